@@ -0,0 +1,210 @@
+import os
+import sys
+import tempfile
+import time
+import hardware
+import registry
+import tracer
+from feeder import Feeder
+from feedercollection import FeederCollection
+
+# Runs the whole feed pipeline on simulated hardware and a virtual clock so
+# timing and accuracy regressions show up without a Pi, e.g.
+#   python3 bench.py --feeds 1000 --weight 25
+#   python3 bench.py --feeds 100 --cats 2
+#   python3 bench.py --feeds 100 --engine loop
+#   python3 bench.py --feeds 100 --bridge 0.05 --flow rate
+#   python3 bench.py --feeds 10 --trace bench.json
+#   python3 bench.py --feeds 10 --food 150 --low 50
+#   python3 bench.py --rates 8 --feeds 3
+#
+# --rates N feeds 1, 2 .. N cats at once on the real clock, so the sampler's
+# own time counts, and reports the samples each channel got per second
+# against the 100 Hz tick. It takes a few seconds of real time per feed.
+
+PWM_PIN = 19
+RESET_PIN = 12
+ADC_CHAN = 0
+RATES_FEEDS = 3
+
+def main(argv):
+  argv.pop(0)
+  feeds = None
+  weight = 25.0
+  seed = 0
+  cats = 1
+  engine = None
+  flow = None
+  hopper = {}
+  food = None
+  verbose = 0
+  trace = None
+  rates = None
+  while len(argv) > 0:
+    argc = len(argv)
+    if argc >= 2 and argv[0] == "--feeds":
+      feeds = int(argv[1])
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--weight":
+      weight = float(argv[1])
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--cats":
+      cats = int(argv[1])
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--engine":
+      engine = argv[1]
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--flow":
+      flow = argv[1]
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--food":
+      food = float(argv[1])
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--low":
+      hopper["low"] = float(argv[1])
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--bridge":
+      hopper["bridge"] = float(argv[1])
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--rates":
+      rates = int(argv[1])
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--seed":
+      seed = int(argv[1])
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--trace":
+      trace = os.path.abspath(argv[1])
+      argv.pop(0)
+    elif argc >= 1 and argv[0] == "-v":
+      verbose += 1
+    else:
+      print("Usage: python3 bench.py [--feeds N] [--weight G] [--seed S] [--cats N] [--engine threads|loop]\n"
+            "                       [--flow timetable|rate] [--bridge <per sec>]\n"
+            "                       [--food <g>] [--low <g>] [--rates N]\n"
+            "                       [--trace <file>] [-v]")
+      return
+    argv.pop(0)
+
+  if feeds == None:
+    feeds = RATES_FEEDS if rates != None else 100
+  hopper["food"] = food if food != None else weight * feeds * 2
+  if trace != None:
+    tracer.use(tracer.Tracer())
+  with tempfile.TemporaryDirectory() as d:
+    os.chdir(d)
+    # A single feeder feeds itself unless an engine is asked for
+    if rates != None:
+      benchRates(rates, feeds, weight, seed, verbose, engine or "threads", hopper)
+    elif cats > 1 or engine != None:
+      benchCollection(feeds, weight, seed, cats, verbose, engine or "threads", flow, hopper)
+    else:
+      benchFeeds(feeds, weight, seed, verbose, flow, hopper)
+  if trace != None:
+    tracer.active().dump(trace)
+    report("trace events", tracer.active().count())
+    report("trace dropped", tracer.active().dropped)
+
+# Feeder i uses ADC channel i, on the second ADC from the ninth, and its own
+# pins
+def simFeeder(seed=0, verbose=0, name="bench", hw=None, i=0, flow=None, **hopper):
+  hw = hw if hw != None else hardware.SimBackend(seed=seed)
+  device, channel = divmod(ADC_CHAN + i, registry.ADC_CHANNELS)
+  h = hw.addHopper(PWM_PIN + 2 * i, channel, device, **hopper)
+  f = Feeder(name, PWM_PIN + 2 * i, RESET_PIN + 2 * i, channel, 5, 9, verbose, hw, adcdevice=device)
+  # Calibrate to the simulated sensor
+  f.calibrate(25.0, 25.0 * h.gain)
+  if flow != None:
+    f.setFlow(flow)
+  return hw, h, f
+
+def benchFeeds(feeds, weight, seed, verbose, flow=None, hopper={}):
+  hw, hopper, f = simFeeder(seed, verbose, flow=flow, **hopper)
+  errors = []
+  durations = []
+  empties = 0
+  start = time.perf_counter()
+  for i in range(feeds):
+    before = hopper.dispensed
+    t = hw.clock.time()
+    f.initFeed(weight)
+    f.startFeed()
+    f.join()
+    durations.append(hw.clock.time() - t)
+    errors.append(hopper.dispensed - before - weight)
+    empties += 1 if f.empty else 0
+    if verbose:
+      print("feed {0} actual {1:.2f}g estimate {2:.2f}g {3:.1f}s hopper {4} {5:.2f}".format(
+        i, hopper.dispensed - before, f.dispensed, durations[-1], f.hopper.state, f.hopper.confidence))
+  real = time.perf_counter() - start
+  virtual = sum(durations)
+  report("feeds", feeds)
+  report("error mean g", sum(errors) / feeds)
+  report("error abs mean g", sum(abs(e) for e in errors) / feeds)
+  report("error abs max g", max(abs(e) for e in errors))
+  report("duration mean s", virtual / feeds)
+  report("empty feeds", empties)
+  report("real per feed ms", 1000 * real / feeds)
+  report("speedup", virtual / real)
+
+def benchCollection(feeds, weight, seed, cats, verbose, engine="threads", flow=None, hopper={}):
+  hw = hardware.SimBackend(seed=seed)
+  collection = FeederCollection(hw, verbose, engine=engine)
+  hoppers = []
+  for i in range(cats):
+    _, h, f = simFeeder(verbose=verbose, name="bench{0}".format(i), hw=hw, i=i, flow=flow, **hopper)
+    collection.add(f)
+    hoppers.append(h)
+  errors = []
+  durations = []
+  start = time.perf_counter()
+  for i in range(feeds):
+    before = [h.dispensed for h in hoppers]
+    t = hw.clock.time()
+    collection.feed({ f.name: weight for f in collection.feeders })
+    durations.append(hw.clock.time() - t)
+    for h, b in zip(hoppers, before):
+      errors.append(h.dispensed - b - weight)
+  real = time.perf_counter() - start
+  virtual = sum(durations)
+  report("feeds", feeds)
+  report("cats", cats)
+  report("engine", engine)
+  report("error mean g", sum(errors) / len(errors))
+  report("error abs mean g", sum(abs(e) for e in errors) / len(errors))
+  report("error abs max g", max(abs(e) for e in errors))
+  report("duration mean s", virtual / feeds)
+  report("real per feed ms", 1000 * real / feeds)
+  report("speedup", virtual / real)
+
+# Samples per channel per second as cats are added, on the real clock
+def benchRates(maxcats, feeds, weight, seed, verbose, engine, hopper):
+  report("engine", engine)
+  report("feeds", feeds)
+  print("{0:<6} {1:>10} {2:>10} {3:>8} {4:>12} {5:>10}".format("cats", "mean Hz", "min Hz", "missed", "late max ms", "cpu/tick ms"))
+  for cats in range(1, maxcats + 1):
+    hw = hardware.SimBackend(hardware.RealClock(), seed)
+    collection = FeederCollection(hw, verbose, engine=engine)
+    for i in range(cats):
+      _, h, f = simFeeder(verbose=verbose, name="rate{0}".format(i), hw=hw, i=i, **hopper)
+      collection.add(f)
+    rates = []
+    missed = 0
+    late = 0.0
+    busy = 0.0
+    ticks = 0
+    for n in range(feeds):
+      start = time.process_time()
+      collection.feed({ f.name: weight for f in collection.feeders })
+      busy += time.process_time() - start
+      ticks += collection.ticks.tick
+      missed += collection.ticks.missed
+      late = max(late, collection.ticks.lateness.max)
+      rates += [f.msamplerate.value for f in collection.feeders]
+    print("{0:<6} {1:>10.1f} {2:>10.1f} {3:>8} {4:>12.3f} {5:>10.3f}".format(
+      cats, sum(rates) / len(rates), min(rates), missed, 1000 * late, 1000 * busy / ticks))
+
+def report(name, value):
+  print("{0:<20} {1:.3f}".format(name, value) if isinstance(value, float) else "{0:<20} {1}".format(name, value))
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -1,3 +1 @@
-python3 /home/pi/catfeeder/git/catfeeder.py -v -v --left Nala --feed 25 &
-python3 /home/pi/catfeeder/git/catfeeder.py -v -v --right Rosie --feed 25 &
-wait
\ No newline at end of file
+python3 /home/pi/catfeeder/git/catfeeder.py -v -v --left Nala --right Rosie --feed 25
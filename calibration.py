@@ -0,0 +1,114 @@
+import caltable
+
+# Calibration: one run of the motor, stopped and weighed as many times as
+# wanted. Each stop lets the food settle and the scale reading is entered;
+# the motor then starts again straight away, the noise floor still fresh
+# and the last run having ended as soon as the sensor settled. Every run
+# between weigh-ins is a portion, the difference between scale readings,
+# and the curve from sensor sums to grams is fitted to them by least
+# squares, see caltable.py. Stopping at different amounts, say 10g, 25g and
+# 50g, fits it across portion sizes. The runs are jobs for the feeder's
+# background worker, so the motor starting again after a weigh-in, or a
+# whole new calibration, starts no thread.
+
+# The runs are fed as calibration segments, Feeder.segment, so they don't
+# touch the excess, average or journal, and however a calibration ends the
+# feeder is left with reset settings.
+
+# More than any hopper holds, a run ends when it is stopped
+SEGMENT_WEIGHT = 10000.0
+CAL_PIECES = 2
+STOP_POLL = 0.1
+
+class Calibration:
+  # With a collection the runs are fed through it, and its feed engine
+  def __init__(self, feeder, collection=None, pieces=CAL_PIECES):
+    self.feeder = feeder
+    self.collection = collection
+    self.pieces = pieces
+    self.sums = 0
+    self.weighed = 0.0
+    self.portions = []
+    self.calibrating = False
+    self.worker = feeder.background
+
+  def start(self, resetcalibration):
+    f = self.feeder
+    self.sums = 0
+    self.weighed = 0.0
+    self.portions = []
+    f.resetSettings()
+    if resetcalibration:
+      f.resetCalibration()
+    f.calms = 0
+    f.segment = True
+    self.resume()
+
+  # Run the motor until stop()
+  def resume(self):
+    f = self.feeder
+    if f.empty:
+      return False
+    self.calibrating = True
+    self.worker.submit(self.calThread)
+    return True
+
+  def calThread(self):
+    f = self.feeder
+    f.resetSettings()
+    if self.collection != None:
+      self.collection.feed({ f.name: SEGMENT_WEIGHT })
+    else:
+      f.initFeed(SEGMENT_WEIGHT)
+      f.startFeed()
+      f.join()
+    self.sums = f.sums
+
+  # Stop the motor and wait for the food to settle, returns the run's sums
+  def stop(self):
+    f = self.feeder
+    if self.calibrating:
+      self.calibrating = False
+      # A stop while the noise is measured would leave the feed waiting for
+      # a baseline nobody takes, let the motor start first
+      while not f.feeding and self.worker.busy():
+        f.clock.sleep(STOP_POLL)
+      f.stop()
+      self.worker.join()
+    return self.sums
+
+  # The scale's reading after the run just stopped, returns the curve so far
+  def add(self, reading):
+    grams = reading - self.weighed
+    if self.sums > 0 and grams > 0:
+      self.portions.append((self.sums, grams))
+    self.weighed = reading
+    self.sums = 0
+    if len(self.portions) == 0:
+      return None
+    return caltable.fit(self.portions, self.pieces)
+
+  def finish(self):
+    f = self.feeder
+    try:
+      if len(self.portions) == 0:
+        raise ValueError("No food weighed to calibrate from")
+      table = caltable.fit(self.portions, self.pieces)
+    except ValueError:
+      self.cancel()
+      raise
+    f.setCalTable(table)
+    f.calms = f.ms
+    self.end()
+    return table
+
+  # Give up without fitting anything
+  def cancel(self):
+    self.stop()
+    self.end()
+
+  def end(self):
+    f = self.feeder
+    f.segment = False
+    f.resetSettings()
+    f.save()
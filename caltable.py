@@ -0,0 +1,114 @@
+from bisect import bisect_right
+
+# Calibration curve from sensor sums to grams, fitted by least squares to
+# the weigh-ins of a calibration run. With one weigh-in it is a ratio, as
+# scaleweight/scaletarget always were; with more it gets an offset, the
+# grams every feed brings that the sensor doesn't see in proportion, such as
+# the tail still falling when it stops, and with pieces > 1 and enough
+# weigh-ins it bends at knots spread through them. The curve is kept as an
+# interpolation table of (sums, grams) knots, "caltable" in <name>.conf, and
+# extended past its ends along the end pieces. A feed of no more than the
+# offset has a target of 0, never a negative one.
+
+# Weigh-ins needed for each piece after the first
+CAL_POINTS_PER_PIECE = 2
+
+# Solve a small dense system, a is a list of rows, by Gaussian elimination
+# with partial pivoting. None if it is singular.
+def solve(a, b):
+  n = len(b)
+  m = [list(row) + [v] for row, v in zip(a, b)]
+  for c in range(n):
+    p = max(range(c, n), key=lambda r: abs(m[r][c]))
+    if abs(m[p][c]) < 1e-12:
+      return None
+    m[c], m[p] = m[p], m[c]
+    for r in range(c + 1, n):
+      k = m[r][c] / m[c][c]
+      for j in range(c, n + 1):
+        m[r][j] -= k * m[c][j]
+  x = [0.0] * n
+  for r in range(n - 1, -1, -1):
+    x[r] = (m[r][n] - sum(m[r][j] * x[j] for j in range(r + 1, n))) / m[r][r]
+  return x
+
+# Least squares on basis functions of s, accumulating the normal equations
+# one point at a time
+class LeastSquares:
+  def __init__(self, basis):
+    self.basis = basis
+    n = len(basis)
+    self.ata = [[0.0] * n for i in range(n)]
+    self.aty = [0.0] * n
+    self.points = 0
+
+  def add(self, s, y):
+    row = [f(s) for f in self.basis]
+    for i, ri in enumerate(row):
+      self.aty[i] += ri * y
+      for j, rj in enumerate(row):
+        self.ata[i][j] += ri * rj
+    self.points += 1
+
+  def solve(self):
+    return solve(self.ata, self.aty)
+
+def hinge(knot):
+  return lambda s: max(s - knot, 0.0)
+
+# Piecewise linear through the points (xs, ys), xs increasing, carried on
+# past either end
+def interpolate(xs, ys, x):
+  i = min(max(bisect_right(xs, x) - 1, 0), len(xs) - 2)
+  return ys[i] + (x - xs[i]) * (ys[i + 1] - ys[i]) / (xs[i + 1] - xs[i])
+
+class CalTable:
+  def __init__(self, knots):
+    if len(knots) < 2:
+      raise ValueError("A calibration table needs two knots")
+    for (s0, g0), (s1, g1) in zip(knots, knots[1:]):
+      if s1 <= s0 or g1 <= g0:
+        raise ValueError("Calibration table isn't increasing")
+    self.knots = [(float(s), float(g)) for s, g in knots]
+    self.sums = [s for s, g in self.knots]
+    self.grams = [g for s, g in self.knots]
+
+  def weight(self, target):
+    return interpolate(self.sums, self.grams, target)
+
+  def target(self, weight):
+    return max(interpolate(self.grams, self.sums, weight), 0.0)
+
+  def text(self):
+    return " ".join("{0:.3g}:{1:.3g}g".format(s, g) for s, g in self.knots)
+
+# Fit (sums, grams) weigh-ins, returns a CalTable
+def fit(points, pieces=1):
+  points = sorted(points)
+  if len(points) == 0:
+    raise ValueError("No weigh-ins to calibrate from")
+  top = points[-1][0]
+  if top <= 0:
+    raise ValueError("No food seen to calibrate from")
+  if len(points) == 1:
+    return CalTable([(0.0, 0.0), points[0]])
+  pieces = max(min(pieces, 1 + (len(points) - 2) // CAL_POINTS_PER_PIECE), 1)
+  # Knots where each piece holds as many weigh-ins
+  knots = [points[len(points) * k // pieces][0] for k in range(1, pieces)]
+  while pieces >= 1:
+    basis = [lambda s: 1.0, lambda s: s] + [hinge(k) for k in knots]
+    ls = LeastSquares(basis)
+    for s, g in points:
+      ls.add(s, g)
+    x = ls.solve()
+    if x != None:
+      at = [0.0] + knots + [top]
+      model = lambda s: sum(c * f(s) for c, f in zip(x, basis))
+      try:
+        return CalTable([(s, model(s)) for s in at])
+      except ValueError:
+        pass
+    # Not increasing, or the weigh-ins can't place a knot, use fewer pieces
+    pieces -= 1
+    knots = knots[:-1]
+  raise ValueError("Weigh-ins don't increase with the sensor")
@@ -1,45 +1,46 @@
 import faulthandler
 import sys
-import threading
-import time
-import RPi.GPIO as GPIO
+import control
+import eventlog
+import hardware
+import registry
+import tracer
+from calibration import Calibration
 from enum import Enum
-from feeder import Feeder
 from feedercollection import FeederCollection
 
 # Constants
 PWM_FREQUENCY = 50
-# BCM numbers for outputs (BOARD numbers in comment)
-# Nala left
-LEFT_RESET_PIN = 12   # 32
-LEFT_PWM_PIN = 19     # 35
-LEFT_ADC_CHAN = 0     # 1
-
-# Rosie right
-RIGHT_RESET_PIN = 24  # 18
-RIGHT_PWM_PIN = 18    # 12
-RIGHT_ADC_CHAN = 1    # 2
-
-# Our servos behave slightly differently, normalize this here
-LEFT_CLOCK_PWM = 5
-LEFT_ANTI_PWM = 9
-RIGHT_CLOCK_PWM = 5
-RIGHT_ANTI_PWM = 10
+# Pins, ADC channels and servo duties are in registry.py
 
 faulthandler.enable()
 feeder = None
+feeders = None
+hw = None
 # 0,1,2
 verbose = 0
 
 def main(argv):
-  global feeder, verbose
+  global feeder, feeders, verbose, hw
   print("Cat Feeder 0.3")
   
   # pop program name
   argv.pop(0)
   op = None
   weight = 0
+  flow = None
   resetcalibration = False
+  sides = []
+  registrypath = None
+  backend = "pi"
+  fastadc = True
+  engine = "threads"
+  record = False
+  trace = None
+  logpath = None
+  logsample = {}
+  local = False
+  path = control.SOCKET_PATH
 
   while len(argv) > 0:
     argc = len(argv)
@@ -48,13 +49,35 @@ def main(argv):
       return
     elif argc >= 1 and argv[0] == "-v":
       verbose += 1
-    elif argc >= 2 and argv[0] == "--left":
-      feeder = Feeder(argv[1], LEFT_PWM_PIN, LEFT_RESET_PIN, LEFT_ADC_CHAN, 
-                      LEFT_CLOCK_PWM, LEFT_ANTI_PWM, verbose)
+    elif argc >= 1 and argv[0] == "--sim":
+      backend = "sim"
+    elif argc >= 1 and argv[0] == "--slowadc":
+      fastadc = False
+    elif argc >= 2 and argv[0] == "--engine":
+      engine = argv[1]
       argv.pop(0)
-    elif argc >= 2 and argv[0] == "--right":
-      feeder = Feeder(argv[1], RIGHT_PWM_PIN, RIGHT_RESET_PIN, RIGHT_ADC_CHAN, 
-                      RIGHT_CLOCK_PWM, RIGHT_ANTI_PWM, verbose)
+    elif argc >= 1 and argv[0] == "--record":
+      record = True
+    elif argc >= 1 and argv[0] == "--local":
+      local = True
+    elif argc >= 2 and argv[0] == "--log":
+      logpath = argv[1]
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--log-sample":
+      level, n = eventlog.parseSample(argv[1])
+      logsample[level] = n
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--trace":
+      trace = argv[1]
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--socket":
+      path = argv[1]
+      argv.pop(0)
+    elif argc >= 2 and (argv[0] == "--left" or argv[0] == "--right" or argv[0] == "--cat"):
+      sides.append((argv[0], argv[1]))
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--feeders":
+      registrypath = argv[1]
       argv.pop(0)
     elif argc >= 1 and argv[0] == "--info":
       op = argv[0]
@@ -64,6 +87,12 @@ def main(argv):
       resetcalibration = True
     elif argc >= 1 and argv[0] == "--cal":
       op = argv[0]
+    elif argc >= 1 and argv[0] == "--schedule":
+      op = argv[0]
+    elif argc >= 2 and argv[0] == "--flow":
+      flow = argv[1]
+      op = argv[0]
+      argv.pop(0)
     elif argc >= 2 and argv[0] == "--feed":
       weight = float(argv[1])
       op = argv[0]
@@ -73,44 +102,123 @@ def main(argv):
       return
     argv.pop(0)
 
-  if feeder == None:
+  if op == "--schedule":
+    if control.available(path):
+      show(control.request({ "op": "schedule", "reload": True }, path))
+    else:
+      print("Feed schedules are kept by feederd.py, which isn't running.")
+    return
+  if len(sides) == 0:
       help()
       return
-  init()
+  try:
+    specs = feederSpecs(sides, registrypath)
+  except (OSError, ValueError) as e:
+    print("Feeders: {0}".format(e))
+    return
+  # Hand the work to the feeder daemon when one is running
+  if not local and op != None and control.available(path):
+    remote(path, op, [s.name for s in specs], weight, resetcalibration, flow)
+    return
+  init(backend, specs)
+  if logpath != None or logsample:
+    eventlog.use(eventlog.EventLog(logpath, sample=logsample))
+  if trace != None:
+    tracer.use(tracer.Tracer())
+  feeders = FeederCollection(hw, verbose, fastadc, engine)
+  for s in specs:
+    feeders.add(s.create(verbose, hw, fastadc))
+  if record:
+    for f in feeders.feeders:
+      f.startRecording()
+  feeder = feeders.feeders[0]
   if op == "--info":
-    feeder.info()
+    for f in feeders.feeders:
+      f.info()
   elif op == "--reset":
-    feeder.resetSettings()
-    feeder.save()
+    for f in feeders.feeders:
+      f.resetSettings()
+      f.save()
+  elif op == "--flow":
+    for f in feeders.feeders:
+      f.setFlow(flow)
+      f.save()
+      f.info()
   elif op == "--cal":
-    cal2(feeder, resetcalibration)
+    if len(feeders.feeders) > 1:
+      print("Calibrate one feeder at a time.")
+    else:
+      cal2(feeder, resetcalibration)
   elif op == "--feed":
-    feed(weight)
+    if len(feeders.feeders) > 1 or feeders.engine == "loop":
+      feedAll(weight)
+    else:
+      feed(weight)
   else:
     help()
+  for f in feeders.feeders:
+    f.flush()
+  if trace != None:
+    tracer.active().dump(trace)
   # Wait for threads to really end
   feeder = None
-  time.sleep(5)
+  feeders = None
+  hw.clock.sleep(5)
 
-  GPIO.cleanup()
+  hw.cleanup()
   return
 
 def help():
   print("--help          Print this message.")
   print("--left <name>   Use the left hand feeder for cat <name>.")
   print("--right <name>  Use the right hand feeder for cat <name>.")
+  print("                Give both to feed both cats at once.")
+  print("--cat <name>    Use the feeder for cat <name> in the feeder registry, as many as wanted.")
+  print("--feeders <file>  The feeder registry, feeders.json unless given. See registry.py.")
   print("--reset         Reset feeder history. Sets excess and average to 0.")
   print("--info          Print feeder info.")
-  print("--cal           Calibrate the cat feeder, needs >200g of food loaded into feeder.")
+  print("--cal           Calibrate the cat feeder, needs >200g of food loaded into feeder. The motor runs")
+  print("                until stopped to weigh, as often as you like, and a curve is fitted to the weigh-ins.")
   print("--resetcal      Reset the calibration before starting measurement.")
   print("--feed <N>      Feed <N> grams of food.")
+  print("--flow <name>   How the motor is driven: timetable (default) or rate, kept per feeder.")
+  print("--schedule      Reload feederd.py's feed schedule and show the next feeds.")
+  print("--local         Drive the hardware directly even if feederd.py is running.")
+  print("--socket <path>  The feeder daemon's control socket.")
+  print("--sim           Use simulated hardware on a virtual clock.")
+  print("--slowadc       Read the ADC through gpiozero, not the SPI block reader.")
+  print("--engine <name> threads (default) or loop, which runs the motors from the sampler thread.")
+  print("--record        Record every sample and motor state to <name>.trace.")
+  print("--trace <file>  Time ADC reads, integration, motor steps and saves, written as Chrome trace JSON.")
+  print("--log <file>    Write -v output to <file> as JSON lines, rotated at 1MB.")
+  print("--log-sample <level>=<n>  Keep one in <n> info or debug events.")
   print("-v              More detail.")
   print("-v -v           Even More detail.")
 
-def init():
-  #GPIO.setmode(GPIO.BOARD)
-  GPIO.setmode(GPIO.BCM)
-  GPIO.setwarnings(True)
+# The feeders --left, --right and --cat ask for, the registry file is only
+# read for --cat
+def feederSpecs(sides, path=None):
+  found = None
+  specs = []
+  for side, name in sides:
+    if side == "--cat":
+      if found == None:
+        found = registry.loadRegistry(path if path != None else registry.REGISTRY_PATH)
+      s = registry.find(found, name)
+      if s == None:
+        raise ValueError("No feeder called {0} in the registry".format(name))
+      specs.append(s)
+    else:
+      specs.append(registry.side(side[2:], name))
+  return registry.validate(specs)
+
+def init(backend, specs):
+  global hw
+  hw = hardware.use(hardware.create(backend))
+  if backend == "sim":
+    for s in specs:
+      hw.addHopper(s.pwm, s.adc, s.device)
+  hw.setup(True)
 
 def feed(weight):
   feeder.initFeed(weight)
@@ -120,49 +228,77 @@ def feed(weight):
     print("Warning: {0}'s feeder is empty".format(feeder.name))
   feeder.info()
 
-sums = 0
-calibrating = True
+def feedAll(weight):
+  for f in feeders.feed({ f.name: weight for f in feeders.feeders }):
+    if f.empty:
+      print("Warning: {0}'s feeder is empty".format(f.name))
+    f.info()
 
 def cal2(f, resetcalibration):
-  global sums, calibrating
-  sums = 0
-  calibrating = True
-  f.resetSettings()
-  if resetcalibration:
-    f.resetCalibration()
-  f.calms = 0
-  cal = threading.Thread(target=calThread)
-  cal.daemon = True
-  cal.start()
-  input("Press return when around 200g has been dispensed")
-  calibrating = False
-  f.stop()
-  cal.join()
-  done = False
-  while not done:
-    text = input("Exact amount dispensed in grammes")
+  cal = Calibration(f, feeders)
+  cal.start(resetcalibration)
+  while True:
+    with hw.clock.blocking():
+      input(STOP_PROMPT)
+    cal.stop()
+    with hw.clock.blocking():
+      table = cal.add(askAmount())
+      if table != None:
+        print("Calibration so far {0}".format(table.text()))
+      if input(MORE_PROMPT).strip() == "f":
+        break
+    if not cal.resume():
+      print("Feeder is empty")
+      break
+  try:
+    cal.finish()
+  except ValueError as e:
+    print("Calibration failed: {0}".format(e))
+    return
+  f.info()
+
+STOP_PROMPT = "Press return to stop the motor and weigh, around 10g, 25g and 50g in"
+MORE_PROMPT = "Press return to dispense more, or f and return to finish"
+
+def askAmount():
+  while True:
+    text = input("Scale reading in grammes")
     try:
-      amount = float(text)
-      done = True
+      return float(text)
     except:
       pass
-  f.calibrate(amount, sums)
-  f.calms = f.ms
-  f.resetSettings()
-  f.save()
-
-def calThread():
-  global sums, calibrating
-  f = feeder
-  print("Cal thread for {0}".format(f.name))
-  sums = 0
-  # feed in 25g chunks
-  while not f.empty and calibrating:
-    f.initFeed(25.0)
-    f.startFeed()
-    f.join()
-    sums += f.sums
-    print("{0} {1}".format(sums, f.sums))
+
+def remote(path, op, names, weight, resetcalibration, flow=None):
+  if op == "--cal":
+    # One connection throughout, the daemon cancels the calibration if it
+    # drops
+    with control.Connection(path) as c:
+      if not show(c.request({ "op": "calstart", "names": names, "resetcal": resetcalibration })):
+        return
+      try:
+        while True:
+          input(STOP_PROMPT)
+          if not show(c.request({ "op": "calstop", "names": names })):
+            return
+          amount = askAmount()
+          if input(MORE_PROMPT).strip() == "f":
+            break
+          if not show(c.request({ "op": "calweigh", "names": names, "amount": amount })):
+            return
+      except (KeyboardInterrupt, EOFError):
+        show(c.request({ "op": "calcancel", "names": names }))
+        return
+      show(c.request({ "op": "calset", "names": names, "amount": amount }))
+  else:
+    show(control.request({ "op": op[2:], "names": names, "weight": weight, "flow": flow }, path))
+
+def show(response):
+  if not response["ok"]:
+    print("Error: {0}".format(response["error"]))
+    return False
+  for line in response["lines"]:
+    print(line)
+  return True
 
 if __name__ == "__main__":
     main(sys.argv)
\ No newline at end of file
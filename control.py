@@ -0,0 +1,51 @@
+import json
+import socket
+
+# The feeder daemon's control socket. Requests and responses are single
+# lines of JSON; a request names an op and the feeders it applies to.
+
+SOCKET_PATH = "/tmp/catfeeder.sock"
+
+def available(path=SOCKET_PATH):
+  try:
+    with connect(path):
+      return True
+  except OSError:
+    return False
+
+def connect(path=SOCKET_PATH):
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    s.connect(path)
+  except OSError:
+    s.close()
+    raise
+  return s
+
+# Several requests over one connection. A calibration started on a
+# connection is cancelled by the daemon when the connection closes.
+class Connection:
+  def __init__(self, path=SOCKET_PATH):
+    self.socket = connect(path)
+    self.file = self.socket.makefile("r", encoding="utf-8")
+
+  def request(self, message):
+    self.socket.sendall((json.dumps(message) + "\n").encode("utf-8"))
+    line = self.file.readline()
+    if not line:
+      return { "ok": False, "error": "No response from feeder daemon" }
+    return json.loads(line)
+
+  def close(self):
+    self.file.close()
+    self.socket.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+def request(message, path=SOCKET_PATH):
+  with Connection(path) as c:
+    return c.request(message)
@@ -0,0 +1,189 @@
+import re
+import time
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+# Just enough of cron to know when the next feed is. Parses the crontab
+# lines that run catfeeder.py, with lists, ranges, steps and names in every
+# field and cron's rule that a day matches if either the day of the month or
+# the day of the week does when both are restricted, and expands them into a
+# sorted index of feed times per cat so finding the next feed is a bisect.
+
+CRONTAB = "/etc/crontab"
+# How far ahead the index goes, a week covers any day of week pattern. Day of
+# the month and month entries can be further off than that, a cat with
+# nothing in the index falls back to asking its entries directly.
+INDEX_DAYS = 8
+
+MONTHS = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+DAYS = ["sun", "mon", "tue", "wed", "thu", "fri", "sat"]
+
+MACROS = {
+  "@yearly": "0 0 1 1 *",
+  "@annually": "0 0 1 1 *",
+  "@monthly": "0 0 1 * *",
+  "@weekly": "0 0 * * 0",
+  "@daily": "0 0 * * *",
+  "@midnight": "0 0 * * *",
+  "@hourly": "0 * * * *",
+}
+
+def parseValue(text, lo, names):
+  if names != None and text.lower() in names:
+    return names.index(text.lower()) + lo
+  return int(text)
+
+# The sorted values lo..hi a field matches
+def parseField(text, lo, hi, names=None):
+  values = set()
+  for part in text.split(","):
+    step = 1
+    if "/" in part:
+      part, s = part.split("/", 1)
+      step = int(s)
+      if step < 1:
+        raise ValueError("Bad step in cron field {0}".format(text))
+    if part == "*":
+      start, end = lo, hi
+    elif "-" in part:
+      a, b = part.split("-", 1)
+      start, end = parseValue(a, lo, names), parseValue(b, lo, names)
+    else:
+      start = parseValue(part, lo, names)
+      # 5/15 means from 5 to the end in steps of 15
+      end = hi if step > 1 else start
+    if start < lo or end > hi or start > end:
+      raise ValueError("Cron field {0} out of range {1}-{2}".format(text, lo, hi))
+    values.update(range(start, end + 1, step))
+  return sorted(values)
+
+class CronEntry:
+  def __init__(self, fields, command=""):
+    if len(fields) != 5:
+      raise ValueError("Cron entry needs 5 time fields")
+    self.minutes = parseField(fields[0], 0, 59)
+    self.hours = parseField(fields[1], 0, 23)
+    self.days = set(parseField(fields[2], 1, 31))
+    self.months = set(parseField(fields[3], 1, 12, MONTHS))
+    # 0 and 7 are both Sunday
+    self.weekdays = set(d % 7 for d in parseField(fields[4], 0, 7, DAYS + ["sun"]))
+    self.anyday = fields[2].startswith("*")
+    self.anyweekday = fields[4].startswith("*")
+    self.command = command
+
+  def matchesDay(self, date):
+    if date.month not in self.months:
+      return False
+    day = date.day in self.days
+    # Python's Monday is 0, cron's Sunday is 0
+    weekday = (date.weekday() + 1) % 7 in self.weekdays
+    if self.anyday or self.anyweekday:
+      return day and weekday
+    return day or weekday
+
+  # Local times from start (a datetime) for the next days days
+  def times(self, start, days):
+    base = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    for d in range(days):
+      date = base + timedelta(days=d)
+      if not self.matchesDay(date):
+        continue
+      for hour in self.hours:
+        for minute in self.minutes:
+          t = date.replace(hour=hour, minute=minute)
+          if t >= start:
+            yield t
+
+  # Epoch time of the first run after now, None if there isn't one in a year
+  def next(self, now):
+    start = datetime.fromtimestamp(now).replace(second=0, microsecond=0)
+    for t in self.times(start, 366):
+      if t.timestamp() > now:
+        return t.timestamp()
+    return None
+
+# The catfeeder entries of a crontab, with the cats each one feeds. Entries
+# that don't name a cat feed everyone and are listed under None.
+def parseCrontab(text, match="catfeeder", system=True):
+  entries = []
+  for line in text.splitlines():
+    line = line.strip()
+    if line == "" or line.startswith("#") or match not in line:
+      continue
+    fields = line.split()
+    if fields[0].startswith("@"):
+      if fields[0] not in MACROS:
+        # @reboot
+        continue
+      fields = MACROS[fields[0]].split() + fields[1:]
+    # /etc/crontab has a user before the command
+    command = " ".join(fields[6 if system else 5:])
+    # catfeeder.py --reset and friends aren't feeds
+    if not command or ("catfeeder.py" in command and "--feed" not in command):
+      continue
+    try:
+      entry = CronEntry(fields[:5], command)
+    except ValueError:
+      continue
+    names = re.findall(r"--(?:left|right|cat)\s+(\S+)", command)
+    entries.append((entry, names if names else [None]))
+  return entries
+
+class FeedSchedule:
+  def __init__(self, path=CRONTAB, days=INDEX_DAYS):
+    self.path = path
+    self.days = days
+    self.index = None
+    self.end = None
+    self.entries = []
+    self.beyond = {}
+
+  # Forget the index, the crontab has changed
+  def invalidate(self):
+    self.index = None
+
+  def build(self, now):
+    with open(self.path) as f:
+      entries = parseCrontab(f.read())
+    self.entries = entries
+    self.beyond = {}
+    start = datetime.fromtimestamp(now).replace(second=0, microsecond=0)
+    index = {}
+    for entry, names in entries:
+      times = [t.timestamp() for t in entry.times(start, self.days)]
+      for name in names:
+        index.setdefault(name, set()).update(times)
+    self.index = { name: sorted(times) for name, times in index.items() }
+    # Rebuild a day before running out
+    self.end = now + (self.days - 1) * 24 * 3600
+
+  # Time of the next feed for name, or for anyone when name is None
+  def next(self, name=None, now=None):
+    now = time.time() if now == None else now
+    if self.index == None or now >= self.end:
+      self.build(now)
+    best = None
+    for key in set([name, None]) if name != None else self.index.keys():
+      times = self.index.get(key, [])
+      i = bisect_right(times, now)
+      if i < len(times) and (best == None or times[i] < best):
+        best = times[i]
+    if best == None:
+      best = self.after(name, now)
+    return best
+
+  # Past the end of the index, the first run of any of name's entries. Kept
+  # until it has gone by, it can be most of a year of days to search.
+  def after(self, name, now):
+    t = self.beyond.get(name)
+    if t != None and t > now:
+      return t
+    t = None
+    for entry, names in self.entries:
+      if name != None and name not in names and None not in names:
+        continue
+      n = entry.next(now)
+      if n != None and (t == None or n < t):
+        t = n
+    self.beyond[name] = t
+    return t
@@ -0,0 +1,153 @@
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+# Verbose output off the sampling and motor threads. print() blocks when the
+# console or pipe is slow, which stretched the very loops -v was timing.
+# Events are dicts (event name, feeder, state, sums, times, ...) put on a
+# bounded queue without waiting; a writer thread formats them, as text lines
+# or JSON lines, and writes them out. A full queue drops events and counts
+# them rather than stall the caller. Each level can be sampled, keeping one
+# event in n, and a log file is rotated once it grows past maxbytes.
+
+# Levels, as the number of -v needed to see them
+INFO = 1
+DEBUG = 2
+LEVEL_NAMES = { INFO: "info", DEBUG: "debug" }
+
+LOG_QUEUE = 4096
+LOG_MAX_BYTES = 1 << 20
+LOG_BACKUPS = 3
+
+class EventLog:
+  # sample maps a level to n, keeping one of every n events at that level
+  def __init__(self, path=None, asjson=False, sample=None, maxsize=LOG_QUEUE,
+               maxbytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, stream=None):
+    self.path = path
+    self.json = asjson or path != None
+    self.sample = dict(sample or {})
+    self.seen = {}
+    self.maxbytes = maxbytes
+    self.backups = backups
+    self.stream = stream if stream != None else sys.stdout
+    self.file = None
+    self.queue = queue.Queue(maxsize)
+    self.dropped = 0
+    self.written = 0
+    self.failed = None
+    self.thread = threading.Thread(target=self.writerThread, name="eventlog")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def event(self, level, event, **fields):
+    n = self.sample.get(level, 1)
+    if n > 1:
+      seen = self.seen.get(level, 0)
+      self.seen[level] = seen + 1
+      if seen % n != 0:
+        return
+    fields["time"] = time.time()
+    fields["level"] = level
+    fields["event"] = event
+    try:
+      self.queue.put_nowait(fields)
+    except queue.Full:
+      self.dropped += 1
+
+  def info(self, event, **fields):
+    self.event(INFO, event, **fields)
+
+  def debug(self, event, **fields):
+    self.event(DEBUG, event, **fields)
+
+  # Wait for everything queued so far to be written
+  def flush(self):
+    self.queue.join()
+
+  def close(self):
+    self.flush()
+    if self.file != None:
+      self.file.close()
+      self.file = None
+
+  def format(self, fields):
+    if self.json:
+      return json.dumps(fields, default=str)
+    t = fields.pop("time")
+    fields.pop("level")
+    text = "{0}.{1:03d} {2}".format(time.strftime("%H:%M:%S", time.localtime(t)), int(t * 1000) % 1000, fields.pop("event"))
+    name = fields.pop("feeder", None)
+    if name != None:
+      text += " " + name
+    for k, v in fields.items():
+      text += " {0}={1}".format(k, "{0:.4g}".format(v) if isinstance(v, float) else v)
+    return text
+
+  def writerThread(self):
+    while True:
+      fields = self.queue.get()
+      try:
+        self.write(self.format(fields) + "\n")
+      except Exception as e:
+        # Say so once, not for every event after
+        if self.failed == None:
+          sys.stderr.write("Event log failed: {0}\n".format(e))
+        self.failed = e
+      self.queue.task_done()
+
+  def write(self, line):
+    if self.path == None:
+      self.stream.write(line)
+      self.stream.flush()
+      return
+    if self.file == None:
+      self.file = open(self.path, "a")
+    if self.file.tell() + len(line) > self.maxbytes and self.file.tell() > 0:
+      self.rotate()
+    self.file.write(line)
+    self.file.flush()
+    self.written += 1
+
+  # log -> log.1 -> ... -> log.<backups>, the oldest is lost
+  def rotate(self):
+    self.file.close()
+    for i in range(self.backups - 1, 0, -1):
+      if os.path.exists("{0}.{1}".format(self.path, i)):
+        os.replace("{0}.{1}".format(self.path, i), "{0}.{1}".format(self.path, i + 1))
+    if self.backups > 0:
+      os.replace(self.path, self.path + ".1")
+    else:
+      os.unlink(self.path)
+    self.file = open(self.path, "a")
+
+LOG = None
+
+def use(log):
+  global LOG
+  if LOG != None and LOG != log:
+    LOG.close()
+  LOG = log
+  return log
+
+# The log in use, writing text lines to stdout unless another was set up
+def get():
+  if LOG == None:
+    use(EventLog())
+  return LOG
+
+def closeLog():
+  if LOG != None:
+    LOG.close()
+
+atexit.register(closeLog)
+
+# "debug=10" or "2=10" to keep one debug event in ten
+def parseSample(text):
+  levels = { name: level for level, name in LEVEL_NAMES.items() }
+  level, n = text.split("=")
+  level = levels[level] if level in levels else int(level)
+  return level, int(n)
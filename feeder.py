@@ -1,12 +1,20 @@
-import json
 import math
-import os.path
-import sys
-import threading
-import time
-import RPi.GPIO as GPIO
-from gpiozero import MCP3008
+import caltable
+import eventlog
+import flowcontrol
+import hardware
+import hopper
+import metrics
+import recorder
+import spiadc
+import tracer
+import workers
 from enum import Enum
+from inflight import InFlightModel
+from noisefloor import NoiseFloor, NOISE_MAX_READING, NOISE_MIN_SAMPLES
+from persist import StateFile, FeedJournal
+from ringbuffer import SampleRing
+from scheduler import DeadlineScheduler, LATENESS_BOUNDS
 
 # Constants
 PWM_FREQUENCY = 50
@@ -22,17 +30,43 @@ ANTI_WIGGLE_TIME = 0.3 # 0.36
 CLOCK_WIGGLE_TIME = 0.3
 
 FED_TIMEOUT_SECS = 10
+# Once the motor has stopped and nothing has been seen for SETTLE_MIN_SECS,
+# the feed ends when a window of SETTLE_WINDOW samples is within SETTLE_Z
+# standard errors of the noise floor, FED_TIMEOUT_SECS at the latest
+SETTLE_MIN_SECS = 0.5
+SETTLE_WINDOW = 25
+SETTLE_Z = 3.0
 EMPTY_TIME = 1.5
 
-LOW_POWER_SECS = 30
-HIGH_POWER_SECS = 90
 EMPTY_TEST_SECS = 180
-JIGGLE_INTERVAL = 15
+
+# Motor timings a feeder can override, see registry.py
+TIMING = {
+  "flips": FLIPS,
+  "antiflip": ANTI_FLIP_TIME,
+  "antiflipmax": ANTI_FLIP_MAX,
+  "clockflip": CLOCK_FLIP_TIME,
+  "clockflipmax": CLOCK_FLIP_MAX,
+  "wiggles": WIGGLES,
+  "antiwiggle": ANTI_WIGGLE_TIME,
+  "clockwiggle": CLOCK_WIGGLE_TIME,
+  "empty": EMPTY_TIME,
+}
 
 DEBUG_PIN = 6     # 31
 
-GPIO.setup(DEBUG_PIN, GPIO.OUT)
-GPIO.output(DEBUG_PIN, False)
+# Sensor cycle: reset pulse, integrate, sample
+RESET_TIME = 0.0005
+INTEGRATE_TIME = 0.0095 - RESET_TIME
+SAMPLE_TIME = 0.0005
+TICK_TIME = RESET_TIME + INTEGRATE_TIME + SAMPLE_TIME
+# How often the integrator takes the samples waiting in the ring
+BATCH_TIME = 0.02
+# How long to measure the noise before a feed when there is no fresh estimate
+BASELINE_SECS = 5
+
+# Conversions averaged per sample when the fast SPI reader is available
+ADC_OVERSAMPLE = 4
 
 class MotorState(Enum):
   START = 0
@@ -45,202 +79,468 @@ class MotorState(Enum):
   COMPLETE = 7
 
 class Feeder:
-  def __init__(self, name, pwmpin, resetpin, adcchannel, clockwise, anticlockwise, verbose):
+  def __init__(self, name, pwmpin, resetpin, adcchannel, clockwise, anticlockwise, verbose, hw=None, fastadc=True, adcdevice=0, timing=None):
     self.name = name
+    self.hw = hw if hw != None else hardware.backend()
+    self.clock = self.hw.clock
+    self.timing = dict(TIMING)
+    if timing != None:
+      self.timing.update(timing)
 
     self.empty = False
     self.running = False
+    # A calibration run, kept out of the excess, average and journal
+    self.segment = False
 
+    self.calms = 0
+    self.sums = 0
+    # When the daemon's schedule next feeds this cat, for the LEDs
+    self.nextfeed = None
+    self.setFlow("timetable")
+    self.noise = NoiseFloor()
+    self.inflight = InFlightModel()
+    self.hopper = hopper.HopperMonitor()
     self.resetSettings()
     self.resetCalibration()
 
+    self.hw.setupOutput(DEBUG_PIN, False)
+
     self.resetpin = resetpin
-    GPIO.setup(self.resetpin, GPIO.OUT)
     # Keep high to reduce current, power
-    GPIO.output(self.resetpin, True)
+    self.hw.setupOutput(self.resetpin, True)
 
     self.pwmpin = pwmpin
-    GPIO.setup(pwmpin, GPIO.OUT)
-    self.pwm = GPIO.PWM(pwmpin, PWM_FREQUENCY)
+    self.pwm = self.hw.pwm(pwmpin, PWM_FREQUENCY)
     self.pwm.start(0)
     self.motorstate = MotorState.START
     self.motorstatecounter = 0
 
     self.adcchannel = adcchannel
-    self.adc = MCP3008(channel=adcchannel, device=0)
-    self.adcevent = threading.Event()
-    self.motorevent = threading.Event()
+    self.adcdevice = adcdevice
+    self.adc = spiadc.openAdc(self.hw, adcdevice, fastadc, verbose)
+    # Conversions summed into each sample
+    self.adcrepeat = ADC_OVERSAMPLE if self.adc.name == "spi" else 1
+    self.adcblock = self.adc.plan([adcchannel], self.adcrepeat)
+    # Samples are stored as the raw sum of the block's counts
+    self.adcscale = 1.0 / (len(self.adcblock.counts) * spiadc.MAX_COUNT)
+    self.samples = SampleRing()
+    self.baselined = self.clock.event()
+    self.baselinerequest = None
+    self.noisefresh = None
+    self.motorevent = self.clock.event()
 
     self.clockwise = clockwise
     self.anticlockwise = anticlockwise
+    self.setupStates()
+    # The "threads" engine's measure, integrator and motor, kept from feed to
+    # feed, see workers.py
+    self.measure = workers.Worker(self.clock, name + " measure")
+    self.integrator = workers.Worker(self.clock, name + " integrate")
+    self.motorworker = workers.Worker(self.clock, name + " motor")
+    # Runs whole feeds in the background, calibration's runs
+    self.background = workers.Worker(self.clock, name + " background")
+    # Writes the settings and journal, which sync to disk, for the sampling
+    # and motor threads
+    self.writer = workers.Worker(self.clock, name + " writer")
+    self.scheduler = DeadlineScheduler(self.clock, TICK_TIME)
 
     self.verbose = verbose
+    self.recorder = None
 
+    self.setupMetrics(metrics.REGISTRY)
+    self.state = StateFile(name + ".conf")
+    self.journal = FeedJournal(name + ".journal")
     self.load()
 
+  def setupMetrics(self, registry):
+    self.registry = registry
+    m = registry
+    self.msamples = m.counter("catfeeder_adc_samples_total", "Sensor samples integrated during feeds", feeder=self.name)
+    self.mdropped = m.counter("catfeeder_samples_dropped_total", "Samples dropped by a full sample ring", feeder=self.name)
+    self.mmissed = m.counter("catfeeder_missed_ticks_total", "Sampler ticks skipped because the loop fell behind", feeder=self.name)
+    self.mlateness = m.histogram("catfeeder_tick_lateness_seconds", "Worst lateness of each sampler tick", LATENESS_BOUNDS, feeder=self.name)
+    self.msamplerate = m.gauge("catfeeder_sample_rate_hz", "Samples per second over the last feed", feeder=self.name)
+    self.mduration = m.histogram("catfeeder_feed_duration_seconds", "Feed duration", feeder=self.name)
+    self.mdispensed = m.counter("catfeeder_dispensed_grams_total", "Grams dispensed", feeder=self.name)
+    self.mrate = m.gauge("catfeeder_dispense_rate_grams_per_second", "Grams per second of motor running over the last feed", feeder=self.name)
+    self.msave = m.histogram("catfeeder_save_seconds", "Time taken saving the settings", metrics.SAVE_BOUNDS, feeder=self.name)
+    self.mdwell = {}
+
+  def dwell(self, state, secs):
+    h = self.mdwell.get(state)
+    if h == None:
+      h = self.mdwell[state] = self.registry.histogram("catfeeder_motor_state_seconds", "Time spent in each motor state", feeder=self.name, state=state.name.lower())
+    h.add(secs)
+
+  # Verbose output goes through the event log, off the sampling threads
+  def log(self, level, event, **fields):
+    if self.verbose >= level:
+      eventlog.get().event(level, event, feeder=self.name, **fields)
+
+  # Record every sample, motor state and feed to a trace file
+  def startRecording(self, path=None):
+    self.recorder = recorder.Recorder(path if path != None else self.name + ".trace", self.name)
+
+  def record(self, kind, arg=0, value=0, extra=0.0):
+    if self.recorder != None:
+      self.recorder.record(self.clock.time(), kind, arg, value, extra)
+
+  # Built once, a feed only puts back the flip and wiggle durations its flow
+  # changed
   def setupStates(self):
+    t = self.timing
     self.states = {
         MotorState.START:       { "pwm": 0, "duration":  0, "repeat": 0, "right": True, "fn": self.stateStart },
-        MotorState.LEFTWIGGLE:  { "pwm": self.anticlockwise, "duration":  ANTI_WIGGLE_TIME, "repeat": WIGGLES, "right": False, "fn": self.stateWiggle  },
-        MotorState.RIGHTWIGGLE: { "pwm": self.clockwise, "duration":  CLOCK_WIGGLE_TIME, "repeat": WIGGLES, "right": True, "fn": self.stateWiggle },
-        MotorState.LEFT:        { "pwm": self.anticlockwise, "duration":  ANTI_FLIP_TIME, "repeat": FLIPS, "right": False, "fn": self.stateFlip },
-        MotorState.RIGHT:       { "pwm": self.clockwise, "duration":  CLOCK_FLIP_TIME, "repeat": FLIPS, "right": True, "fn": self.stateFlip},
-        MotorState.LEFTEMPTY:   { "pwm": self.anticlockwise, "duration":  EMPTY_TIME, "repeat": 0, "right": False, "fn": self.stateEmpty   },
-        MotorState.RIGHTEMPTY:  { "pwm": self.clockwise, "duration":  EMPTY_TIME, "repeat": 0, "right": True, "fn": self.stateEmpty },
+        MotorState.LEFTWIGGLE:  { "pwm": self.anticlockwise, "duration":  t["antiwiggle"], "repeat": t["wiggles"], "right": False, "fn": self.stateWiggle  },
+        MotorState.RIGHTWIGGLE: { "pwm": self.clockwise, "duration":  t["clockwiggle"], "repeat": t["wiggles"], "right": True, "fn": self.stateWiggle },
+        MotorState.LEFT:        { "pwm": self.anticlockwise, "duration":  t["antiflip"], "repeat": t["flips"], "right": False, "fn": self.stateFlip },
+        MotorState.RIGHT:       { "pwm": self.clockwise, "duration":  t["clockflip"], "repeat": t["flips"], "right": True, "fn": self.stateFlip},
+        MotorState.LEFTEMPTY:   { "pwm": self.anticlockwise, "duration":  t["empty"], "repeat": 0, "right": False, "fn": self.stateEmpty   },
+        MotorState.RIGHTEMPTY:  { "pwm": self.clockwise, "duration":  t["empty"], "repeat": 0, "right": True, "fn": self.stateEmpty },
         MotorState.COMPLETE:    { "pwm": 0, "duration":  0, "repeat": 0, "fn": None }
     }
 
+  def resetStates(self):
+    self.setFlips((self.timing["antiflip"], self.timing["clockflip"]))
+    self.setWiggles((self.timing["antiwiggle"], self.timing["clockwiggle"]))
+
   def initFeed(self, weight):
+    self.prepareFeed(weight)
+
+    self.integrator.submit(self.integrateThread)
+    self.measure.submit(self.measureThread)
+    if not self.baselineFresh():
+      self.clock.sleep(BASELINE_SECS)
+    self.armFeed()
+
+  # Reset the per feed state, the sensor can then be sampled
+  def prepareFeed(self, weight):
     self.running = True
-    self.lastempty = self.lasttime = time.time()
-    self.setupStates()
+    self.empty = False
+    self.lastempty = self.lasttime = self.feedstart = self.clock.time()
+    self.resetStates()
+    self.flow.reset(self.feedstart)
+    self.inflight.reset()
+    self.hopper.reset()
+    self.stopreason = None
+    self.motorstart = self.motorend = None
+    self.settled = False
+    self.settlesum = 0.0
+    self.settlecount = 0
+    self.noisefresh = None
     self.sums = 0
     self.counts = 0
     self.total = 0
     self.ms = 0
     self.right = not self.right
     self.motor = None
+    self.ticks = None
     self.motorstate = MotorState.START
     self.weight = weight
     self.feeding = False
     self.error = False
 
-    excess = self.excess
+    excess = 0.0 if self.segment else self.excess
     # Limit the excess each time to half a meal either way
     # We should eventually catch up
     excess = max(min(excess, weight/2), -weight/2)
     self.target = self.targetFromWeight(weight - excess)
-    if self.verbose > 0:
-      print("Current target {0:.2f} which is {1:.2f}g total excess {2:.2f}".format(self.target, weight - excess, self.excess))
+    self.log(eventlog.INFO, "target", target=self.target, grams=weight - excess, excess=self.excess)
     self.motorevent.clear()
-
-    self.adcthread = threading.Thread(target=self.adcThread)
-    #self.adcthread.daemon = True
-    self.adcthread.start()
-
-    self.measure = threading.Thread(target=self.measureThread)
-    self.measure.start()
-    time.sleep(5)
-    self.meansquared()
-
-    self.motor = threading.Thread(target=self.motorThread)
-    #self.motor.daemon = True
-
-    if self.verbose:
-      print("Init feed done {0}".format(self.name))
+    self.samples.reset()
+    if self.recorder != None:
+      self.recorder.feedStart(self.clock.time(), self.clock.wall(), weight, self.target, self.adcscale)
+      self.record(recorder.CALIBRATION, extra=self.gramsPerUnit())
+      if self.caltable != None:
+        for i, (sums, grams) in enumerate(self.caltable.knots):
+          self.record(recorder.CALKNOT, 0, i, sums)
+          self.record(recorder.CALKNOT, 1, i, grams)
+
+  # Decided once a feed: the warm-up is skipped on it, so the noise going
+  # stale before requestBaseline() mustn't then ask for a measurement of
+  # next to no samples
+  def baselineFresh(self):
+    now = self.clock.wall()
+    self.noisefresh = self.noise.fresh(now)
+    if not self.noisefresh:
+      self.log(eventlog.INFO, "noise stale", age=self.noise.age(now), measuring=BASELINE_SECS)
+    return self.noisefresh
+
+  # Once the noise is known the motor is ready to go. The integrator owns
+  # sums so it takes the measurement, or the cached estimate if fresh.
+  def armFeed(self):
+    self.requestBaseline()
+    self.baselined.wait()
+
+    self.motor = self.motorworker
+
+    self.log(eventlog.INFO, "armed")
+
+  def requestBaseline(self):
+    self.baselined.clear()
+    fresh = self.noisefresh if self.noisefresh != None else self.noise.fresh(self.clock.wall())
+    self.baselinerequest = "cached" if fresh else "measure"
 
   def startFeed(self):
-    self.motor.start()
+    self.motor.submit(self.motorThread)
 
   def join(self):
     self.measure.join()
     self.motor.join()
-    self.adcthread.join()
+    self.integrator.join()
+    self.writer.join()
 
   def stop(self):
+    self.record(recorder.STOP, recorder.STOP_REQUESTED, extra=self.sums)
+    self.stopreason = recorder.STOP_REQUESTED
     self.motorevent.set()
-    self.lasttime = time.time()     # ???
-    if self.verbose > 0:
-      print("stop(): self.motorevent.set()")
+    self.lasttime = self.clock.time()     # ???
+    self.log(eventlog.INFO, "stop", reason="requested", sums=self.sums, t=self.clock.time())
 
   def meansquared(self):
     self.ms = self.sums / self.counts
+    self.noise.reset(self.ms, self.counts, self.clock.wall())
     self.sums = 0
     self.counts = 0
     # Ensure calms cannot be 0 before divide
     if not self.calms:
       self.calms = self.ms
     if self.verbose:
-      print("Mean squared {0:.2e} cal {1:.2e} ratio {2:.2e}".format(self.ms, self.calms, self.ms / self.calms))
+      self.log(eventlog.INFO, "baseline", ms=self.ms, calms=self.calms, ratio=self.ms / self.calms)
     return self.ms
 
-  def measureThread(self):
+  def cachedBaseline(self):
+    self.ms = self.noise.ms
+    self.sums = 0
+    self.counts = 0
+    if not self.calms:
+      self.calms = self.ms
     if self.verbose:
-      print("measureThread {0} {1}".format(self.resetpin, self.adcchannel))
+      self.log(eventlog.INFO, "baseline cached", ms=self.ms, age=self.noise.age(self.clock.wall()), calms=self.calms, ratio=self.ms / self.calms)
+    return self.ms
+
+  def measureThread(self):
+    self.log(eventlog.INFO, "measure start", reset=self.resetpin, adc=self.adcchannel)
+    # Every phase runs on an absolute deadline so the sample rate, and so
+    # sums, doesn't depend on how loaded the Pi is
+    self.ticks = self.scheduler
+    self.ticks.start()
+    trace = tracer.active()
     while self.running:
       if self.running:
-        GPIO.output(self.resetpin, False)
-        time.sleep(0.0005)
-      GPIO.output(self.resetpin, True)
-      time.sleep(0.0095 - 0.0005)
+        self.hw.output(self.resetpin, False)
+        self.ticks.until(RESET_TIME)
+      self.hw.output(self.resetpin, True)
+      self.ticks.until(RESET_TIME + INTEGRATE_TIME)
+
+      self.hw.output(DEBUG_PIN, True)
+      with tracer.span("adc", self.name):
+        self.adc.read(self.adcblock)
+      t = self.clock.time()
+      raw = sum(self.adcblock.counts)
+      self.samples.push(t, raw)
+      if self.recorder != None:
+        self.recorder.sample(t, raw)
+      self.hw.output(DEBUG_PIN, False)
+      self.ticks.until(TICK_TIME)
+      # A missed tick skips its reset, the sensor keeps integrating
+      missed = self.ticks.next()
+      if missed:
+        if trace != None:
+          trace.instant("missed", self.name)
+        self.record(recorder.MISSED, value=missed)
+
+    # Keep high to reduce current, power
+    self.hw.output(self.resetpin, True)
 
-      self.adcevent.set()
-      time.sleep(0.0005)
+    self.log(eventlog.INFO, "measure end", running=self.running)
+    #print("sumb {0} suma {1} sums {2} total {3} counts {4}".format(self.sumb, self.suma, self.sums, self.total, self.counts))
 
-      # Don't check the event if the motor isn't running
-      if self.motor != None and not self.motorevent.is_set() and self.sums >= self.target:
-        self.motorevent.set()
-        self.lasttime = time.time()     # ???
-        if self.verbose > 0:
-          print("measureThread() 1: self.motorevent.set()")
-      
-      if self.running:
-        # Cope with timeout
-        self.running = not (self.motorevent.is_set() and (time.time() - self.lasttime) > FED_TIMEOUT_SECS)
-        if not self.running:
-          #print("sumb {0} suma {1} sums {2} total {3} counts {4}".format(self.sumb, self.suma, self.sums, self.total, self.counts))
-          self.motorevent.set()
-          self.adcevent.set()
-          if self.verbose > 0:
-            print("measureThread() 2: self.motorevent.set()")
+  def integrateThread(self):
+    self.log(eventlog.INFO, "integrate start", reset=self.resetpin, adc=self.adcchannel)
+    while self.running:
+      self.clock.sleep(BATCH_TIME)
+      self.integrate()
+    # Anything left over, and don't leave armFeed() waiting
+    self.integrate()
+    self.finishFeed()
+    self.log(eventlog.INFO, "integrate end")
+
+  # Consume every sample waiting in the ring
+  def integrate(self):
+    with tracer.span("integrate", self.name):
+      ring = self.samples
+      start, end = ring.available()
+      for n in range(start, end):
+        i = n & ring.mask
+        self.sample(ring.times[i], ring.values[i] * self.adcscale)
+      ring.commit(end)
+      self.noise.stamp(self.clock.wall())
+      if self.motor != None and not self.motorevent.is_set():
+        self.inflight.update(self.clock.time(), self.weightFromTarget(self.sums))
+      if self.baselinerequest:
+        if self.baselinerequest == "cached":
+          self.cachedBaseline()
+        else:
+          self.meansquared()
+        self.record(recorder.BASELINE, extra=self.ms)
+        self.baselinerequest = None
+        self.baselined.set()
+      self.checkStop()
+
+  def checkStop(self):
+    # Don't check the event if the motor isn't running
+    if self.motor != None and not self.motorevent.is_set() and self.sums >= self.target:
+      self.stopMotor(recorder.STOP_TARGET)
+    # Or early, with what is still falling expected to make up the rest. The
+    # grams still falling are added to those seen before converting, a fitted
+    # curve's offset is for the whole feed, not for part of it.
+    elif self.motor != None and not self.motorevent.is_set() and self.targetFromWeight(self.weightFromTarget(self.sums) + self.inflight.predict()) >= self.target:
+      self.stopMotor(recorder.STOP_PREDICTED)
     
-    # Keep high to reduce current, power
-    GPIO.output(self.resetpin, True)
+    if self.running:
+      # Cope with timeout
+      timeout = self.motorevent.is_set() and (self.clock.time() - self.lasttime) > FED_TIMEOUT_SECS
+      self.running = not (timeout or (self.motorevent.is_set() and self.settled))
+      if not self.running:
+        self.record(recorder.STOP, recorder.STOP_TIMEOUT if timeout else recorder.STOP_SETTLED, extra=self.sums)
+        #print("sumb {0} suma {1} sums {2} total {3} counts {4}".format(self.sumb, self.suma, self.sums, self.total, self.counts))
+        self.motorevent.set()
+        self.log(eventlog.INFO, "end", reason="timeout" if timeout else "settled", sums=self.sums, t=self.clock.time())
 
+  def stopMotor(self, reason):
+    self.record(recorder.STOP, reason, extra=self.sums)
+    self.stopreason = reason
+    self.inflight.stopped(self.weightFromTarget(self.sums))
+    self.motorevent.set()
+    self.lasttime = self.clock.time()     # ???
+    self.log(eventlog.INFO, "stop", reason=recorder.STOP_NAMES[reason], sums=self.sums, t=self.clock.time())
+
+  def finishFeed(self):
+    self.record(recorder.FEED_END, extra=self.sums)
     self.dispensed = self.weightFromTarget(self.sums)
-    self.excess = self.dispensed - (self.weight - self.excess)
-    self.avg = self.dispensed if self.avg == 0 else (self.avg * 0.8) + (self.dispensed * 0.2)
+    if self.stopreason in (recorder.STOP_TARGET, recorder.STOP_PREDICTED):
+      self.inflight.learn(self.dispensed)
+      if self.motorend != None:
+        self.hopper.learn(self.dispensed, self.motorend - self.motorstart)
+    if self.hopper.state in (hopper.JAMMED, hopper.EMPTY):
+      self.error = True
+    if not self.segment:
+      self.excess = self.dispensed - (self.weight - self.excess)
+      self.avg = self.dispensed if self.avg == 0 else (self.avg * 0.8) + (self.dispensed * 0.2)
     #print("right {0} dispensed {1} excess {2} avg {3}".format(self.right, self.dispensed, self.excess, self.avg))
-    self.save()
-
-    if self.verbose:
-      print("measureThread ends {0}".format(self.running))
-      #print("sumb {0} suma {1} sums {2} total {3} counts {4}".format(self.sumb, self.suma, self.sums, self.total, self.counts))
-
-  def adcThread(self):
-    if self.verbose:
-      print("adcThread reset {0} adc {1}".format(self.resetpin, self.adcchannel))
-    while self.running:
-      self.adcevent.wait()
-      self.adcevent.clear()
-      GPIO.output(DEBUG_PIN, True)
-
-      a = self.adc.value
-      a2 = a * a
-      #if a2 > self.ms:
-      #  # Square Analogue
-      #  self.sums += a2 - self.ms
-      #  self.counts += 1
-      # Count all datapoints minus mean squared noise
-      self.sums += a2 - self.ms
-      self.counts += 1
-      if a > 0.5:
-        self.lastempty = self.lasttime = time.time()
-        self.states[MotorState.LEFT]["duration"] = ANTI_FLIP_TIME
-        self.states[MotorState.RIGHT]["duration"] = CLOCK_FLIP_TIME
-      self.total += 1
-      GPIO.output(DEBUG_PIN, False)
-    if self.verbose:
-      print("adcThread ends")
+    self.saveLater()
+    duration = self.clock.time() - self.feedstart
+    if not self.segment:
+      self.writer.submit(self.journal.append, {
+        "time": self.clock.wall(),
+        "weight": self.weight,
+        "dispensed": self.dispensed,
+        "excess": self.excess,
+        "duration": duration,
+        "empty": self.empty
+      })
+    self.updateMetrics(duration)
+    if self.verbose and self.ticks != None:
+      self.log(eventlog.INFO, "sampling", ticks=self.ticks.format(), dropped=self.samples.dropped)
+
+  def updateMetrics(self, duration):
+    stop = recorder.STOP_NAMES.get(self.stopreason, "none")
+    self.registry.counter("catfeeder_feeds_total", "Feeds by why the motor stopped", feeder=self.name, stop=stop).inc()
+    self.msamples.inc(self.total)
+    self.mdropped.inc(self.samples.dropped)
+    if self.ticks != None:
+      self.mmissed.inc(self.ticks.missed)
+      self.mlateness.merge(self.ticks.lateness)
+    if duration > 0:
+      self.msamplerate.set(self.total / duration)
+    self.mduration.add(duration)
+    self.mdispensed.inc(max(self.dispensed, 0.0))
+    if self.motorend != None and self.motorend > self.motorstart:
+      self.mrate.set(self.dispensed / (self.motorend - self.motorstart))
+
+  def sample(self, t, a):
+    a2 = a * a
+    #if a2 > self.ms:
+    #  # Square Analogue
+    #  self.sums += a2 - self.ms
+    #  self.counts += 1
+    # Count all datapoints minus mean squared noise
+    self.sums += a2 - self.ms
+    self.counts += 1
+    # Until the motor starts it's all noise
+    if self.motor == None and a <= NOISE_MAX_READING:
+      self.noise.add(a2)
+    if a > 0.5:
+      self.lastempty = self.lasttime = t
+      self.setFlips(self.flow.food(t))
+      self.settlesum = 0.0
+      self.settlecount = 0
+    elif self.motorevent.is_set() and t - self.lasttime >= SETTLE_MIN_SECS:
+      self.checkSettled(a2)
+    self.total += 1
+
+  # Is a window of readings after the motor stopped just noise
+  def checkSettled(self, a2):
+    if self.noise.samples < NOISE_MIN_SAMPLES or self.noise.var <= 0:
+      return
+    self.settlesum += a2 - self.ms
+    self.settlecount += 1
+    if self.settlecount >= SETTLE_WINDOW:
+      z = self.settlesum / math.sqrt(self.settlecount * self.noise.var)
+      self.settled = z < SETTLE_Z
+      self.settlesum = 0.0
+      self.settlecount = 0
 
   def motorThread(self):
-    if self.verbose:
-      print("motorThread {0}".format(self.pwmpin))
+    for duration in self.motorSteps():
+      self.motorevent.wait(duration)
+
+  # The motor state machine, yields how long to wait before the next step,
+  # stepping early once motorevent is set
+  def motorSteps(self):
+    self.log(eventlog.INFO, "motor start", pwm=self.pwmpin)
 
     self.feeding = True
-    self.save()
+    self.saveLater()
+    self.motorstart = changed = self.clock.time()
+    trace = tracer.active()
+    traced = None
     while not self.motorevent.is_set():
       state = self.states[self.motorstate]
-      state["fn"](state)
-      state = self.states[self.motorstate]
-      if self.verbose > 1:
-        print("{0} {1} {2} {3}".format(self.motorstate, state["pwm"], state["duration"], self.motorstatecounter))
-      self.pwm.ChangeDutyCycle(state["pwm"])
-      self.motorevent.wait(state["duration"])
+      now = self.clock.time()
+      self.dwell(self.motorstate, now - changed)
+      if self.motorstate in (MotorState.LEFT, MotorState.RIGHT):
+        self.checkHopper(state, now - changed)
+      elif state["pwm"] != 0:
+        self.hopper.skip(self.weightFromTarget(self.sums))
+      changed = now
+      with tracer.span("motor step", self.name):
+        state["fn"](state)
+        state = self.states[self.motorstate]
+        if self.verbose > 1:
+          self.log(eventlog.DEBUG, "motor", state=self.motorstate.name, pwm=state["pwm"], duration=state["duration"],
+                   counter=self.motorstatecounter, sums=self.sums, t=self.clock.time())
+        self.pwm.ChangeDutyCycle(state["pwm"])
+        self.record(recorder.MOTOR, self.motorstate.value, extra=state["pwm"])
+      if trace != None:
+        # Each state the motor is in is a span on the feeder's own track
+        if traced != self.motorstate:
+          if traced != None:
+            trace.asyncEnd(traced.name, self.name)
+          traced = self.motorstate
+          trace.asyncBegin(traced.name, self.name)
+      yield state["duration"]
+
+    if traced != None:
+      trace.asyncEnd(traced.name, self.name)
 
     self.feeding = False
     # Whatever state we end in set pwm to 0
     self.pwm.ChangeDutyCycle(0)
+    self.motorend = self.clock.time()
+    self.dwell(self.motorstate, self.motorend - changed)
+    self.record(recorder.MOTOR, MotorState.COMPLETE.value, extra=0)
 
   def stateStart(self, state):
     self.motorstate = MotorState.RIGHTWIGGLE if self.right else  MotorState.LEFTWIGGLE
@@ -265,14 +565,26 @@ class Feeder:
   def stateEmpty(self, state):
     # Guard just in case event has been set asynchronously
     if not self.motorevent.set():
-      self.lasttime = time.time()     # ???
+      self.record(recorder.STOP, recorder.STOP_EMPTY, extra=self.sums)
+      self.stopreason = recorder.STOP_EMPTY
+      self.lasttime = self.clock.time()     # ???
       self.motorevent.set()
       self.empty = True
       self.error = True
-      if self.verbose > 0:
-        print("stateEmpty(): self.motorevent.set()")
+      self.log(eventlog.INFO, "stop", reason="empty", sums=self.sums, t=self.clock.time())
     self.motorstate = MotorState.COMPLETE
 
+  # How the step just run went, see hopper.py
+  def checkHopper(self, state, secs):
+    was = self.hopper.state
+    full = self.motorstate in (MotorState.LEFT, MotorState.RIGHT) and state["duration"] >= min(self.timing["antiflipmax"], self.timing["clockflipmax"])
+    now = self.hopper.step(secs, self.weightFromTarget(self.sums), full)
+    if now != was:
+      self.record(recorder.HOPPER, recorder.HOPPER_STATES.index(now), extra=self.hopper.confidence)
+      self.log(eventlog.INFO, "hopper", state=now, confidence=self.hopper.confidence, sums=self.sums, t=self.clock.time())
+      # For feederleds.py, as it happens
+      self.saveLater()
+
   def checkCounter(self):
     if self.motorstatecounter > 1:
       self.motorstatecounter -= 1
@@ -281,67 +593,112 @@ class Feeder:
       return True
 
   def checkEmpty(self, state):
-    dt = time.time() - self.lastempty
-    if dt > EMPTY_TEST_SECS:
+    now = self.clock.time()
+    dt = now - self.lastempty
+    if dt > EMPTY_TEST_SECS or self.hopper.state == hopper.EMPTY:
       self.motorstate = MotorState.LEFTEMPTY if self.motorstate == MotorState.RIGHT else MotorState.RIGHTEMPTY
       self.motorstatecounter = self.states[self.motorstate]["repeat"]
-      self.lastempty = time.time()
+      self.lastempty = self.clock.time()
       return True
-    elif dt > HIGH_POWER_SECS:
-      #self.states[MotorState.LEFT]["duration"] = ANTI_FLIP_MAX
-      #self.states[MotorState.RIGHT]["duration"] = CLOCK_FLIP_MAX
-      if int(dt / JIGGLE_INTERVAL) % 2 == 0:
-        self.states[MotorState.LEFT]["duration"] = ANTI_FLIP_MAX
-        self.states[MotorState.RIGHT]["duration"] = CLOCK_FLIP_TIME
-      else:
-        self.states[MotorState.LEFT]["duration"] = ANTI_FLIP_TIME
-        self.states[MotorState.RIGHT]["duration"] = CLOCK_FLIP_MAX
-    elif dt > LOW_POWER_SECS and dt <= HIGH_POWER_SECS:
-      # Pull left for a bit, then right
-      if int(dt / JIGGLE_INTERVAL) % 2 == 0:
-        self.states[MotorState.LEFT]["duration"] = ((ANTI_FLIP_MAX - ANTI_FLIP_TIME) * (dt - LOW_POWER_SECS)/(HIGH_POWER_SECS - LOW_POWER_SECS)) + ANTI_FLIP_TIME
-        self.states[MotorState.RIGHT]["duration"] = CLOCK_FLIP_TIME
-      else:
-        self.states[MotorState.LEFT]["duration"] = ANTI_FLIP_TIME
-        self.states[MotorState.RIGHT]["duration"] = ((CLOCK_FLIP_MAX - CLOCK_FLIP_TIME) * (dt - LOW_POWER_SECS)/(HIGH_POWER_SECS - LOW_POWER_SECS)) + CLOCK_FLIP_TIME
+    self.setFlips(self.flow.durations(now, dt, self.weightFromTarget(self.sums)))
+    self.setWiggles(self.flow.wiggles())
+    # Pull as hard as possible to break a bridge
+    if self.hopper.state == hopper.JAMMED:
+      self.setFlips((self.timing["antiflipmax"], self.timing["clockflipmax"]))
     return False
+
+  # (left, right) flip durations from the flow strategy, None for no change
+  def setFlips(self, durations):
+    if durations != None:
+      self.states[MotorState.LEFT]["duration"], self.states[MotorState.RIGHT]["duration"] = durations
+
+  def setWiggles(self, durations):
+    if durations != None:
+      self.states[MotorState.LEFTWIGGLE]["duration"], self.states[MotorState.RIGHTWIGGLE]["duration"] = durations
+
+  def setFlow(self, name, rate=flowcontrol.FLOW_TARGET_RATE):
+    t = self.timing
+    self.flow = flowcontrol.create(name, (t["antiflip"], t["antiflipmax"]), (t["clockflip"], t["clockflipmax"]), rate,
+                                   (t["antiwiggle"], t["clockwiggle"]))
+    self.flowrate = rate
     
   def targetFromWeight(self, weight):
+    if self.caltable != None:
+      return self.caltable.target(weight)
     return (weight * self.scaletarget) / self.scaleweight
 
   def weightFromTarget(self, target):
+    if self.caltable != None:
+      return self.caltable.weight(target)
     return (target * self.scaleweight) / self.scaletarget
 
+  # Grams per unit of sums over this feed's target, the ratio unless there
+  # is a curve
+  def gramsPerUnit(self):
+    if self.caltable == None or self.target <= 0:
+      return self.scaleweight / self.scaletarget
+    return (self.weightFromTarget(self.target) - self.weightFromTarget(0.0)) / self.target
+
   def load(self):
-    n = self.name + ".conf"
-    if not os.path.exists(n):
+    settings = self.state.load()
+    if settings == None:
       return
-    s = ""
-    with open(n) as f:
-      s = f.read()
-    settings = json.loads(s)
     self.right = settings["right"]
     self.excess = settings["excess"]
     self.avg = settings["avg"]
     self.scaleweight = settings["scaleweight"]
     self.scaletarget = settings["scaletarget"]
+    knots = settings.get("caltable")
+    self.caltable = None if knots == None else caltable.CalTable(knots)
     self.calms = settings["calms"]
     self.feeding = settings["feeding"]
     self.error = settings["error"]
+    self.nextfeed = settings.get("nextfeed")
+    self.setFlow(settings.get("flow", "timetable"), settings.get("flowrate", flowcontrol.FLOW_TARGET_RATE))
+    self.noise.load(settings)
+    self.inflight.load(settings)
+    self.hopper.load(settings)
 
-  def save(self):
+  def settings(self):
     settings = { 
       "right": self.right, 
       "excess": self.excess, 
       "avg": self.avg, 
       "scaleweight": self.scaleweight,
       "scaletarget": self.scaletarget,
+      "caltable": None if self.caltable == None else self.caltable.knots,
       "calms": self.calms,
       "feeding": self.feeding,
-      "error": self.error
+      "error": self.error,
+      "nextfeed": self.nextfeed,
+      "flow": self.flow.name,
+      "flowrate": self.flowrate
     }
-    with open(self.name + ".conf", "w") as f:
-      f.write(json.dumps(settings))
+    self.noise.save(settings)
+    self.inflight.save(settings)
+    self.hopper.save(settings)
+    return settings
+
+  # The settings as they are now, on disk when save() returns
+  def save(self):
+    self.saveLater()
+    self.writer.join()
+
+  # Written by the writer while the caller carries on, as the settings are
+  # when it gets to them, so saves from several threads can't land out of
+  # order
+  def saveLater(self):
+    self.writer.submit(self.writeSettings)
+
+  def writeSettings(self):
+    with tracer.span("save", self.name), metrics.timed(self.msave) as timing:
+      if not self.state.save(self.settings()):
+        timing.discard()
+
+  # Write out anything save() held back, before exiting
+  def flush(self):
+    self.writer.join()
+    self.state.flush(self.settings())
   
   def resetSettings(self):
     self.right = False
@@ -354,15 +711,27 @@ class Feeder:
   def resetCalibration(self):
     self.scaleweight = 25.0
     self.scaletarget = 3  # 10 # 30  # 6
+    self.caltable = None
     #self.calms = 0
   
   def calibrate(self, weight, target):
     self.scaleweight = weight
     self.scaletarget = target
+    self.caltable = None
+
+  # A fitted curve, scaleweight and scaletarget keep its top knot
+  def setCalTable(self, table):
+    self.caltable = table
+    self.scaletarget, self.scaleweight = table.knots[-1]
 
   def info(self):
-    print("{0} dispensed {1:.2f} average {2:.2f} excess {3:.2f} scaleweight {4:.2f}  scaletarget {5:.2f} calms {6:.2e} error {7}".
-      format(self.name, self.dispensed, self.avg, self.excess, self.scaleweight, self.scaletarget, self.calms, self.error))
+    print(self.infoText())
+
+  def infoText(self):
+    return ("{0} dispensed {1:.2f} average {2:.2f} excess {3:.2f} scaleweight {4:.2f}  scaletarget {5:.2f} calms {6:.2e} error {7} flow {8}{9}{10}".
+      format(self.name, self.dispensed, self.avg, self.excess, self.scaleweight, self.scaletarget, self.calms, self.error, self.flow.name,
+             "" if self.caltable == None else " caltable " + self.caltable.text(),
+             "" if self.hopper.state == hopper.NORMAL else " hopper {0} ({1:.2f})".format(self.hopper.state, self.hopper.confidence)))
 
 def __init__():
   return
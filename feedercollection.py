@@ -0,0 +1,248 @@
+import eventlog
+import hardware
+import recorder
+import spiadc
+import tracer
+import workers
+from feeder import BASELINE_SECS, BATCH_TIME, DEBUG_PIN, RESET_TIME, INTEGRATE_TIME, SAMPLE_TIME, TICK_TIME
+from feedloop import MotorTasks
+from noisefloor import NOISE_MAX_READING
+from scheduler import DeadlineScheduler
+
+# Between feeds each sensor is read this often to keep its noise floor fresh
+IDLE_PERIOD = 1.0
+# The sampler integrates every feeder's samples once per this many ticks, a
+# batch as a feeder's own integrator thread would take them
+BATCH_TICKS = max(1, int(round(BATCH_TIME / TICK_TIME)))
+
+# Several feeders in one process. Rather than an ADC and a measure thread per
+# feeder, one sampler thread drives every sensor's reset pin and reads all of
+# their ADC channels in a single block each tick, so a feed only adds its
+# motor thread and the feeders never compete for the SPI bus. The sampler and
+# the motors are long lived workers, see workers.py. With the "loop" engine
+# the motors run from the sampler's loop as well, see feedloop.py.
+#
+# All eight channels of an MCP3008, or of two on CE0 and CE1, fit in a tick:
+# the conversions are made in the SAMPLE_TIME window, and when every
+# feeder's oversampling would overrun it each channel is read fewer times
+# and its sum scaled back up, so a feeder's sums don't depend on how many
+# others are running.
+ENGINES = ("threads", "loop")
+
+# The running feeders on one ADC device and the block that reads them
+class DeviceBlock:
+  def __init__(self, adc, feeders, repeat):
+    self.adc = adc
+    self.feeders = feeders
+    self.block = adc.plan([f.adcchannel for f in feeders], repeat)
+    # Each feeder's samples are the sum of adcrepeat conversions
+    self.gains = [f.adcrepeat // repeat for f in feeders]
+
+class FeederCollection:
+  def __init__(self, hw=None, verbose=0, fastadc=True, engine="threads"):
+    if engine not in ENGINES:
+      raise ValueError("Unknown feed engine {0}".format(engine))
+    self.hw = hw if hw != None else hardware.backend()
+    self.clock = self.hw.clock
+    self.verbose = verbose
+    self.engine = engine
+    self.feeders = []
+    self.fastadc = fastadc
+    self.adcs = {}
+    self.sampler = workers.Worker(self.clock, "sampler")
+    self.ticks = DeadlineScheduler(self.clock, TICK_TIME)
+    self.motors = MotorTasks(self.clock)
+    self.idling = False
+    self.idlethread = None
+    self.paused = False
+    self.idledone = self.clock.event()
+    self.idledone.set()
+
+  def add(self, feeder):
+    self.feeders.append(feeder)
+    return feeder
+
+  def find(self, name):
+    for f in self.feeders:
+      if f.name == name:
+        return f
+    return None
+
+  # weights maps feeder names to grams, all of them are fed at once
+  def feed(self, weights):
+    active = [f for f in self.feeders if f.name in weights]
+    self.pauseIdle()
+    try:
+      for f in active:
+        f.prepareFeed(weights[f.name])
+
+      if self.engine == "loop":
+        fresh = all([f.baselineFresh() for f in active])
+        self.sampleLoop(active, self.motors, 0 if fresh else BASELINE_SECS)
+      else:
+        self.sampler.submit(self.sampleLoop, active)
+        if not all([f.baselineFresh() for f in active]):
+          self.clock.sleep(BASELINE_SECS)
+
+        for f in active:
+          f.armFeed()
+          f.startFeed()
+        for f in active:
+          f.motor.join()
+        self.sampler.join()
+      # The sampler left the settings and journal to each feeder's writer
+      for f in active:
+        f.writer.join()
+    finally:
+      self.resumeIdle()
+    return active
+
+  # Keep every feeder's noise floor fresh while nothing is being fed
+  def startIdle(self):
+    self.idling = True
+    self.idlethread = self.clock.thread(target=self.idleThread)
+    self.idlethread.daemon = True
+    self.idlethread.start()
+
+  def stopIdle(self):
+    self.idling = False
+    if self.idlethread != None:
+      self.idlethread.join()
+      self.idlethread = None
+
+  # Stop idle sampling while something else drives the sensors, returns once
+  # any idle sample in progress has finished
+  def pauseIdle(self):
+    self.paused = True
+    self.idledone.wait()
+
+  def resumeIdle(self):
+    self.paused = False
+
+  def idleThread(self):
+    blocks = self.plan(self.feeders)
+    while self.idling:
+      self.idledone.clear()
+      if not self.paused:
+        self.idleSample(blocks)
+      self.idledone.set()
+      self.clock.sleep(IDLE_PERIOD)
+
+  def idleSample(self, blocks):
+    for f in self.feeders:
+      self.hw.output(f.resetpin, False)
+    self.clock.sleep(RESET_TIME)
+    for f in self.feeders:
+      self.hw.output(f.resetpin, True)
+    self.clock.sleep(INTEGRATE_TIME)
+    with tracer.span("adc idle"):
+      for d in blocks:
+        d.adc.read(d.block)
+    now = self.clock.wall()
+    for d in blocks:
+      for i, f in enumerate(d.feeders):
+        a = d.block.mean(i)
+        if a <= NOISE_MAX_READING:
+          f.noise.add(a * a)
+          f.noise.stamp(now)
+
+  def adcFor(self, device):
+    if device not in self.adcs:
+      self.adcs[device] = spiadc.openAdc(self.hw, device, self.fastadc, self.verbose)
+    return self.adcs[device]
+
+  # A DeviceBlock for each ADC device the running feeders use, read one
+  # after the other within the sample window
+  def plan(self, running):
+    repeat = max(f.adcrepeat for f in running)
+    repeat = spiadc.fitRepeat(len(running), repeat, SAMPLE_TIME)
+    blocks = []
+    for device in sorted(set(f.adcdevice for f in running)):
+      feeders = [f for f in running if f.adcdevice == device]
+      adc = self.adcFor(device)
+      blocks.append(DeviceBlock(adc, feeders, min(repeat, min(f.adcrepeat for f in feeders))))
+    return blocks
+
+  # Sample and integrate every running feeder until they have all finished.
+  # Given motors, also measure the noise for baseline seconds if needed and
+  # then start and step each feeder's motor.
+  def sampleLoop(self, active, motors=None, baseline=0):
+    if self.verbose:
+      eventlog.get().info("sampler start", feeders=",".join(f.name for f in active))
+    running = list(active)
+    blocks = self.plan(running)
+    ticks = self.ticks
+    ticks.start()
+    for f in active:
+      f.ticks = ticks
+    arm = None if motors == None else ticks.deadline + baseline
+    trace = tracer.active()
+    waiting = []
+    tick = 0
+    while running:
+      if arm != None and ticks.deadline >= arm:
+        for f in running:
+          f.requestBaseline()
+        waiting = list(running)
+        arm = None
+      for f in running:
+        self.hw.output(f.resetpin, False)
+      self.until(ticks, RESET_TIME, motors)
+      for f in running:
+        self.hw.output(f.resetpin, True)
+      self.until(ticks, RESET_TIME + INTEGRATE_TIME, motors)
+
+      self.hw.output(DEBUG_PIN, True)
+      with tracer.span("adc"):
+        for d in blocks:
+          d.adc.read(d.block)
+      t = self.clock.time()
+      for d in blocks:
+        for i, f in enumerate(d.feeders):
+          raw = d.block.total(i) * d.gains[i]
+          f.samples.push(t, raw)
+          if f.recorder != None:
+            f.recorder.sample(t, raw)
+      self.hw.output(DEBUG_PIN, False)
+      self.until(ticks, TICK_TIME, motors)
+
+      # The sampler is also every feeder's integrator
+      tick += 1
+      if tick % BATCH_TICKS != 0:
+        self.next(ticks, running, trace)
+        continue
+      for f in running:
+        f.integrate()
+        if f in waiting and f.baselined.is_set():
+          waiting.remove(f)
+          motors.start(f)
+        if not f.running:
+          self.hw.output(f.resetpin, True)
+          f.finishFeed()
+      stillrunning = [f for f in running if f.running]
+      if len(stillrunning) != len(running):
+        running = stillrunning
+        if running:
+          blocks = self.plan(running)
+      self.next(ticks, running, trace)
+    # Let any motor finish stopping
+    if motors != None:
+      while motors.pending():
+        motors.runUntil(self.clock.time() + TICK_TIME)
+        self.clock.sleep(TICK_TIME)
+    if self.verbose:
+      eventlog.get().info("sampler end")
+
+  def next(self, ticks, running, trace):
+    missed = ticks.next()
+    if missed:
+      if trace != None:
+        trace.instant("missed")
+      for f in running:
+        f.record(recorder.MISSED, value=missed)
+
+  # Wait for the tick phase at offset, running any motor steps due first
+  def until(self, ticks, offset, motors):
+    if motors != None:
+      motors.runUntil(ticks.deadline + offset)
+    ticks.until(offset)
@@ -0,0 +1,374 @@
+import faulthandler
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import control
+import eventlog
+import hardware
+import metrics
+import registry
+import tracer
+from calibration import Calibration
+from catfeeder import feederSpecs
+from feedercollection import FeederCollection
+from feedschedule import FeedScheduler
+
+# Long running feeder daemon. It owns the hardware and keeps every feeder's
+# state in memory, and takes feed/info/reset/calibrate requests from
+# catfeeder.py over a Unix domain socket so a feed doesn't pay for starting
+# Python, importing gpiozero and setting up the pins each time.
+#
+# A calibration holds the hardware from calstart until calset or calcancel.
+# It is cancelled, the motor stopped and the hardware let go, if the
+# connection it was started on closes or no request for it comes for
+# CAL_TIMEOUT_SECS, so a client that dies can't leave the motor running and
+# every feed after it waiting. The timeout is on the real clock, it waits
+# for a person.
+
+faulthandler.enable()
+
+CAL_TIMEOUT_SECS = 600
+CAL_WATCH_SECS = 1.0
+
+# A calibration and the connection running it
+class CalSession:
+  def __init__(self, cal, owner, now):
+    self.cal = cal
+    self.owner = owner
+    self.touched = now
+
+class FeederDaemon:
+  def __init__(self, collection, verbose=0):
+    self.collection = collection
+    self.clock = collection.clock
+    self.verbose = verbose
+    # One feed or calibration at a time has the hardware
+    self.lock = threading.Lock()
+    # Feeder names to CalSessions
+    self.calibrations = {}
+    self.scheduler = None
+    self.metricsfile = None
+
+  # owner is the connection the request came on
+  def handle(self, request, owner=None):
+    op = request.get("op")
+    names = request.get("names", [])
+    feeders = [self.collection.find(name) for name in names]
+    for name, f in zip(names, feeders):
+      if f == None:
+        return { "ok": False, "error": "No feeder called {0}".format(name) }
+    if self.verbose:
+      print("request {0} {1}".format(op, ", ".join(names)))
+
+    if op == "ping":
+      return { "ok": True, "lines": [] }
+    elif op == "info":
+      return { "ok": True, "lines": [f.infoText() for f in feeders] }
+    elif op == "reset":
+      with self.lock:
+        for f in feeders:
+          f.resetSettings()
+          f.save()
+      return { "ok": True, "lines": [] }
+    elif op == "feed":
+      return self.feed(feeders, float(request["weight"]))
+    elif op == "calstart":
+      return self.calStart(feeders, request.get("resetcal", False), owner)
+    elif op == "calstop":
+      return self.calStop(feeders)
+    elif op == "calweigh":
+      return self.calWeigh(feeders, float(request["amount"]))
+    elif op == "calset":
+      return self.calSet(feeders, request.get("amount"))
+    elif op == "calcancel":
+      return self.calCancel(feeders)
+    elif op == "flow":
+      with self.lock:
+        for f in feeders:
+          f.setFlow(request["flow"])
+          f.save()
+      return { "ok": True, "lines": [f.infoText() for f in feeders] }
+    elif op == "schedule":
+      return self.schedule(request.get("reload", False))
+    elif op == "metrics":
+      return { "ok": True, "lines": metrics.REGISTRY.format().splitlines() }
+    return { "ok": False, "error": "Unknown op {0}".format(op) }
+
+  def feed(self, feeders, weight):
+    if len(feeders) == 0:
+      return { "ok": False, "error": "No feeder given" }
+    return { "ok": True, "lines": self.feedWeights({ f.name: weight for f in feeders }) }
+
+  # weights maps feeder names to grams
+  def feedWeights(self, weights):
+    lines = []
+    with self.lock:
+      fed = self.collection.feed(weights)
+    self.writeMetrics()
+    for f in fed:
+      if f.empty:
+        lines.append("Warning: {0}'s feeder is empty".format(f.name))
+      lines.append(f.infoText())
+    return lines
+
+  # For node_exporter's textfile collector
+  def writeMetrics(self):
+    if self.metricsfile != None:
+      metrics.REGISTRY.writeTextfile(self.metricsfile)
+
+  def schedule(self, reload):
+    if self.scheduler == None:
+      return { "ok": False, "error": "No schedule" }
+    if reload:
+      self.scheduler.reload()
+    times = self.scheduler.nextFeeds(self.clock.wall())
+    lines = ["{0} next fed {1}".format(name, time.ctime(t)) for name, t in sorted(times.items())]
+    return { "ok": True, "lines": lines }
+
+  def calStart(self, feeders, resetcalibration, owner=None):
+    if len(feeders) != 1:
+      return { "ok": False, "error": "Calibrate one feeder at a time." }
+    f = feeders[0]
+    if not self.lock.acquire(blocking=False):
+      return { "ok": False, "error": "Feeder busy" }
+    self.collection.pauseIdle()
+    session = CalSession(Calibration(f, self.collection), owner, time.monotonic())
+    self.calibrations[f.name] = session
+    session.cal.start(resetcalibration)
+    watch = threading.Thread(target=self.calWatch, args=(f.name, session), name="calwatch")
+    watch.daemon = True
+    watch.start()
+    return { "ok": True, "lines": [] }
+
+  def calSession(self, feeders):
+    session = self.calibrations.get(feeders[0].name) if len(feeders) == 1 else None
+    if session != None:
+      session.touched = time.monotonic()
+    return session
+
+  # Whoever takes the session out of calibrations ends it, exactly once
+  def calEnd(self, name, session):
+    if self.calibrations.get(name) is not session:
+      return False
+    self.calibrations.pop(name)
+    return True
+
+  def calRelease(self):
+    self.collection.resumeIdle()
+    self.lock.release()
+
+  def calStop(self, feeders):
+    session = self.calSession(feeders)
+    if session == None:
+      return { "ok": False, "error": "Not calibrating" }
+    sums = session.cal.stop()
+    return { "ok": True, "lines": [], "sums": sums }
+
+  # A scale reading after calstop, then the motor runs again
+  def calWeigh(self, feeders, amount):
+    session = self.calSession(feeders)
+    if session == None:
+      return { "ok": False, "error": "Not calibrating" }
+    table = session.cal.add(amount)
+    lines = [] if table == None else ["Calibration so far {0}".format(table.text())]
+    if not session.cal.resume():
+      lines.append("Feeder is empty")
+    return { "ok": True, "lines": lines }
+
+  # Finish, with the last scale reading if it wasn't given to calweigh
+  def calSet(self, feeders, amount):
+    session = self.calSession(feeders)
+    if session == None or not self.calEnd(feeders[0].name, session):
+      return { "ok": False, "error": "Not calibrating" }
+    try:
+      session.cal.stop()
+      if amount != None:
+        session.cal.add(float(amount))
+      session.cal.finish()
+    finally:
+      self.calRelease()
+    self.writeMetrics()
+    return { "ok": True, "lines": [feeders[0].infoText()] }
+
+  def calCancel(self, feeders):
+    session = self.calSession(feeders)
+    if session == None or not self.calCancelSession(feeders[0].name, session, "cancelled"):
+      return { "ok": False, "error": "Not calibrating" }
+    return { "ok": True, "lines": [feeders[0].infoText()] }
+
+  def calCancelSession(self, name, session, why):
+    if not self.calEnd(name, session):
+      return False
+    print("Calibration of {0} {1}".format(name, why))
+    try:
+      session.cal.cancel()
+    finally:
+      self.calRelease()
+    return True
+
+  # The connection owner has closed
+  def dropped(self, owner):
+    for name, session in list(self.calibrations.items()):
+      if session.owner is owner:
+        self.calCancelSession(name, session, "cancelled, its client went away")
+
+  def calWatch(self, name, session):
+    while self.calibrations.get(name) is session:
+      if time.monotonic() - session.touched > CAL_TIMEOUT_SECS:
+        with self.clock.attached():
+          self.calCancelSession(name, session, "timed out")
+        return
+      time.sleep(CAL_WATCH_SECS)
+
+class ControlHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    daemon = self.server.daemon
+    try:
+      for line in self.rfile:
+        try:
+          request = json.loads(line)
+          with daemon.clock.attached():
+            response = daemon.handle(request, self)
+        except Exception as e:
+          response = { "ok": False, "error": "{0}".format(e) }
+        self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+    except OSError:
+      pass
+    finally:
+      with daemon.clock.attached():
+        daemon.dropped(self)
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+def serve(daemon, path=control.SOCKET_PATH):
+  if os.path.exists(path):
+    os.unlink(path)
+  server = ControlServer(path, ControlHandler)
+  server.daemon = daemon
+  try:
+    with daemon.clock.blocking():
+      server.serve_forever()
+  finally:
+    server.server_close()
+    os.unlink(path)
+
+def main(argv):
+  argv.pop(0)
+  verbose = 0
+  backend = "pi"
+  fastadc = True
+  engine = "threads"
+  record = False
+  trace = None
+  logpath = None
+  logsample = {}
+  path = control.SOCKET_PATH
+  schedule = None
+  metricsfile = None
+  metricsport = None
+  sides = []
+  registrypath = None
+  while len(argv) > 0:
+    argc = len(argv)
+    if argc >= 1 and argv[0] == "-v":
+      verbose += 1
+    elif argc >= 1 and argv[0] == "--sim":
+      backend = "sim"
+    elif argc >= 1 and argv[0] == "--slowadc":
+      fastadc = False
+    elif argc >= 2 and argv[0] == "--engine":
+      engine = argv[1]
+      argv.pop(0)
+    elif argc >= 1 and argv[0] == "--record":
+      record = True
+    elif argc >= 2 and argv[0] == "--log":
+      logpath = argv[1]
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--log-sample":
+      level, n = eventlog.parseSample(argv[1])
+      logsample[level] = n
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--trace":
+      trace = argv[1]
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--socket":
+      path = argv[1]
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--schedule":
+      schedule = argv[1]
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--metrics-file":
+      metricsfile = argv[1]
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--metrics-port":
+      metricsport = int(argv[1])
+      argv.pop(0)
+    elif argc >= 2 and (argv[0] == "--left" or argv[0] == "--right" or argv[0] == "--cat"):
+      sides.append((argv[0], argv[1]))
+      argv.pop(0)
+    elif argc >= 2 and argv[0] == "--feeders":
+      registrypath = argv[1]
+      argv.pop(0)
+    else:
+      sides = []
+      registrypath = None
+      break
+    argv.pop(0)
+  if len(sides) == 0 and registrypath == None:
+    print("Usage: python3 feederd.py [--sim] [--slowadc] [--engine threads|loop] [--record] [--trace <file>] [--log <file>] [--log-sample <level>=<n>] [-v] [--socket <path>] [--schedule <file>] [--metrics-file <path>] [--metrics-port <port>] --left <name> [--right <name>]")
+    print("       python3 feederd.py [options] --feeders <file> [--cat <name> ...]")
+    return
+  # Every feeder in the registry unless some are picked
+  try:
+    if len(sides) == 0:
+      specs = registry.loadRegistry(registrypath)
+    else:
+      specs = feederSpecs(sides, registrypath)
+  except (OSError, ValueError) as e:
+    print("Feeders: {0}".format(e))
+    return
+
+  if trace != None:
+    tracer.use(tracer.Tracer())
+  if logpath != None or logsample:
+    eventlog.use(eventlog.EventLog(logpath, sample=logsample))
+  hw = hardware.use(hardware.create(backend))
+  if backend == "sim":
+    for s in specs:
+      hw.addHopper(s.pwm, s.adc, s.device)
+  hw.setup(True)
+  collection = FeederCollection(hw, verbose, fastadc, engine)
+  for s in specs:
+    collection.add(s.create(verbose, hw, fastadc))
+  if record:
+    for f in collection.feeders:
+      f.startRecording()
+  # On the virtual clock idle sampling would spin through time forever
+  if backend != "sim":
+    collection.startIdle()
+  daemon = FeederDaemon(collection, verbose)
+  daemon.metricsfile = metricsfile
+  daemon.writeMetrics()
+  if metricsport != None:
+    metrics.serve(metrics.REGISTRY, metricsport)
+  if schedule != None:
+    daemon.scheduler = FeedScheduler(daemon, schedule, verbose)
+    daemon.scheduler.start()
+  print("Cat Feeder daemon on {0}".format(path))
+  try:
+    serve(daemon, path)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    for f in collection.feeders:
+      f.flush()
+    if trace != None:
+      tracer.active().dump(trace)
+    hw.cleanup()
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -5,9 +5,9 @@ import os.path
 import sys
 import threading
 import time
-import subprocess
-import re
-import RPi.GPIO as GPIO
+import cron
+import hardware
+import leds
 
 LEFT_BLUE = 13
 RIGHT_BLUE = 5
@@ -18,12 +18,16 @@ PATH = '/home/pi/catfeeder/git/'
 
 leftName = ""
 rightName = ""
+schedule = None
+scheduleChanged = None
 leftFeeder = { "error": False, "feeding": False }
 rightFeeder = { "error": False, "feeding": False }
 leftblue = None
 rightblue = None
 leftred = None
 rightred = None
+hw = None
+engine = None
 
 # 'Normal' flash the LED according to how long before the next feed
 MIN_ON_CYCLE = 0.01
@@ -36,42 +40,53 @@ MAX_HOURS = 12
 # Feeding and Error flash
 ERROR_FREQUENCY = 1
 ERROR_ON_CYCLE = 50
+# The hopper jammed while feeding, see hopper.py, the red flashes faster
+JAMMED_FREQUENCY = 4
+# The last feed found the hopper running low, the red breathes
+LOW_BREATHE_SECS = 4
 
 def main(argv):
-    global leftName, rightName
-    if len(argv) != 3:
-      print("Usage: python3 feederleds.py <left name> <right name>")
-      return
+    global leftName, rightName, hw, schedule, scheduleChanged
+    global leftFeeder, rightFeeder
     # Program name
     argv.pop(0)
+    sim = len(argv) > 0 and argv[0] == "--sim"
+    if sim:
+      argv.pop(0)
+    if len(argv) != 2:
+      print("Usage: python3 feederleds.py [--sim] <left name> <right name>")
+      return
     leftName = argv.pop(0) + ".conf"
     rightName = argv.pop(0) + ".conf"
+    leftFeeder = load(PATH, leftName) or leftFeeder
+    rightFeeder = load(PATH, rightName) or rightFeeder
 
-    global leftblue, rightblue, leftred, rightred
-    #GPIO.setmode(GPIO.BOARD)
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
-
-    GPIO.setup(LEFT_BLUE, GPIO.OUT)
-    leftblue = GPIO.PWM(LEFT_BLUE, MIN_FLASH_FREQUENCY)
-    leftblue.start(MIN_ON_CYCLE)
+    # Simulated pins but real time, the LEDs follow the wall clock
+    hw = hardware.use(hardware.SimBackend(hardware.RealClock()) if sim else hardware.create("pi"))
 
-    GPIO.setup(RIGHT_BLUE, GPIO.OUT)
-    rightblue = GPIO.PWM(RIGHT_BLUE, MIN_FLASH_FREQUENCY)
-    rightblue.start(MIN_ON_CYCLE)
+    global leftblue, rightblue, leftred, rightred, engine
+    hw.setup(False)
 
-    GPIO.setup(LEFT_RED, GPIO.OUT)
-    leftred = GPIO.PWM(LEFT_RED, MIN_FLASH_FREQUENCY)
-    leftred.start(0)
-
-    GPIO.setup(RIGHT_RED, GPIO.OUT)
-    rightred = GPIO.PWM(RIGHT_RED, MIN_FLASH_FREQUENCY)
-    rightred.start(0)
+    # One thread animates all four LEDs
+    engine = leds.LedEngine(hw)
+    leftblue = engine.add(LEFT_BLUE)
+    rightblue = engine.add(RIGHT_BLUE)
+    leftred = engine.add(LEFT_RED)
+    rightred = engine.add(RIGHT_RED)
+    engine.set(leftblue, leds.flash(MIN_FLASH_FREQUENCY, MIN_ON_CYCLE))
+    engine.set(rightblue, leds.flash(MIN_FLASH_FREQUENCY, MIN_ON_CYCLE))
+    engine.start()
 
     errorthread = threading.Thread(target=errorLEDs)
     errorthread.daemon = True
     errorthread.start()
 
+    schedule = cron.FeedSchedule()
+    scheduleChanged = hw.clock.event()
+    crontabthread = threading.Thread(target=watchCrontab)
+    crontabthread.daemon = True
+    crontabthread.start()
+
     normalLEDs()
 
 def errorLEDs():
@@ -79,19 +94,24 @@ def errorLEDs():
     global leftFeeder, rightFeeder
     global leftblue, rightblue, leftred, rightred
 
+    # The .conf files are replaced by renaming a new file over them, so
+    # watch the directory for the rename rather than the files themselves
     i = inotify.adapters.Inotify()
-    i.add_watch(PATH + leftName, mask=inotify.constants.IN_MODIFY)
-    i.add_watch(PATH + rightName, mask=inotify.constants.IN_MODIFY)
+    i.add_watch(PATH, mask=inotify.constants.IN_MOVED_TO | inotify.constants.IN_CLOSE_WRITE)
 
     for event in i.event_gen(yield_nones=False):
       (_, type_names, path, filename) = event
-      print("event '" + path + "'")
-      if path == PATH + leftName:
+      print("event '" + filename + "'")
+      if filename == leftName:
         leftFeeder = load(PATH, leftName)
         updateStatusLEDs(leftFeeder, leftred, leftblue)    
-      elif path == PATH + rightName:
+      elif filename == rightName:
         rightFeeder = load(PATH, rightName)
         updateStatusLEDs(rightFeeder, rightred, rightblue)    
+      else:
+        continue
+      # The daemon's next feed time may have moved
+      scheduleChanged.set()
      
 def load(path, name):
     n = path + name
@@ -103,60 +123,80 @@ def load(path, name):
     return json.loads(s)
 
 def updateStatusLEDs(settings, red, blue):
+    state = settings.get("hopper", "normal")
     if settings["feeding"]:
-      print("feeding")
+      print("feeding, hopper " + state)
       on = red if settings["error"] else blue
-      flash = blue if settings["error"] else red
-      on.ChangeFrequency(MIN_FLASH_FREQUENCY)
-      on.ChangeDutyCycle(FULL_ON)
-      flash.ChangeFrequency(ERROR_FREQUENCY)
-      flash.ChangeDutyCycle(ERROR_ON_CYCLE)
+      flashing = blue if settings["error"] else red
+      engine.set(on, leds.on())
+      engine.set(flashing, leds.flash(JAMMED_FREQUENCY if state == "jammed" else ERROR_FREQUENCY, ERROR_ON_CYCLE))
     elif settings["error"]:
-      print("error")
-      blue.ChangeDutyCycle(0)
-      red.ChangeFrequency(ERROR_FREQUENCY)
-      red.ChangeDutyCycle(ERROR_ON_CYCLE)
+      print("error, hopper " + state)
+      engine.set(blue, leds.off())
+      engine.set(red, leds.flash(ERROR_FREQUENCY, ERROR_ON_CYCLE))
+    elif state == "low":
+      print("hopper low")
+      engine.set(blue, leds.off())
+      engine.set(red, leds.breathe(LOW_BREATHE_SECS))
     else:
       # Set both to off: normalLEDs() will override this
-      blue.ChangeDutyCycle(0)
-      red.ChangeDutyCycle(0)
+      engine.set(blue, leds.off())
+      engine.set(red, leds.off())
       print("normal")
 
+def watchCrontab():
+    # Editors and crontab -e replace the file, so watch the directory
+    directory, name = os.path.split(cron.CRONTAB)
+    i = inotify.adapters.Inotify()
+    i.add_watch(directory, mask=inotify.constants.IN_MOVED_TO | inotify.constants.IN_CLOSE_WRITE | inotify.constants.IN_DELETE)
+
+    for event in i.event_gen(yield_nones=False):
+      (_, type_names, path, filename) = event
+      if filename == name:
+        print("crontab changed")
+        schedule.invalidate()
+        scheduleChanged.set()
+
+# Flash frequency and on cycle for a feed hours away
+def flash(hours):
+    if hours == None:
+      return MIN_FLASH_FREQUENCY, MIN_ON_CYCLE
+    if hours < 0.25:
+      f = MIN_FLASH_FREQUENCY
+      c = FULL_ON
+    else:
+      #f = (MAX_FLASH_FREQUENCY * (1 - (hours/MAX_HOURS))) + (MIN_FLASH_FREQUENCY * (hours/MAX_HOURS))
+      f = MAX_FLASH_FREQUENCY / (2 * hours)
+      c = 75 - ((hours/MAX_HOURS) * 75)
+    c = (MAX_ON_CYCLE if c > MAX_ON_CYCLE else c) if c >= MIN_ON_CYCLE else MIN_ON_CYCLE
+    f = (MAX_FLASH_FREQUENCY  if f > MAX_FLASH_FREQUENCY  else f) if f >= MIN_FLASH_FREQUENCY else MIN_FLASH_FREQUENCY
+    return f, c
+
+# From the feeder daemon's schedule if it has one, otherwise the crontab
+def hoursToFeed(name, settings, now):
+    t = settings.get("nextfeed") if settings != None else None
+    if t == None or t <= now:
+      t = schedule.next(name, now)
+    return None if t == None else (t - now) / 3600
+
 def normalLEDs():
     while True:
-      text = subprocess.check_output("cat /etc/crontab | grep catfeeder", shell=True)
-      text = str(text, encoding="utf-8")
-      print("Subprocess returned:" + text)
-      now = time.gmtime()
-      now = now.tm_hour + (now.tm_min/60)
-      minhours = None
-      lines = text.splitlines()
-      for line in lines:
-        fields = re.split("\s", line)
-        hours = int(fields[1]) + int(fields[0])/60
-        hours -= now
-        hours = hours if hours > 0.0 else hours + 24
-        print("fields {0} {1} {2} {3}".format(fields[0], fields[1], hours, minhours))
-        if minhours == None or minhours > hours:
-            minhours = hours
-
-      if minhours < 0.25:
-        f = MIN_FLASH_FREQUENCY
-        c = FULL_ON
-      else:
-        #f = (MAX_FLASH_FREQUENCY * (1 - (minhours/MAX_HOURS))) + (MIN_FLASH_FREQUENCY * (minhours/MAX_HOURS))
-        f = MAX_FLASH_FREQUENCY / (2 * minhours)
-        c = 75 - ((minhours/MAX_HOURS) * 75)
-      c = (MAX_ON_CYCLE if c > MAX_ON_CYCLE else c) if c >= MIN_ON_CYCLE else MIN_ON_CYCLE
-      f = (MAX_FLASH_FREQUENCY  if f > MAX_FLASH_FREQUENCY  else f) if f >= MIN_FLASH_FREQUENCY else MIN_FLASH_FREQUENCY
-      #print("f {0} c {1}".format(f,c))
+      now = time.time()
+      try:
+        left = hoursToFeed(leftName[:-len(".conf")], leftFeeder, now)
+        right = hoursToFeed(rightName[:-len(".conf")], rightFeeder, now)
+      except (OSError, ValueError) as e:
+        print("crontab: {0}".format(e))
+        left = right = None
+      print("next feed left {0} right {1}".format(left, right))
       if not leftFeeder["feeding"] and not leftFeeder["error"]:
-        leftblue.ChangeFrequency(f)
-        leftblue.ChangeDutyCycle(c)
+        f, c = flash(left)
+        engine.set(leftblue, leds.flash(f, c))
       if not rightFeeder["feeding"] and not rightFeeder["error"]:
-        rightblue.ChangeFrequency(f)
-        rightblue.ChangeDutyCycle(c)
-      time.sleep(60)
+        f, c = flash(right)
+        engine.set(rightblue, leds.flash(f, c))
+      scheduleChanged.wait(60)
+      scheduleChanged.clear()
       
 if __name__ == "__main__":
     main(sys.argv)
\ No newline at end of file
@@ -0,0 +1,40 @@
+# Motor state machines run as generators from the sampler's loop instead of
+# a thread each. Feeder.motorSteps() yields how long to wait before its next
+# step; MotorTasks steps each one when that time comes, or as soon as its
+# motorevent is set, while the sampler waits for its next tick phase. A feed
+# of any number of feeders then runs in the one thread that called feed().
+
+class MotorTasks:
+  def __init__(self, clock):
+    self.clock = clock
+    self.tasks = []
+
+  def start(self, feeder):
+    steps = feeder.motorSteps()
+    # Feeder.checkStop() and sample() look for a motor
+    feeder.motor = steps
+    self.tasks.append([self.clock.time(), feeder, steps])
+
+  def pending(self):
+    return len(self.tasks) > 0
+
+  def due(self, limit):
+    best = None
+    for task in self.tasks:
+      wake = self.clock.time() if task[1].motorevent.is_set() else task[0]
+      if wake <= limit and (best == None or wake < best[0]):
+        best = (wake, task)
+    return best
+
+  # Run every step due by limit, in time order
+  def runUntil(self, limit):
+    while True:
+      due = self.due(limit)
+      if due == None:
+        return
+      wake, task = due
+      self.clock.sleepUntil(wake)
+      try:
+        task[0] = self.clock.time() + next(task[2])
+      except StopIteration:
+        self.tasks.remove(task)
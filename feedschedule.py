@@ -0,0 +1,159 @@
+import json
+import time
+import cron
+
+# Meal times kept by the daemon itself instead of cron entries that each
+# start catfeeder.py. The schedule file is JSON:
+#
+#   {
+#     "policy": "serialise",
+#     "meals": [
+#       { "time": "07:00", "names": ["Nala", "Rosie"], "grams": 25 },
+#       { "cron": "30 18 * * mon-fri", "names": ["Nala"], "grams": 10 },
+#       { "time": "19:00", "grams": { "Nala": 20, "Rosie": 15 } }
+#     ]
+#   }
+#
+# Meals due at the same minute are fed together when the policy is
+# "overlap", or one cat after another when it is "serialise", which keeps
+# the motors from running at once. The next meal for each cat is kept in
+# its .conf file as "nextfeed" for feederleds.py.
+
+SCHEDULE_PATH = "schedule.json"
+POLICIES = ("serialise", "overlap")
+
+class Meal:
+  def __init__(self, settings):
+    if "cron" in settings:
+      fields = settings["cron"].split()
+    elif "time" in settings:
+      hour, minute = settings["time"].split(":")
+      fields = [str(int(minute)), str(int(hour)), "*", "*", "*"]
+    else:
+      raise ValueError("Meal needs a time or a cron expression")
+    self.entry = cron.CronEntry(fields)
+    grams = settings.get("grams")
+    if grams == None:
+      raise ValueError("Meal needs grams")
+    if isinstance(grams, dict):
+      self.weights = { name: float(g) for name, g in grams.items() }
+    else:
+      self.weights = { name: float(grams) for name in settings.get("names", []) }
+
+def loadSchedule(path):
+  with open(path) as f:
+    settings = json.loads(f.read())
+  policy = settings.get("policy", "serialise")
+  if policy not in POLICIES:
+    raise ValueError("Unknown feed policy {0}".format(policy))
+  meals = []
+  for i, meal in enumerate(settings.get("meals", [])):
+    meal = Meal(meal)
+    # One meal left without names shouldn't stop every other cat's
+    if len(meal.weights) == 0:
+      print("{0}: meal {1} feeds nobody, skipping it".format(path, i + 1))
+      continue
+    meals.append(meal)
+  return policy, meals
+
+class FeedScheduler:
+  def __init__(self, daemon, path=SCHEDULE_PATH, verbose=0):
+    self.daemon = daemon
+    self.collection = daemon.collection
+    self.clock = daemon.clock
+    self.path = path
+    self.verbose = verbose
+    self.changed = self.clock.event()
+    self.thread = None
+    self.running = False
+    self.load()
+
+  def load(self):
+    policy, meals = loadSchedule(self.path)
+    for meal in meals:
+      for name in meal.weights:
+        if self.collection.find(name) == None:
+          raise ValueError("No feeder called {0}".format(name))
+    self.policy = policy
+    self.meals = meals
+
+  # Read the schedule file again, the old schedule stays if it is bad
+  def reload(self):
+    self.load()
+    self.changed.set()
+
+  # When the next meals are due and what each cat gets then
+  def due(self, now):
+    when = None
+    weights = {}
+    for meal in self.meals:
+      t = meal.entry.next(now)
+      if t == None or (when != None and t > when):
+        continue
+      if when == None or t < when:
+        when = t
+        weights = {}
+      for name, grams in meal.weights.items():
+        weights[name] = weights.get(name, 0.0) + grams
+    return when, weights
+
+  def nextFeeds(self, now):
+    times = {}
+    for meal in self.meals:
+      t = meal.entry.next(now)
+      for name in meal.weights:
+        if t != None and (name not in times or t < times[name]):
+          times[name] = t
+    return times
+
+  # Tell feederleds.py when each cat is next fed. Not under the daemon's
+  # lock, a calibration holds it for minutes; only this thread sets
+  # nextfeed and the feeder's writer orders the saves.
+  def publish(self, now):
+    times = self.nextFeeds(now)
+    for f in self.collection.feeders:
+      t = times.get(f.name)
+      if t != f.nextfeed:
+        f.nextfeed = t
+        f.saveLater()
+
+  def start(self):
+    self.running = True
+    self.thread = self.clock.thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.running = False
+    self.changed.set()
+
+  def run(self):
+    last = self.clock.wall()
+    while self.running:
+      self.changed.clear()
+      when, weights = self.due(last)
+      self.publish(last)
+      if when == None:
+        self.changed.wait()
+      else:
+        if self.verbose:
+          print("next meal {0} {1}".format(time.ctime(when), weights))
+        if not self.changed.wait(max(when - self.clock.wall(), 0)):
+          last = when
+          self.feed(weights)
+          continue
+      # A changed schedule's meals from before now have gone by, not due
+      last = max(last, self.clock.wall())
+
+  def feed(self, weights):
+    try:
+      if self.policy == "overlap":
+        lines = self.daemon.feedWeights(weights)
+      else:
+        lines = []
+        for name, grams in weights.items():
+          lines += self.daemon.feedWeights({ name: grams })
+      if self.verbose:
+        print("\n".join(lines))
+    except Exception as e:
+      print("Scheduled feed failed: {0}".format(e))
@@ -0,0 +1,120 @@
+# How long the motor pulls each way on a flip. A feeder's flow strategy is
+# asked for the left and right flip and wiggle durations on every flip, and
+# for the flips when the sensor sees food, and is chosen by "flow" in
+# <name>.conf.
+#
+#   timetable  the original escalation: after LOW_POWER_SECS without food
+#              one side pulls harder, growing to the maximum at
+#              HIGH_POWER_SECS, alternating sides every JIGGLE_INTERVAL
+#   rate       closed loop on the dispense rate measured from the
+#              integrated sensor signal, pulling harder both ways, and
+#              wiggling longer, whenever it falls below "flowrate" g/s and
+#              easing off above it
+
+LOW_POWER_SECS = 30
+HIGH_POWER_SECS = 90
+JIGGLE_INTERVAL = 15
+
+FLOW_TARGET_RATE = 4.0
+# Time constant of the measured rate
+FLOW_WINDOW = 1.0
+# Change in effort per second per unit of relative rate error
+FLOW_GAIN = 1.0
+# A wiggle at full effort, times its normal duration
+FLOW_WIGGLE_SCALE = 2.0
+
+class TimetableFlow:
+  name = "timetable"
+
+  # anti and clock are each (normal, maximum) flip durations, wiggle the
+  # normal (anti, clock) wiggle durations
+  def __init__(self, anti, clock, rate=FLOW_TARGET_RATE, wiggle=None):
+    self.anti = anti
+    self.clock = clock
+
+  def reset(self, now):
+    return
+
+  def food(self, t):
+    return self.anti[0], self.clock[0]
+
+  # sincefood: seconds since the sensor last saw food, grams: so far
+  def durations(self, now, sincefood, grams):
+    dt = sincefood
+    anti, antimax = self.anti
+    clock, clockmax = self.clock
+    if dt > HIGH_POWER_SECS:
+      if int(dt / JIGGLE_INTERVAL) % 2 == 0:
+        return antimax, clock
+      return anti, clockmax
+    elif dt > LOW_POWER_SECS:
+      # Pull left for a bit, then right
+      power = (dt - LOW_POWER_SECS) / (HIGH_POWER_SECS - LOW_POWER_SECS)
+      if int(dt / JIGGLE_INTERVAL) % 2 == 0:
+        return anti + (antimax - anti) * power, clock
+      return anti, clock + (clockmax - clock) * power
+    return None
+
+  # (anti, clock) wiggle durations, None for no change
+  def wiggles(self):
+    return None
+
+class RateFlow:
+  name = "rate"
+
+  def __init__(self, anti, clock, rate=FLOW_TARGET_RATE, wiggle=None):
+    self.anti = anti
+    self.clock = clock
+    self.wiggle = wiggle
+    self.target = rate
+    self.reset(None)
+
+  def reset(self, now):
+    self.lastt = now
+    self.lastgrams = 0.0
+    self.rate = None
+    # 0 pulls for the normal time, 1 for the maximum
+    self.effort = 0.0
+
+  def food(self, t):
+    return None
+
+  def durations(self, now, sincefood, grams):
+    if self.lastt == None:
+      self.lastt = now
+      self.lastgrams = grams
+      return None
+    dt = now - self.lastt
+    if dt <= 0:
+      return None
+    # Noise can make the integral step back a little
+    measured = max(grams - self.lastgrams, 0.0) / dt
+    alpha = min(dt / FLOW_WINDOW, 1.0)
+    self.rate = measured if self.rate == None else self.rate + alpha * (measured - self.rate)
+    self.lastt = now
+    self.lastgrams = grams
+
+    error = (self.target - self.rate) / self.target
+    self.effort = min(max(self.effort + FLOW_GAIN * error * dt, 0.0), 1.0)
+    anti, antimax = self.anti
+    clock, clockmax = self.clock
+    # Flips alternate direction, so a bridge is rocked from both sides.
+    # Pulling one side harder than the other leaves every other flip too
+    # short to clear it.
+    return anti + (antimax - anti) * self.effort, clock + (clockmax - clock) * self.effort
+
+  def wiggles(self):
+    if self.wiggle == None:
+      return None
+    scale = 1.0 + (FLOW_WIGGLE_SCALE - 1.0) * self.effort
+    return self.wiggle[0] * scale, self.wiggle[1] * scale
+
+STRATEGIES = {
+  "timetable": TimetableFlow,
+  "rate": RateFlow,
+}
+
+def create(name, anti, clock, rate=FLOW_TARGET_RATE, wiggle=None):
+  if name not in STRATEGIES:
+    raise ValueError("Unknown flow strategy {0}".format(name))
+  return STRATEGIES[name](anti, clock, rate, wiggle)
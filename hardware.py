@@ -0,0 +1,493 @@
+import heapq
+import itertools
+import math
+import os
+import random
+import subprocess
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Hardware backends. Everything that touches pins, PWM, the ADC or the clock
+# goes through one of these so the feeder can run off a Pi.
+#
+# A backend provides:
+#   setup(warnings)              select BCM numbering
+#   setupOutput(pin, value)      configure an output pin and set it
+#   output(pin, value)
+#   pwm(pin, frequency)          object with start/ChangeDutyCycle/ChangeFrequency/stop
+#   hardwarePwm(pin, frequency)  the same for a hardware PWM channel, or None
+#   adc(channel, device)         object with a .value in 0..1
+#   cleanup()
+#   clock                        time/wall/sleep/sleepUntil/event/thread/blocking/attached
+
+class RealClock:
+  def time(self):
+    return time.monotonic()
+
+  # Seconds since the epoch, for anything kept between runs
+  def wall(self):
+    return time.time()
+
+  def sleep(self, secs):
+    if secs > 0:
+      time.sleep(secs)
+
+  def sleepUntil(self, deadline):
+    self.sleep(deadline - time.monotonic())
+
+  def event(self):
+    return threading.Event()
+
+  def thread(self, target, args=()):
+    return threading.Thread(target=target, args=args)
+
+  @contextmanager
+  def blocking(self):
+    yield
+
+  @contextmanager
+  def attached(self):
+    yield
+
+class VirtualWaiter:
+  def __init__(self):
+    self.woken = False
+
+# Discrete event clock. Time only moves forward when every participating
+# thread is blocked in sleep()/wait()/join(), and then jumps straight to the
+# earliest deadline, so a simulated feed runs as fast as the CPU allows and
+# is deterministic for a given seed. Participating threads are the one that
+# created the clock plus any made with thread().
+class VirtualClock:
+  def __init__(self, start=0.0):
+    self.now = start
+    self.epoch = time.time() - start
+    self.cond = threading.Condition()
+    self.runnable = 1
+    self.external = 0
+    self.timers = []
+    self.seq = itertools.count()
+
+  def time(self):
+    return self.now
+
+  def wall(self):
+    return self.epoch + self.now
+
+  def sleep(self, secs):
+    self.sleepUntil(self.now + max(secs, 0))
+
+  def sleepUntil(self, deadline):
+    with self.cond:
+      self.block(VirtualWaiter(), max(deadline, self.now))
+
+  def event(self):
+    return VirtualEvent(self)
+
+  def thread(self, target, args=()):
+    return VirtualThread(self, target, args)
+
+  # Use around anything that blocks outside the clock (input(), sockets)
+  @contextmanager
+  def blocking(self):
+    with self.cond:
+      self.runnable -= 1
+      self.external += 1
+      self.advance()
+    try:
+      yield
+    finally:
+      with self.cond:
+        self.external -= 1
+        self.runnable += 1
+
+  # Use in threads not made with thread(), e.g. socket server handlers,
+  # while they take part in virtual time
+  @contextmanager
+  def attached(self):
+    with self.cond:
+      self.runnable += 1
+    try:
+      yield
+    finally:
+      with self.cond:
+        self.runnable -= 1
+        self.advance()
+
+  # Caller holds self.cond
+  def block(self, waiter, deadline):
+    if deadline is not None:
+      heapq.heappush(self.timers, (deadline, next(self.seq), waiter))
+    self.runnable -= 1
+    self.advance()
+    while not waiter.woken:
+      self.cond.wait()
+
+  def wake(self, waiter):
+    if not waiter.woken:
+      waiter.woken = True
+      self.runnable += 1
+      self.cond.notify_all()
+
+  def advance(self):
+    while self.runnable == 0:
+      while self.timers and self.timers[0][2].woken:
+        heapq.heappop(self.timers)
+      if not self.timers:
+        if self.external == 0:
+          raise RuntimeError("VirtualClock: every thread is blocked with no timer pending")
+        return
+      deadline, _, waiter = heapq.heappop(self.timers)
+      self.now = max(self.now, deadline)
+      self.wake(waiter)
+
+class VirtualEvent:
+  def __init__(self, clock):
+    self.clock = clock
+    self.flag = False
+    self.waiters = []
+
+  def is_set(self):
+    return self.flag
+
+  def set(self):
+    with self.clock.cond:
+      self.flag = True
+      for waiter in self.waiters:
+        self.clock.wake(waiter)
+      self.waiters = []
+
+  def clear(self):
+    with self.clock.cond:
+      self.flag = False
+
+  def wait(self, timeout=None):
+    with self.clock.cond:
+      if self.flag:
+        return True
+      waiter = VirtualWaiter()
+      self.waiters.append(waiter)
+      self.clock.block(waiter, None if timeout is None else self.clock.now + max(timeout, 0))
+      if waiter in self.waiters:
+        self.waiters.remove(waiter)
+      return self.flag
+
+class VirtualThread:
+  def __init__(self, clock, target, args=()):
+    self.clock = clock
+    self.target = target
+    self.args = args
+    self.done = VirtualEvent(clock)
+    self.thread = threading.Thread(target=self.run)
+    self.daemon = False
+
+  def start(self):
+    with self.clock.cond:
+      self.clock.runnable += 1
+    self.thread.daemon = self.daemon
+    self.thread.start()
+
+  def run(self):
+    try:
+      self.target(*self.args)
+    finally:
+      with self.clock.cond:
+        self.done.flag = True
+        for waiter in self.done.waiters:
+          self.clock.wake(waiter)
+        self.done.waiters = []
+        self.clock.runnable -= 1
+        self.clock.advance()
+
+  def join(self, timeout=None):
+    if self.done.wait(timeout):
+      self.thread.join()
+
+  def is_alive(self):
+    return not self.done.is_set()
+
+class PiBackend:
+  name = "pi"
+
+  def __init__(self):
+    import RPi.GPIO as GPIO
+    self.GPIO = GPIO
+    self.clock = RealClock()
+
+  def setup(self, warnings=True):
+    #self.GPIO.setmode(self.GPIO.BOARD)
+    self.GPIO.setmode(self.GPIO.BCM)
+    self.GPIO.setwarnings(warnings)
+
+  def setupOutput(self, pin, value=False):
+    self.GPIO.setup(pin, self.GPIO.OUT)
+    self.GPIO.output(pin, value)
+
+  def output(self, pin, value):
+    self.GPIO.output(pin, value)
+
+  def pwm(self, pin, frequency):
+    self.GPIO.setup(pin, self.GPIO.OUT)
+    return self.GPIO.PWM(pin, frequency)
+
+  # Only for a pin the overlay has routed its channel to, and to no other
+  # pin, or the LED's 1kHz would reach a servo or a sensor's reset. 12, 18
+  # and 19 are the feeders' pins, which leaves 13, the left blue LED:
+  #   dtoverlay=pwm,pin=13,func=4
+  def hardwarePwm(self, pin, frequency):
+    if pin not in HARDWARE_PWM_PINS or not os.path.exists(SYSFS_PWM) or not pwmRouted(pin):
+      return None
+    channel = HARDWARE_PWM_PINS[pin]
+    if any(pwmRouted(p) for p, c in HARDWARE_PWM_PINS.items() if c == channel and p != pin):
+      print("PWM channel {0} is routed to pin {1} and another, not using it".format(channel, pin))
+      return None
+    try:
+      return SysfsPwm(HARDWARE_PWM_PINS[pin], frequency)
+    except OSError:
+      return None
+
+  def adc(self, channel, device=0):
+    from gpiozero import MCP3008
+    return MCP3008(channel=channel, device=device)
+
+  def cleanup(self):
+    self.GPIO.cleanup()
+
+# GPIO pin to hardware PWM channel
+HARDWARE_PWM_PINS = { 12: 0, 18: 0, 13: 1, 19: 1 }
+SYSFS_PWM = "/sys/class/pwm/pwmchip0"
+
+# Whether the pin is set to its PWM function, asking pinctrl or, on older
+# releases, raspi-gpio. Not if neither can say.
+def pwmRouted(pin):
+  for command in (["pinctrl", "get", str(pin)], ["raspi-gpio", "get", str(pin)]):
+    try:
+      result = subprocess.run(command, capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+      continue
+    if result.returncode == 0:
+      return "PWM" in result.stdout
+  return False
+
+# A hardware PWM channel through sysfs, with RPi.GPIO's PWM interface
+class SysfsPwm:
+  def __init__(self, channel, frequency):
+    self.path = "{0}/pwm{1}".format(SYSFS_PWM, channel)
+    if not os.path.exists(self.path):
+      self.write(SYSFS_PWM + "/export", channel)
+    self.period = 0
+    self.duty = 0
+    self.ChangeFrequency(frequency)
+
+  def write(self, path, value):
+    with open(path, "w") as f:
+      f.write(str(value))
+
+  def start(self, duty):
+    self.ChangeDutyCycle(duty)
+    self.write(self.path + "/enable", 1)
+
+  def ChangeDutyCycle(self, duty):
+    self.duty = duty
+    self.write(self.path + "/duty_cycle", int(self.period * duty / 100))
+
+  def ChangeFrequency(self, frequency):
+    period = int(1e9 / frequency)
+    # The duty cycle can't be longer than the period
+    if period < self.period:
+      self.write(self.path + "/duty_cycle", 0)
+    self.write(self.path + "/period", period)
+    self.period = period
+    self.ChangeDutyCycle(self.duty)
+
+  def stop(self):
+    self.write(self.path + "/enable", 0)
+
+class SimPwm:
+  def __init__(self, backend, pin, frequency):
+    self.backend = backend
+    self.pin = pin
+    self.frequency = frequency
+    self.duty = 0
+    self.changes = 0
+
+  def start(self, duty):
+    self.ChangeDutyCycle(duty)
+
+  def ChangeDutyCycle(self, duty):
+    hopper = self.backend.hoppersByPwm.get(self.pin)
+    if hopper != None:
+      hopper.motor(self.backend.clock.time(), duty)
+    self.duty = duty
+    self.changes += 1
+
+  def ChangeFrequency(self, frequency):
+    self.frequency = frequency
+
+  def stop(self):
+    self.ChangeDutyCycle(0)
+
+class SimAdc:
+  def __init__(self, backend, channel, device=0):
+    self.backend = backend
+    self.channel = channel
+    self.device = device
+
+  @property
+  def value(self):
+    return self.backend.sample(self.channel, self.device)
+
+# A hopper driven by a servo on pwmpin dropping kibble past the sensor on an
+# ADC channel. While the servo is moving kibble is released at rate g/s and
+# reaches the sensor fall seconds later. Each sample sees the kibble that
+# arrived since the previous one plus sensor noise, with gain scaling grams
+# to squared sensor units, so a correctly calibrated feeder has
+# scaletarget / scaleweight == gain.
+#
+# With bridge > 0 the kibble bridges over the outlet that many times a second
+# of motor running, and nothing falls until one pull lasts clearpull seconds.
+class SimHopper:
+  def __init__(self, rng, food=1000.0, rate=8.0, kibble=0.3, fall=0.25, gain=1.25, noise=0.02, bridge=0.0, clearpull=0.5, low=0.0):
+    self.random = rng
+    self.food = food
+    self.rate = rate
+    self.kibble = kibble
+    self.fall = fall
+    self.gain = gain
+    self.noise = noise
+    self.dispensed = 0.0
+    self.moving = False
+    self.lastmotor = 0.0
+    self.nextkibble = None
+    self.falling = deque()
+    self.held = 0.0
+    self.lastsample = None
+    self.bridge = bridge
+    self.clearpull = clearpull
+    # Below low grams the flow falls off in proportion
+    self.low = low
+    self.bridged = False
+    self.bridges = 0
+
+  def motor(self, t, duty):
+    self.release(t)
+    if self.moving:
+      pull = t - self.lastmotor
+      if self.bridged and pull >= self.clearpull:
+        self.bridged = False
+      elif not self.bridged and self.bridge > 0 and self.random.random() < 1 - math.exp(-self.bridge * pull):
+        self.bridged = True
+        self.bridges += 1
+    self.moving = duty != 0
+    self.lastmotor = t
+
+  def release(self, t):
+    if not self.moving or self.bridged:
+      self.nextkibble = None
+      return
+    if self.nextkibble == None:
+      self.nextkibble = self.lastmotor + self.random.expovariate(self.flow() / self.kibble)
+    while self.nextkibble <= t and self.food >= self.kibble:
+      self.food -= self.kibble
+      self.dispensed += self.kibble
+      self.falling.append(self.nextkibble + self.fall * self.random.uniform(0.8, 1.2))
+      self.nextkibble += self.random.expovariate(self.flow() / self.kibble)
+
+  def flow(self):
+    if self.low > 0 and self.food < self.low:
+      return max(self.rate * self.food / self.low, self.rate * 0.01)
+    return self.rate
+
+  # The sensor integrates until it is reset, so conversions made at the
+  # same instant all see the same kibble, with fresh noise
+  def sample(self, t):
+    if t != self.lastsample:
+      self.release(t)
+      self.held = 0.0
+      while self.falling and self.falling[0] <= t:
+        self.falling.popleft()
+        self.held += self.kibble
+      self.lastsample = t
+    a = abs(self.random.gauss(0, self.noise)) + math.sqrt(self.gain * self.held)
+    return min(a, 1.0)
+
+# The pin routed by the overlay PiBackend.hardwarePwm() suggests
+SIM_HARDWARE_PWM_PINS = (13,)
+
+class SimBackend:
+  name = "sim"
+
+  def __init__(self, clock=None, seed=0):
+    self.clock = clock if clock != None else VirtualClock()
+    self.random = random.Random(seed)
+    self.pins = {}
+    self.pwms = {}
+    self.hoppers = {}
+    self.hoppersByPwm = {}
+
+  def setup(self, warnings=True):
+    return
+
+  def setupOutput(self, pin, value=False):
+    self.pins[pin] = bool(value)
+
+  def output(self, pin, value):
+    self.pins[pin] = bool(value)
+
+  def pwm(self, pin, frequency):
+    p = SimPwm(self, pin, frequency)
+    self.pwms[pin] = p
+    return p
+
+  # As if the overlay routed the one hardware PWM pin the feeders leave free
+  def hardwarePwm(self, pin, frequency):
+    if pin not in SIM_HARDWARE_PWM_PINS:
+      return None
+    return self.pwm(pin, frequency)
+
+  def adc(self, channel, device=0):
+    return SimAdc(self, channel, device)
+
+  def cleanup(self):
+    self.pins.clear()
+
+  def addHopper(self, pwmpin, adcchannel, device=0, **kwargs):
+    return self.attach(pwmpin, adcchannel, SimHopper(self.random, **kwargs), device)
+
+  # Anything with motor(t, duty) and sample(t) can stand in for a hopper
+  def attach(self, pwmpin, adcchannel, hopper, device=0):
+    self.hoppers[(device, adcchannel)] = hopper
+    self.hoppersByPwm[pwmpin] = hopper
+    return hopper
+
+  def sample(self, channel, device=0):
+    hopper = self.hoppers.get((device, channel))
+    if hopper == None:
+      return abs(self.random.gauss(0, 0.02))
+    return hopper.sample(self.clock.time())
+
+BACKENDS = {
+  "pi": PiBackend,
+  "sim": SimBackend,
+}
+
+_backend = None
+
+def create(name, **kwargs):
+  if name not in BACKENDS:
+    raise ValueError("Unknown hardware backend {0}".format(name))
+  return BACKENDS[name](**kwargs)
+
+def use(backend):
+  global _backend
+  _backend = backend
+  return backend
+
+# The backend used when none is passed in, the Pi unless use() says otherwise
+def backend():
+  global _backend
+  if _backend == None:
+    _backend = PiBackend()
+  return _backend
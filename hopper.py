@@ -0,0 +1,121 @@
+import math
+
+# What the hopper is doing, from how much food each flip brings. Each flip's
+# grams over what the learnt flow rate would give in that time is
+# compared, by CUSUM, against two changes: flow falling to HOPPER_LOW of
+# normal, a hopper running low, and flow stopping altogether. Each CUSUM is
+# a log likelihood ratio, so the confidence in a change is its logistic and
+# it is called at HOPPER_CONFIDENCE.
+#
+#   low      the flow has dropped but not stopped, the feed goes on
+#   jammed   the flow stopped suddenly, a bridge or a jam; the flips pull
+#            as hard as they can until food comes again
+#   empty    the flow stopped after running low, or stayed stopped through
+#            HOPPER_STALL_FLIPS flips at full pull
+#
+# The wiggles between runs of flips only shake the food loose and bring too
+# little to judge the flow by, they are left out. A feed that ends with the
+# hopper jammed or empty sets error, as the EMPTY_TEST_SECS timeout did,
+# within seconds of the food stopping. The state is written to <name>.conf
+# as it changes, for feederleds.py, and the normal flow rate, learnt from
+# feeds that saw nothing wrong, is kept there too.
+
+NORMAL = "normal"
+LOW = "low"
+JAMMED = "jammed"
+EMPTY = "empty"
+
+# g/s of motor running until a feed has been seen
+HOPPER_RATE = 4.0
+HOPPER_ALPHA = 0.2
+# Spread of one step's flow as a fraction of normal
+HOPPER_SD = 0.5
+HOPPER_LOW = 0.4
+HOPPER_CONFIDENCE = 0.99
+HOPPER_STALL_FLIPS = 6
+# Shorter steps say too little
+HOPPER_MIN_STEP = 0.05
+
+def logistic(x):
+  return 1.0 / (1.0 + math.exp(-min(x, 50.0)))
+
+# Log likelihood ratio of relative flow r under mean changed against 1
+def llr(r, changed):
+  return (changed - 1.0) / (HOPPER_SD * HOPPER_SD) * (r - (1.0 + changed) / 2)
+
+class HopperMonitor:
+  def __init__(self, confidence=HOPPER_CONFIDENCE):
+    self.threshold = math.log(confidence / (1 - confidence))
+    self.rate = HOPPER_RATE
+    self.feeds = 0
+    self.reset()
+
+  def reset(self):
+    self.slow = 0.0
+    self.stall = 0.0
+    self.state = NORMAL
+    self.confidence = 0.0
+    self.wentlow = False
+    self.stalledflips = 0
+    self.lastgrams = 0.0
+    self.trouble = False
+
+  # The motor flipped for secs, at full pull if full, and the feed has seen
+  # grams in total. Returns the state, changed or not.
+  def step(self, secs, grams, full):
+    if secs < HOPPER_MIN_STEP:
+      return self.state
+    r = max(grams - self.lastgrams, 0.0) / (self.rate * secs)
+    self.lastgrams = grams
+    # Held within twice the threshold so the state follows a recovery
+    # within a step or two
+    limit = 2 * self.threshold
+    self.slow = min(max(self.slow + llr(r, HOPPER_LOW), 0.0), limit)
+    self.stall = min(max(self.stall + llr(r, 0.0), 0.0), limit)
+    if self.stall >= self.threshold:
+      if self.wentlow:
+        self.state = EMPTY
+      elif self.state in (JAMMED, EMPTY):
+        # Only flips that brought nothing count against the hopper
+        self.stalledflips += 1 if full and llr(r, 0.0) > 0 else 0
+        if self.stalledflips >= HOPPER_STALL_FLIPS:
+          self.state = EMPTY
+      else:
+        self.state = JAMMED
+      self.confidence = logistic(self.stall)
+    elif self.slow >= self.threshold:
+      self.state = LOW
+      self.wentlow = True
+      self.confidence = logistic(self.slow)
+    else:
+      self.state = NORMAL
+      self.stalledflips = 0
+      # Against the same prior odds that call a change at the threshold
+      self.confidence = 1 - logistic(max(self.slow, self.stall) - self.threshold)
+    if self.state != NORMAL:
+      self.trouble = True
+    return self.state
+
+  # A step left out of the statistics, its food isn't the next flip's
+  def skip(self, grams):
+    self.lastgrams = grams
+
+  # A feed that went smoothly dispensed grams in secs of motor running
+  def learn(self, grams, secs):
+    if self.trouble or secs <= 1.0 or grams <= 0:
+      return
+    rate = grams / secs
+    self.rate = rate if self.feeds == 0 else self.rate + HOPPER_ALPHA * (rate - self.rate)
+    self.feeds += 1
+
+  def load(self, settings):
+    self.rate = settings.get("hopperrate", HOPPER_RATE)
+    self.feeds = settings.get("hopperfeeds", 0)
+    self.state = settings.get("hopper", NORMAL)
+    self.confidence = settings.get("hopperconfidence", 0.0)
+
+  def save(self, settings):
+    settings["hopperrate"] = self.rate
+    settings["hopperfeeds"] = self.feeds
+    settings["hopper"] = self.state
+    settings["hopperconfidence"] = self.confidence
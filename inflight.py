@@ -0,0 +1,69 @@
+# Food still falling when the motor stops. Kibble takes a moment to get from
+# the hopper past the sensor, so stopping the motor when the sensor total
+# reaches the target overshoots by about the flow rate times that delay.
+# The delay, lag seconds, is learnt from each feed that stopped on target:
+# what arrived after the stop divided by the flow rate at the stop. The
+# motor is then stopped once the total plus lag * rate reaches the target.
+# lag starts at 0, stopping on target as before, and is kept in <name>.conf.
+
+INFLIGHT_ALPHA = 0.2
+# Time constant of the flow rate
+INFLIGHT_WINDOW = 0.5
+INFLIGHT_MAX_LAG = 2.0
+# Feeds stopping slower than this say little about the lag, g/s
+INFLIGHT_MIN_RATE = 0.5
+
+class InFlightModel:
+  def __init__(self, alpha=INFLIGHT_ALPHA):
+    self.alpha = alpha
+    self.lag = 0.0
+    self.feeds = 0
+    self.reset()
+
+  def reset(self):
+    self.rate = 0.0
+    self.lastt = None
+    self.lastgrams = 0.0
+    self.stopgrams = None
+    self.stoprate = None
+
+  # grams so far at time now, while the motor runs
+  def update(self, now, grams):
+    if self.lastt != None and now > self.lastt:
+      dt = now - self.lastt
+      measured = max(grams - self.lastgrams, 0.0) / dt
+      self.rate += min(dt / INFLIGHT_WINDOW, 1.0) * (measured - self.rate)
+    self.lastt = now
+    self.lastgrams = grams
+
+  # Grams expected to arrive if the motor stopped now
+  def predict(self):
+    return self.lag * self.rate
+
+  def stopped(self, grams):
+    self.stopgrams = grams
+    self.stoprate = self.rate
+
+  # The feed ended with grams in total
+  def learn(self, grams):
+    if self.stopgrams == None or self.stoprate < INFLIGHT_MIN_RATE:
+      return
+    observed = max(grams - self.stopgrams, 0.0) / self.stoprate
+    if self.feeds == 0:
+      self.lag = observed
+    else:
+      self.lag += self.alpha * (observed - self.lag)
+    self.lag = min(self.lag, INFLIGHT_MAX_LAG)
+    self.feeds += 1
+
+  def clear(self):
+    self.lag = 0.0
+    self.feeds = 0
+
+  def load(self, settings):
+    self.lag = settings.get("inflightlag", 0.0)
+    self.feeds = settings.get("inflightfeeds", 0)
+
+  def save(self, settings):
+    settings["inflightlag"] = self.lag
+    settings["inflightfeeds"] = self.feeds
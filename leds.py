@@ -0,0 +1,150 @@
+import math
+import threading
+
+# LED animation. Each LED plays a pattern, a list of segments each holding or
+# ramping the brightness for a time, and one thread drives every LED,
+# sleeping until the next LED needs to change. That replaces a software PWM
+# thread per LED toggling its pin even when it is flashing at 0.1Hz.
+#
+# On a pin the backend has hardware PWM for, brightness is the PWM duty and
+# ramps are stepped every RAMP_STEP. On a plain GPIO pin the LED is on when
+# the brightness is at least a half, and a ramp shows its end brightness.
+
+RAMP_STEP = 0.05
+HARDWARE_PWM_FREQUENCY = 1000
+# Shortest a flash is lit for, anything shorter wouldn't be seen
+MIN_FLASH_ON = 0.005
+
+class Pattern:
+  # segments: (duration, start brightness, end brightness), brightness 0..1.
+  # A duration of None holds for ever.
+  def __init__(self, segments, repeat=True):
+    self.segments = segments
+    self.repeat = repeat
+    self.period = None if any(d == None for d, _, _ in segments) else sum(d for d, _, _ in segments)
+
+  def __eq__(self, other):
+    return isinstance(other, Pattern) and self.segments == other.segments and self.repeat == other.repeat
+
+  # Segment at elapsed seconds into the pattern, with when it started and ends
+  def at(self, elapsed):
+    if self.period != None and self.period > 0:
+      if self.repeat:
+        cycle = math.floor(elapsed / self.period)
+        base = cycle * self.period
+      elif elapsed >= self.period:
+        d, a, b = self.segments[-1]
+        return (0, b, b), elapsed, None
+      else:
+        base = 0.0
+    else:
+      base = 0.0
+    t = base
+    for segment in self.segments:
+      d = segment[0]
+      if d == None or elapsed < t + d:
+        return segment, t, None if d == None else t + d
+      t += d
+    d, a, b = self.segments[-1]
+    return (0, b, b), t, t
+
+def off():
+  return Pattern([(None, 0.0, 0.0)])
+
+def on(brightness=1.0):
+  return Pattern([(None, brightness, brightness)])
+
+# Same meaning as a software PWM's ChangeFrequency()/ChangeDutyCycle(),
+# duty is a percentage
+def flash(frequency, duty, brightness=1.0):
+  if duty <= 0:
+    return off()
+  period = 1.0 / frequency
+  lit = max(period * min(duty, 100.0) / 100.0, MIN_FLASH_ON)
+  if lit >= period:
+    return on(brightness)
+  return Pattern([(lit, brightness, brightness), (period - lit, 0.0, 0.0)])
+
+def breathe(period, brightness=1.0):
+  return Pattern([(period / 2, 0.0, brightness), (period / 2, brightness, 0.0)])
+
+class Led:
+  def __init__(self, pin, pwm):
+    self.pin = pin
+    self.pwm = pwm
+    self.pattern = off()
+    self.started = 0.0
+    self.edge = None
+    self.value = None
+
+class LedEngine:
+  def __init__(self, hw):
+    self.hw = hw
+    self.clock = hw.clock
+    self.lock = threading.Lock()
+    self.wake = self.clock.event()
+    self.leds = []
+    self.thread = None
+
+  def add(self, pin):
+    pwm = self.hw.hardwarePwm(pin, HARDWARE_PWM_FREQUENCY)
+    if pwm != None:
+      pwm.start(0)
+    else:
+      self.hw.setupOutput(pin, False)
+    led = Led(pin, pwm)
+    self.leds.append(led)
+    return led
+
+  def set(self, led, pattern):
+    with self.lock:
+      if pattern == led.pattern:
+        return
+      led.pattern = pattern
+      led.started = self.clock.time()
+      self.update(led, led.started)
+    self.wake.set()
+
+  def start(self):
+    now = self.clock.time()
+    with self.lock:
+      for led in self.leds:
+        led.started = now
+        self.update(led, now)
+    self.thread = self.clock.thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  # Show the LED's brightness at now and work out when it next changes
+  def update(self, led, now):
+    (d, a, b), start, end = led.pattern.at(now - led.started)
+    ramp = a != b and d != None and d > 0
+    if ramp and led.pwm != None:
+      brightness = a + (b - a) * (now - led.started - start) / d
+      step = led.started + start + RAMP_STEP * (math.floor((now - led.started - start) / RAMP_STEP) + 1)
+      led.edge = step if end == None else min(step, led.started + end)
+    else:
+      brightness = b if ramp else a
+      led.edge = None if end == None else led.started + end
+    if led.pwm != None:
+      value = round(brightness * 100.0, 1)
+      if value != led.value:
+        led.pwm.ChangeDutyCycle(value)
+    else:
+      value = brightness >= 0.5
+      if value != led.value:
+        self.hw.output(led.pin, value)
+    led.value = value
+
+  def run(self):
+    while True:
+      self.wake.clear()
+      with self.lock:
+        now = self.clock.time()
+        edge = None
+        for led in self.leds:
+          if led.edge != None and led.edge <= now:
+            self.update(led, now)
+          if led.edge != None and (edge == None or led.edge < edge):
+            edge = led.edge
+      self.wake.wait(None if edge == None else edge - now)
@@ -0,0 +1,148 @@
+import http.server
+import threading
+import time
+from persist import writeAtomic
+from scheduler import Histogram
+
+# Counters, gauges and histograms for watching a feeder on the device, in
+# Prometheus' text format. Write them to a file for node_exporter's textfile
+# collector with writeTextfile(), or serve them with serve(port). Feeders
+# update them once per feed, not per sample, so the sampling loop pays
+# nothing for them.
+
+DURATION_BOUNDS = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0]
+SAVE_BOUNDS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5]
+
+def labelText(labels):
+  if not labels:
+    return ""
+  return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+class Counter:
+  kind = "counter"
+
+  def __init__(self):
+    self.value = 0.0
+
+  def inc(self, n=1):
+    self.value += n
+
+  def lines(self, name, labels):
+    return ["{0}{1} {2:g}".format(name, labelText(labels), self.value)]
+
+class Gauge(Counter):
+  kind = "gauge"
+
+  def set(self, value):
+    self.value = value
+
+class MetricHistogram(Histogram):
+  kind = "histogram"
+
+  def merge(self, other):
+    if other.bounds != self.bounds:
+      raise ValueError("Histogram bounds differ")
+    for i, c in enumerate(other.counts):
+      self.counts[i] += c
+    self.count += other.count
+    self.sum += other.sum
+    self.max = max(self.max, other.max)
+
+  def lines(self, name, labels):
+    lines = []
+    total = 0
+    for i, bound in enumerate(self.bounds + ["+Inf"]):
+      total += self.counts[i]
+      le = "{0:g}".format(bound) if i < len(self.bounds) else bound
+      lines.append("{0}_bucket{1} {2}".format(name, labelText(labels + (("le", le),)), total))
+    lines.append("{0}_sum{1} {2:g}".format(name, labelText(labels), self.sum))
+    lines.append("{0}_count{1} {2}".format(name, labelText(labels), self.count))
+    return lines
+
+class Registry:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.help = {}
+    self.kinds = {}
+    self.metrics = {}
+
+  def get(self, cls, name, help, labels, *args):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      metric = self.metrics.get(key)
+      if metric == None:
+        if name in self.kinds and self.kinds[name] != cls.kind:
+          raise ValueError("Metric {0} is a {1}".format(name, self.kinds[name]))
+        self.help[name] = help
+        self.kinds[name] = cls.kind
+        metric = self.metrics[key] = cls(*args)
+      return metric
+
+  def counter(self, name, help="", **labels):
+    return self.get(Counter, name, help, labels)
+
+  def gauge(self, name, help="", **labels):
+    return self.get(Gauge, name, help, labels)
+
+  def histogram(self, name, help="", bounds=DURATION_BOUNDS, **labels):
+    return self.get(MetricHistogram, name, help, labels, bounds)
+
+  def format(self):
+    lines = []
+    with self.lock:
+      for name in sorted(self.kinds):
+        lines.append("# HELP {0} {1}".format(name, self.help[name]))
+        lines.append("# TYPE {0} {1}".format(name, self.kinds[name]))
+        for (n, labels), metric in sorted(self.metrics.items(), key=lambda item: item[0]):
+          if n == name:
+            lines += metric.lines(name, labels)
+    return "\n".join(lines) + "\n"
+
+  def writeTextfile(self, path):
+    writeAtomic(path, self.format())
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path not in ("/", "/metrics"):
+      self.send_error(404)
+      return
+    body = self.server.registry.format().encode("utf-8")
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    return
+
+# Serve the registry over HTTP from a background thread, on localhost unless
+# told otherwise
+def serve(registry, port, host="127.0.0.1"):
+  server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+  server.daemon_threads = True
+  server.registry = registry
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+REGISTRY = Registry()
+
+# Seconds taken by the with block, added to a histogram
+class timed:
+  def __init__(self, histogram):
+    self.histogram = histogram
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  # Leave this one out, it didn't do what the histogram is timing
+  def discard(self):
+    self.histogram = None
+
+  def __exit__(self, *exc):
+    if self.histogram != None:
+      self.histogram.add(time.perf_counter() - self.start)
+    return False
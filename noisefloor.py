@@ -0,0 +1,71 @@
+# Running estimate of the sensor's noise floor, the mean squared reading with
+# no food falling. It is updated from every idle sample as an exponentially
+# weighted mean so it follows slow drift (dust on the sensor, temperature)
+# and is kept in <name>.conf, so a feed can start straight away instead of
+# measuring the noise for 5 seconds first. Once nothing has updated it for
+# NOISE_STALE_SECS it is stale and the feed measures it again. The variance
+# of the squared readings is tracked alongside, so a feed can tell when the
+# signal has gone back to noise.
+
+NOISE_ALPHA = 0.01
+NOISE_MIN_SAMPLES = 100
+NOISE_STALE_SECS = 3600
+# Readings above this are food, not noise
+NOISE_MAX_READING = 0.5
+
+class NoiseFloor:
+  def __init__(self, alpha=NOISE_ALPHA, stale=NOISE_STALE_SECS):
+    self.alpha = alpha
+    self.stalesecs = stale
+    self.clear()
+
+  def clear(self):
+    self.ms = 0.0
+    self.var = 0.0
+    self.samples = 0
+    self.updated = None
+    self.pending = 0
+
+  def add(self, a2):
+    if self.samples == 0:
+      self.ms = a2
+      self.var = 0.0
+    else:
+      d = a2 - self.ms
+      self.ms += self.alpha * d
+      self.var = (1 - self.alpha) * (self.var + self.alpha * d * d)
+    self.samples += 1
+    self.pending += 1
+
+  # Record when the samples added since the last stamp were taken
+  def stamp(self, now):
+    if self.pending:
+      self.updated = now
+      self.pending = 0
+
+  # Replace the estimate with a directly measured mean of samples readings
+  def reset(self, ms, samples, now):
+    self.ms = ms
+    self.samples = samples
+    self.updated = now
+    self.pending = 0
+
+  def age(self, now):
+    return None if self.updated == None else now - self.updated
+
+  def fresh(self, now):
+    age = self.age(now)
+    return self.samples >= NOISE_MIN_SAMPLES and age != None and 0 <= age < self.stalesecs
+
+  def load(self, settings):
+    if "ms" in settings:
+      self.ms = settings["ms"]
+      self.samples = settings["mssamples"]
+      self.updated = settings["mstime"]
+      self.var = settings.get("msvar", 0.0)
+
+  def save(self, settings):
+    settings["ms"] = self.ms
+    settings["mssamples"] = self.samples
+    settings["mstime"] = self.updated
+    settings["msvar"] = self.var
@@ -0,0 +1,126 @@
+import json
+import os
+import time
+
+# Crash safe storage for feeder state.
+#
+# <name>.conf holds the current settings. It is replaced atomically, written
+# to a temporary file, synced and renamed over the old one, so a reader
+# (feederleds.py) or a power cut never sees half a file. Writes that change
+# nothing are skipped, and changes to the noise estimate alone, which moves
+# with every idle sample, are only written every STATE_LAZY_SECS.
+#
+# <name>.journal is an append-only log, one JSON line per feed. Once it has
+# JOURNAL_MAX_ENTRIES lines it is compacted to the last JOURNAL_KEEP entries
+# and a summary of the rest.
+
+STATE_LAZY_SECS = 600
+STATE_LAZY_KEYS = ("ms", "mssamples", "mstime", "msvar")
+
+JOURNAL_MAX_ENTRIES = 1000
+JOURNAL_KEEP = 100
+
+def syncDir(path):
+  fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+def writeAtomic(path, text):
+  tmp = path + ".tmp"
+  with open(tmp, "w") as f:
+    f.write(text)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp, path)
+  syncDir(path)
+
+class StateFile:
+  def __init__(self, path, lazy=STATE_LAZY_SECS):
+    self.path = path
+    self.lazysecs = lazy
+    self.written = None
+    self.writtenat = None
+    self.writes = 0
+
+  def load(self):
+    if not os.path.exists(self.path):
+      return None
+    with open(self.path) as f:
+      settings = json.loads(f.read())
+    self.written = dict(settings)
+    self.writtenat = time.monotonic()
+    return settings
+
+  # Write settings unless they match what is on disk, or only the lazy keys
+  # changed and they were written recently. True if the file was written.
+  def save(self, settings, force=False):
+    now = time.monotonic()
+    if not force and self.written != None:
+      if settings == self.written:
+        return False
+      changed = [k for k in settings.keys() | self.written.keys() if settings.get(k) != self.written.get(k)]
+      if all(k in STATE_LAZY_KEYS for k in changed) and now - self.writtenat < self.lazysecs:
+        return False
+    writeAtomic(self.path, json.dumps(settings))
+    self.written = dict(settings)
+    self.writtenat = now
+    self.writes += 1
+    return True
+
+  # Write anything held back by save()
+  def flush(self, settings):
+    if settings == self.written:
+      return False
+    return self.save(settings, force=True)
+
+class FeedJournal:
+  def __init__(self, path, maxentries=JOURNAL_MAX_ENTRIES, keep=JOURNAL_KEEP):
+    self.path = path
+    self.maxentries = maxentries
+    self.keep = keep
+    self.entries = None
+
+  def read(self):
+    if not os.path.exists(self.path):
+      return []
+    entries = []
+    with open(self.path) as f:
+      for line in f:
+        try:
+          entries.append(json.loads(line))
+        except ValueError:
+          # A line cut short by a crash
+          pass
+    return entries
+
+  def append(self, entry):
+    if self.entries == None:
+      self.entries = len(self.read())
+    with open(self.path, "a") as f:
+      f.write(json.dumps(entry) + "\n")
+      f.flush()
+      os.fsync(f.fileno())
+    self.entries += 1
+    if self.entries >= self.maxentries:
+      self.compact()
+
+  # Keep the most recent entries and fold the rest into one summary line
+  def compact(self):
+    entries = self.read()
+    old = entries[:-self.keep] if self.keep > 0 else entries
+    kept = entries[len(old):]
+    summary = { "compacted": 0, "dispensed": 0.0, "empty": 0 }
+    for entry in old:
+      if "compacted" in entry:
+        summary["compacted"] += entry["compacted"]
+        summary["dispensed"] += entry["dispensed"]
+        summary["empty"] += entry["empty"]
+      else:
+        summary["compacted"] += 1
+        summary["dispensed"] += entry.get("dispensed", 0.0)
+        summary["empty"] += 1 if entry.get("empty") else 0
+    lines = [summary] + kept if summary["compacted"] > 0 else kept
+    writeAtomic(self.path, "".join(json.dumps(entry) + "\n" for entry in lines))
+    self.entries = len(lines)
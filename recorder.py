@@ -0,0 +1,136 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Binary trace of everything the sensor and motor did, for looking at
+# dispense dynamics offline. A trace file is
+#
+#   header    magic, version, record size, record count, feed count,
+#             index slots, creation time, feeder name
+#   index     one entry per feed: first record, wall time, weight, target
+#             and the scale from raw counts to a 0..1 reading
+#   records   fixed size (t, kind, arg, value, extra)
+#
+# The file is memory mapped and grown in chunks, so recording a sample is a
+# struct.pack_into() into the map with no system call.
+
+MAGIC = b"CFTRACE1"
+VERSION = 1
+HEADER = struct.Struct("<8sHHIIId32s")
+INDEX = struct.Struct("<Idfff")
+RECORD = struct.Struct("<dBBHf")
+INDEX_SLOTS = 1024
+RECORDS_OFFSET = HEADER.size + INDEX_SLOTS * INDEX.size
+GROW_RECORDS = 65536
+
+# Record kinds
+SAMPLE = 0        # value: raw ADC counts
+MISSED = 1        # value: ticks skipped
+MOTOR = 2         # arg: MotorState, extra: PWM duty
+FEED_START = 3    # extra: target
+BASELINE = 4      # extra: mean squared noise
+STOP = 5          # arg: STOP_* reason, extra: sums
+FEED_END = 6      # extra: sums
+CALIBRATION = 7   # extra: grams per unit of sums over the feed's target
+HOPPER = 8        # arg: HOPPER_STATES index, extra: confidence
+CALKNOT = 9       # a calibration curve's knots, arg: 0 sums 1 grams, value: knot, extra: the number
+
+STOP_TARGET = 0
+STOP_TIMEOUT = 1
+STOP_EMPTY = 2
+STOP_REQUESTED = 3
+STOP_PREDICTED = 4
+STOP_SETTLED = 5
+HOPPER_STATES = ["normal", "low", "jammed", "empty"]
+STOP_NAMES = { STOP_TARGET: "target", STOP_TIMEOUT: "timeout", STOP_EMPTY: "empty",
+               STOP_REQUESTED: "requested", STOP_PREDICTED: "predicted", STOP_SETTLED: "settled" }
+
+class Recorder:
+  def __init__(self, path, name=""):
+    self.path = path
+    self.lock = threading.Lock()
+    exists = os.path.exists(path) and os.path.getsize(path) >= RECORDS_OFFSET
+    self.file = open(path, "r+b" if exists else "w+b")
+    if not exists:
+      self.file.truncate(RECORDS_OFFSET + GROW_RECORDS * RECORD.size)
+    self.map = mmap.mmap(self.file.fileno(), 0)
+    if exists:
+      magic, version, size, self.count, self.feeds, slots, self.created, _ = HEADER.unpack_from(self.map, 0)
+      if magic != MAGIC or version != VERSION or size != RECORD.size or slots != INDEX_SLOTS:
+        self.close()
+        raise ValueError("{0} is not a version {1} feeder trace".format(path, VERSION))
+    else:
+      self.count = 0
+      self.feeds = 0
+      self.created = time.time()
+    self.name = name.encode("utf-8")[:32]
+    self.capacity = (len(self.map) - RECORDS_OFFSET) // RECORD.size
+    self.writeHeader()
+
+  def writeHeader(self):
+    HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, self.count, self.feeds, INDEX_SLOTS, self.created, self.name)
+
+  def record(self, t, kind, arg=0, value=0, extra=0.0):
+    with self.lock:
+      if self.count >= self.capacity:
+        self.grow()
+      RECORD.pack_into(self.map, RECORDS_OFFSET + self.count * RECORD.size, t, kind, arg, value, extra)
+      self.count += 1
+      # Just the count, the rest of the header doesn't change
+      struct.pack_into("<I", self.map, 12, self.count)
+
+  def grow(self):
+    self.capacity += GROW_RECORDS
+    self.map.resize(RECORDS_OFFSET + self.capacity * RECORD.size)
+
+  def feedStart(self, t, wall, weight, target, adcscale):
+    with self.lock:
+      if self.feeds < INDEX_SLOTS:
+        INDEX.pack_into(self.map, HEADER.size + self.feeds * INDEX.size, self.count, wall, weight, target, adcscale)
+      self.feeds += 1
+      self.writeHeader()
+    self.record(t, FEED_START, extra=target)
+
+  def sample(self, t, value):
+    self.record(t, SAMPLE, value=value)
+
+  def close(self):
+    if self.map != None:
+      self.map.flush()
+      self.map.close()
+      self.map = None
+    self.file.close()
+
+class TraceReader:
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, "rb")
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, size, self.count, nfeeds, slots, self.created, name = HEADER.unpack_from(self.map, 0)
+    if magic != MAGIC or version != VERSION or size != RECORD.size:
+      self.close()
+      raise ValueError("{0} is not a version {1} feeder trace".format(path, VERSION))
+    self.name = name.rstrip(b"\0").decode("utf-8")
+    self.feeds = []
+    for i in range(min(nfeeds, slots)):
+      start, wall, weight, target, adcscale = INDEX.unpack_from(self.map, HEADER.size + i * INDEX.size)
+      self.feeds.append({ "start": start, "wall": wall, "weight": weight, "target": target, "adcscale": adcscale })
+    for i, feed in enumerate(self.feeds):
+      feed["end"] = self.feeds[i + 1]["start"] if i + 1 < len(self.feeds) else self.count
+
+  # (t, kind, arg, value, extra) for records start..end-1
+  def records(self, start=0, end=None):
+    end = self.count if end == None else min(end, self.count)
+    return RECORD.iter_unpack(self.map[RECORDS_OFFSET + start * RECORD.size:RECORDS_OFFSET + end * RECORD.size])
+
+  def feedRecords(self, i):
+    feed = self.feeds[i]
+    return self.records(feed["start"], feed["end"])
+
+  def close(self):
+    if self.map != None:
+      self.map.close()
+      self.map = None
+    self.file.close()
@@ -0,0 +1,138 @@
+import json
+from feeder import DEBUG_PIN, Feeder, TIMING
+
+# Which pins, ADC channel and servo duties each feeder uses, loaded once from
+# a JSON file and checked before any pin is touched:
+#
+#   {
+#     "feeders": [
+#       { "name": "Nala", "pwm": 19, "reset": 12, "adc": 0,
+#         "clockwise": 5, "anticlockwise": 9 },
+#       { "name": "Rosie", "pwm": 18, "reset": 24, "adc": 1,
+#         "clockwise": 5, "anticlockwise": 10, "timing": { "antiflipmax": 0.9 } },
+#       { "name": "Tom", "pwm": 20, "reset": 21, "device": 1, "adc": 0,
+#         "clockwise": 5, "anticlockwise": 9 }
+#     ]
+#   }
+#
+# Pins are BCM numbers. "device" is the MCP3008's chip select, 0 unless
+# given, and "adc" its channel. "timing" overrides any of feeder.TIMING for
+# a servo that needs it. Names, pins and (device, channel) pairs must each
+# be used once. --left and --right still give the two feeders the catfeeder
+# was built with, and can be mixed with --cat names from the file.
+
+REGISTRY_PATH = "feeders.json"
+ADC_CHANNELS = 8
+ADC_DEVICES = 2
+# BCM numbers on the 40 pin header, less the SPI bus the ADCs are on
+GPIO_PINS = range(2, 28)
+SPI_PINS = (7, 8, 9, 10, 11)
+# Servo duty cycles, percent
+DUTY_MAX = 20
+
+# BOARD numbers in comments
+SIDES = {
+  # Nala left
+  "left": { "pwm": 19, "reset": 12, "adc": 0, "clockwise": 5, "anticlockwise": 9 },      # 35, 32, 1
+  # Rosie right, our servos behave slightly differently
+  "right": { "pwm": 18, "reset": 24, "adc": 1, "clockwise": 5, "anticlockwise": 10 },    # 12, 18, 2
+}
+
+def integer(settings, key, low, high, default=None):
+  value = settings.get(key, default)
+  if value == None:
+    raise ValueError("needs {0}".format(key))
+  if isinstance(value, bool) or not isinstance(value, int) or value < low or value > high:
+    raise ValueError("{0} must be a whole number from {1} to {2}, not {3}".format(key, low, high, value))
+  return value
+
+class FeederSpec:
+  def __init__(self, settings):
+    if not isinstance(settings, dict):
+      raise ValueError("Feeder settings must be an object")
+    self.name = settings.get("name")
+    if not isinstance(self.name, str) or self.name == "":
+      raise ValueError("Feeder needs a name")
+    try:
+      self.parse(settings)
+    except ValueError as e:
+      raise ValueError("Feeder {0}: {1}".format(self.name, e))
+
+  def parse(self, settings):
+    unknown = set(settings) - set(("name", "pwm", "reset", "device", "adc", "clockwise", "anticlockwise", "timing"))
+    if unknown:
+      raise ValueError("unknown setting {0}".format(", ".join(sorted(unknown))))
+    self.pwm = integer(settings, "pwm", GPIO_PINS[0], GPIO_PINS[-1])
+    self.reset = integer(settings, "reset", GPIO_PINS[0], GPIO_PINS[-1])
+    for pin in (self.pwm, self.reset):
+      if pin == DEBUG_PIN:
+        raise ValueError("pin {0} is the debug pin".format(pin))
+      if pin in SPI_PINS:
+        raise ValueError("pin {0} is on the ADC's SPI bus".format(pin))
+    if self.pwm == self.reset:
+      raise ValueError("pwm and reset are both pin {0}".format(self.pwm))
+    self.device = integer(settings, "device", 0, ADC_DEVICES - 1, 0)
+    self.adc = integer(settings, "adc", 0, ADC_CHANNELS - 1)
+    self.clockwise = integer(settings, "clockwise", 1, DUTY_MAX)
+    self.anticlockwise = integer(settings, "anticlockwise", 1, DUTY_MAX)
+    timing = settings.get("timing", {})
+    if not isinstance(timing, dict):
+      raise ValueError("timing must be an object")
+    self.timing = {}
+    for key, value in timing.items():
+      if key not in TIMING:
+        raise ValueError("unknown timing {0}".format(key))
+      if isinstance(TIMING[key], int):
+        value = integer(timing, key, 1, 100)
+      elif isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError("timing {0} must be a positive number of seconds".format(key))
+      self.timing[key] = value
+    t = dict(TIMING, **self.timing)
+    if t["antiflip"] > t["antiflipmax"] or t["clockflip"] > t["clockflipmax"]:
+      raise ValueError("flip times must not exceed their maximum")
+
+  def pins(self):
+    return (self.pwm, self.reset)
+
+  def create(self, verbose=0, hw=None, fastadc=True):
+    return Feeder(self.name, self.pwm, self.reset, self.adc, self.clockwise, self.anticlockwise, verbose, hw, fastadc,
+                  self.device, self.timing)
+
+# The feeder on a side of the original two feeder catfeeder, for cat name
+def side(which, name):
+  return FeederSpec(dict(SIDES[which], name=name))
+
+# Specs must not share a name, a pin or an ADC channel
+def validate(specs):
+  names = set()
+  pins = {}
+  channels = {}
+  for spec in specs:
+    if spec.name in names:
+      raise ValueError("Two feeders called {0}".format(spec.name))
+    names.add(spec.name)
+    for pin in spec.pins():
+      if pin in pins:
+        raise ValueError("Feeders {0} and {1} both use pin {2}".format(pins[pin], spec.name, pin))
+      pins[pin] = spec.name
+    channel = (spec.device, spec.adc)
+    if channel in channels:
+      raise ValueError("Feeders {0} and {1} both use ADC {2} channel {3}".format(channels[channel], spec.name, spec.device, spec.adc))
+    channels[channel] = spec.name
+  return specs
+
+def loadRegistry(path=REGISTRY_PATH):
+  with open(path) as f:
+    settings = json.loads(f.read())
+  if not isinstance(settings, dict) or not isinstance(settings.get("feeders"), list):
+    raise ValueError("{0}: needs a list of feeders".format(path))
+  specs = validate([FeederSpec(feeder) for feeder in settings["feeders"]])
+  if len(specs) == 0:
+    raise ValueError("{0}: no feeders".format(path))
+  return specs
+
+def find(specs, name):
+  for spec in specs:
+    if spec.name == name:
+      return spec
+  return None
@@ -0,0 +1,191 @@
+import os
+import sys
+import tempfile
+import time
+from bisect import bisect_right
+import hardware
+import recorder
+from caltable import CalTable
+from feeder import Feeder, MotorState
+from noisefloor import NOISE_MIN_SAMPLES
+
+# Replays recorded feeds through the real Feeder, its integrator, stop rules
+# and motor state machine, on a virtual clock, so a change to any of them
+# can be judged against a library of real feeds in seconds, e.g.
+#   python3 replay.py Nala.trace Rosie.trace
+#
+# The recorded samples are played back from the moment the replayed motor
+# starts. Once the replayed motor stops, food recorded more than
+# REPLAY_FALL_TIME later, while the recorded motor was still running, would
+# never have fallen, so noise is played instead. A replay that keeps the
+# motor going beyond the recorded run has no samples for what it would have
+# dispensed and is marked truncated.
+
+REPLAY_FALL_TIME = 0.3
+
+PWM_PIN = 19
+RESET_PIN = 12
+ADC_CHAN = 0
+
+# Stands in for the hopper on the simulated backend
+class ReplaySource:
+  def __init__(self, reader, i, fall=REPLAY_FALL_TIME):
+    feed = reader.feeds[i]
+    self.fall = fall
+    self.weight = feed["weight"]
+    self.target = feed["target"]
+    self.gramsperunit = None
+    knots = {}
+    self.times = []
+    self.values = []
+    self.ms = None
+    self.first = None
+    self.motorstart = None
+    self.motorstop = None
+    self.feedstart = None
+    self.feedend = None
+    self.sums = None
+    self.stopreason = None
+    for t, kind, arg, value, extra in reader.feedRecords(i):
+      if kind == recorder.SAMPLE:
+        self.times.append(t)
+        self.values.append(value * feed["adcscale"])
+      elif kind == recorder.MOTOR:
+        if extra != 0 and self.motorstart == None:
+          self.motorstart = t
+          self.first = MotorState(arg)
+        elif extra == 0 and self.motorstart != None:
+          self.motorstop = t
+      elif kind == recorder.BASELINE:
+        self.ms = extra
+      elif kind == recorder.CALIBRATION:
+        self.gramsperunit = extra
+      elif kind == recorder.CALKNOT:
+        knots.setdefault(value, [0.0, 0.0])[arg] = extra
+      elif kind == recorder.FEED_START:
+        self.feedstart = t
+      elif kind == recorder.STOP and self.stopreason == None:
+        self.stopreason = arg
+      elif kind == recorder.FEED_END:
+        self.feedend = t
+        self.sums = extra
+    if self.motorstart == None or len(self.times) == 0:
+      raise ValueError("Feed {0} in {1} has no samples with the motor running".format(i, reader.path))
+    if self.motorstop == None:
+      self.motorstop = self.times[-1]
+    if self.gramsperunit == None:
+      # Old traces, assume there was no excess carried over
+      self.gramsperunit = self.weight / self.target
+    self.caltable = CalTable([knots[k] for k in sorted(knots)]) if knots else None
+    n = bisect_right(self.times, self.motorstart)
+    self.noise = self.values[:n] if n > 0 else [0.0]
+    if self.ms == None:
+      self.ms = sum(a * a for a in self.noise) / len(self.noise)
+    self.noisei = 0
+    self.started = None
+    self.stopped = None
+    self.truncated = False
+
+  def motor(self, t, duty):
+    if duty != 0 and self.started == None:
+      self.started = t
+    elif duty == 0 and self.started != None and self.stopped == None:
+      self.stopped = t
+
+  def noiseSample(self):
+    self.noisei = (self.noisei + 1) % len(self.noise)
+    return self.noise[self.noisei]
+
+  def sample(self, t):
+    if self.started == None:
+      return self.noiseSample()
+    # The same moment in the recorded feed
+    r = self.motorstart + (t - self.started)
+    if self.stopped != None and t > self.stopped + self.fall and r < self.motorstop + self.fall:
+      return self.noiseSample()
+    if self.stopped == None and r > self.motorstop + self.fall:
+      self.truncated = True
+    i = bisect_right(self.times, r) - 1
+    if i < 0 or i >= len(self.times) - 1:
+      return self.noiseSample()
+    return self.values[i]
+
+def replayFeed(reader, i, verbose=0, fall=REPLAY_FALL_TIME):
+  source = ReplaySource(reader, i, fall)
+  hw = hardware.SimBackend(seed=i)
+  hw.attach(PWM_PIN, ADC_CHAN, source)
+  f = Feeder(reader.name or "replay", PWM_PIN, RESET_PIN, ADC_CHAN, 5, 9, verbose, hw)
+  # Same calibration and first direction as the recording, no excess so the
+  # target is the recorded one, and start from the recorded noise floor
+  f.calibrate(source.gramsperunit, 1.0)
+  if source.caltable != None:
+    f.setCalTable(source.caltable)
+  f.excess = 0.0
+  f.right = source.first != MotorState.RIGHTWIGGLE
+  f.noise.reset(source.ms, NOISE_MIN_SAMPLES, hw.clock.wall())
+  intended = f.weightFromTarget(source.target)
+
+  t = hw.clock.time()
+  f.initFeed(intended)
+  f.startFeed()
+  f.join()
+  return {
+    "intended": intended,
+    "recorded": f.weightFromTarget(source.sums) if source.sums != None else None,
+    "recordedduration": source.feedend - source.feedstart if source.feedend != None else None,
+    "dispensed": f.dispensed,
+    "duration": hw.clock.time() - t,
+    "empty": f.empty,
+    "truncated": source.truncated,
+  }
+
+def main(argv):
+  argv.pop(0)
+  verbose = 0
+  paths = []
+  fall = REPLAY_FALL_TIME
+  while len(argv) > 0:
+    if argv[0] == "-v":
+      verbose += 1
+    elif len(argv) >= 2 and argv[0] == "--fall":
+      fall = float(argv[1])
+      argv.pop(0)
+    else:
+      paths.append(os.path.abspath(argv[0]))
+    argv.pop(0)
+  if len(paths) == 0:
+    print("Usage: python3 replay.py [-v] [--fall <secs>] <trace> ...")
+    return
+
+  results = []
+  start = time.perf_counter()
+  with tempfile.TemporaryDirectory() as d:
+    os.chdir(d)
+    for path in paths:
+      reader = recorder.TraceReader(path)
+      for i in range(len(reader.feeds)):
+        try:
+          r = replayFeed(reader, i, max(verbose - 1, 0), fall)
+        except ValueError as e:
+          print("skip {0}".format(e))
+          continue
+        results.append(r)
+        print("{0} feed {1} intended {2:.2f}g recorded {3} replay {4:.2f}g {5:.1f}s{6}{7}".format(
+          os.path.basename(path), i, r["intended"],
+          "-" if r["recorded"] == None else "{0:.2f}g {1:.1f}s".format(r["recorded"], r["recordedduration"]),
+          r["dispensed"], r["duration"], " truncated" if r["truncated"] else "", " empty" if r["empty"] else ""))
+      reader.close()
+  real = time.perf_counter() - start
+  if len(results) == 0:
+    return
+  n = len(results)
+  recorded = [r for r in results if r["recorded"] != None]
+  print("feeds {0} truncated {1} real {2:.2f}s".format(n, sum(1 for r in results if r["truncated"]), real))
+  print("replay   error abs mean {0:.2f}g duration mean {1:.1f}s".format(
+    sum(abs(r["dispensed"] - r["intended"]) for r in results) / n, sum(r["duration"] for r in results) / n))
+  if recorded:
+    print("recorded error abs mean {0:.2f}g duration mean {1:.1f}s".format(
+      sum(abs(r["recorded"] - r["intended"]) for r in recorded) / len(recorded), sum(r["recordedduration"] for r in recorded) / len(recorded)))
+
+if __name__ == "__main__":
+  main(sys.argv)
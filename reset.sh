@@ -1,3 +1 @@
-python3 /home/pi/catfeeder/git/catfeeder.py --left Nala --reset
-python3 /home/pi/catfeeder/git/catfeeder.py --right Rosie --reset
-wait
\ No newline at end of file
+python3 /home/pi/catfeeder/git/catfeeder.py --left Nala --right Rosie --reset
@@ -0,0 +1,45 @@
+from array import array
+
+# Single producer, single consumer ring of timestamped raw ADC samples. The
+# sampler pushes one per tick and the integrator takes everything pending in
+# one go, so neither waits on the other. head is only written by the
+# producer and tail only by the consumer, and a slot is filled before head
+# moves past it, so no lock is needed. A full ring drops the new sample and
+# counts it rather than blocking the sampler.
+class SampleRing:
+  def __init__(self, size=1024):
+    if size <= 0 or size & (size - 1):
+      raise ValueError("SampleRing size must be a power of two")
+    self.size = size
+    self.mask = size - 1
+    self.times = array("d", [0.0]) * size
+    self.values = array("L", [0]) * size
+    self.reset()
+
+  # Only while neither side is running
+  def reset(self):
+    self.head = 0
+    self.tail = 0
+    self.dropped = 0
+
+  def push(self, t, value):
+    head = self.head
+    if head - self.tail >= self.size:
+      self.dropped += 1
+      return False
+    i = head & self.mask
+    self.times[i] = t
+    self.values[i] = value
+    self.head = head + 1
+    return True
+
+  def pending(self):
+    return self.head - self.tail
+
+  # Consumer: samples tail..head-1 are readable at index n & mask until
+  # commit(head) hands them back
+  def available(self):
+    return self.tail, self.head
+
+  def commit(self, tail):
+    self.tail = tail
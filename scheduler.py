@@ -0,0 +1,83 @@
+# Fixed rate loops on absolute deadlines. Chained sleeps drift by the
+# oversleep of every call, so under load the 10ms sensor loop ran slower and
+# took fewer samples; here every tick, and every phase within a tick, is
+# scheduled from the loop's start time so lateness never accumulates.
+
+# Lateness bucket upper bounds in seconds, the last bucket catches the rest
+LATENESS_BOUNDS = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05]
+
+class Histogram:
+  def __init__(self, bounds=LATENESS_BOUNDS):
+    self.bounds = bounds
+    self.reset()
+
+  def reset(self):
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def add(self, value):
+    i = 0
+    while i < len(self.bounds) and value > self.bounds[i]:
+      i += 1
+    self.counts[i] += 1
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+  def mean(self):
+    return self.sum / self.count if self.count else 0.0
+
+  def format(self, scale=1000.0, unit="ms"):
+    buckets = []
+    for i, c in enumerate(self.counts):
+      if c:
+        bound = "<={0:g}".format(self.bounds[i] * scale) if i < len(self.bounds) else ">{0:g}".format(self.bounds[-1] * scale)
+        buckets.append("{0}:{1}".format(bound, c))
+    return "n {0} mean {1:.3f}{3} max {2:.3f}{3} [{4}]".format(self.count, self.mean() * scale, self.max * scale, unit, " ".join(buckets))
+
+# Runs ticks of period seconds. Within a tick until(offset) sleeps to the
+# tick's deadline plus offset. next() moves on to the following tick; if the
+# loop has fallen more than catchup ticks behind the extra ticks are skipped
+# and counted in missed rather than run back to back.
+class DeadlineScheduler:
+  def __init__(self, clock, period, catchup=0):
+    self.clock = clock
+    self.period = period
+    self.catchup = catchup
+    self.lateness = Histogram()
+    self.start()
+
+  def start(self):
+    self.deadline = self.clock.time()
+    self.tick = 0
+    self.missed = 0
+    self.ticklate = 0.0
+    self.lateness.reset()
+
+  def until(self, offset=0.0):
+    target = self.deadline + offset
+    self.clock.sleepUntil(target)
+    late = self.clock.time() - target
+    if late > self.ticklate:
+      self.ticklate = late
+    return late
+
+  def next(self):
+    self.lateness.add(self.ticklate)
+    self.ticklate = 0.0
+    self.tick += 1
+    self.deadline += self.period
+    behind = int((self.clock.time() - self.deadline) / self.period)
+    if behind > self.catchup:
+      skipped = behind - self.catchup
+      self.deadline += skipped * self.period
+      self.tick += skipped
+      self.missed += skipped
+      return skipped
+    return 0
+
+  def format(self):
+    return "ticks {0} missed {1} lateness {2}".format(self.tick, self.missed, self.lateness.format())
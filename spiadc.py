@@ -0,0 +1,163 @@
+import ctypes
+import fcntl
+import os
+from array import array
+
+# Fast MCP3008 reader. gpiozero's MCP3008.value costs an object call chain and
+# a separate SPI transaction per sample; SpiAdc talks to /dev/spidev directly
+# and reads a whole block of conversions, over any mix of channels, in one
+# SPI_IOC_MESSAGE ioctl. Counts are raw 10 bit integers.
+
+MAX_COUNT = 1023
+SPI_SPEED = 1000000
+SPI_MODE = 0
+# spidev's default buffer is 4096 bytes, 3 bytes per conversion each way
+MAX_BLOCK = 512
+# 24 clocks a conversion plus the chip select gap between transfers
+CONVERSION_TIME = 24.0 / SPI_SPEED + 0.000005
+
+SPI_IOC_MAGIC = ord("k")
+
+class SpiIocTransfer(ctypes.Structure):
+  _fields_ = [
+    ("tx_buf", ctypes.c_uint64),
+    ("rx_buf", ctypes.c_uint64),
+    ("len", ctypes.c_uint32),
+    ("speed_hz", ctypes.c_uint32),
+    ("delay_usecs", ctypes.c_uint16),
+    ("bits_per_word", ctypes.c_uint8),
+    ("cs_change", ctypes.c_uint8),
+    ("tx_nbits", ctypes.c_uint8),
+    ("rx_nbits", ctypes.c_uint8),
+    ("word_delay_usecs", ctypes.c_uint8),
+    ("pad", ctypes.c_uint8),
+  ]
+
+def _IOW(nr, size):
+  return (1 << 30) | (size << 16) | (SPI_IOC_MAGIC << 8) | nr
+
+SPI_IOC_WR_MODE = _IOW(1, 1)
+SPI_IOC_WR_BITS_PER_WORD = _IOW(3, 1)
+SPI_IOC_WR_MAX_SPEED_HZ = _IOW(4, 4)
+
+def SPI_IOC_MESSAGE(n):
+  return _IOW(0, n * ctypes.sizeof(SpiIocTransfer))
+
+# The conversions to make on each read, channels are read in order and the
+# whole list repeat times. counts holds the result of the last read.
+class AdcBlock:
+  def __init__(self, channels, repeat=1):
+    self.channels = list(channels) * repeat
+    if len(self.channels) == 0 or len(self.channels) > MAX_BLOCK:
+      raise ValueError("ADC block must have 1 to {0} conversions".format(MAX_BLOCK))
+    self.width = len(channels)
+    self.counts = array("H", [0]) * len(self.channels)
+
+  # Sum of the counts for channel index i of the channel list
+  def total(self, i=0):
+    return sum(self.counts[i::self.width])
+
+  # Mean of the counts for channel index i of the channel list, 0..1
+  def mean(self, i=0):
+    c = self.counts[i::self.width]
+    return sum(c) / (len(c) * MAX_COUNT)
+
+# How many times over to read channels conversions, at most repeat, to fit
+# in window seconds. Always a divisor of repeat so a sample can be scaled
+# back up to repeat conversions' worth exactly.
+def fitRepeat(channels, repeat, window):
+  for r in range(repeat, 0, -1):
+    if repeat % r == 0 and channels * r * CONVERSION_TIME <= window:
+      return r
+  return 1
+
+class SpiAdc:
+  name = "spi"
+
+  def __init__(self, device=0, bus=0, speed=SPI_SPEED):
+    self.path = "/dev/spidev{0}.{1}".format(bus, device)
+    self.speed = speed
+    self.fd = os.open(self.path, os.O_RDWR)
+    try:
+      fcntl.ioctl(self.fd, SPI_IOC_WR_MODE, bytes([SPI_MODE]))
+      fcntl.ioctl(self.fd, SPI_IOC_WR_BITS_PER_WORD, bytes([8]))
+      fcntl.ioctl(self.fd, SPI_IOC_WR_MAX_SPEED_HZ, speed.to_bytes(4, "little"))
+    except OSError:
+      os.close(self.fd)
+      raise
+
+  def plan(self, channels, repeat=1):
+    block = AdcBlock(channels, repeat)
+    n = len(block.channels)
+    block.tx = (ctypes.c_uint8 * (3 * n))()
+    block.rx = (ctypes.c_uint8 * (3 * n))()
+    block.transfers = (SpiIocTransfer * n)()
+    for i, channel in enumerate(block.channels):
+      # Start bit, single ended, channel in the top nibble
+      block.tx[3 * i] = 1
+      block.tx[3 * i + 1] = (8 + channel) << 4
+      t = block.transfers[i]
+      t.tx_buf = ctypes.addressof(block.tx) + 3 * i
+      t.rx_buf = ctypes.addressof(block.rx) + 3 * i
+      t.len = 3
+      t.speed_hz = self.speed
+      t.bits_per_word = 8
+      # Drop chip select between conversions, the MCP3008 needs it
+      t.cs_change = 1 if i < n - 1 else 0
+    block.request = SPI_IOC_MESSAGE(n)
+    return block
+
+  def read(self, block):
+    fcntl.ioctl(self.fd, block.request, block.transfers)
+    rx = bytes(block.rx)
+    counts = block.counts
+    for i in range(len(counts)):
+      counts[i] = ((rx[3 * i + 1] & 3) << 8) | rx[3 * i + 2]
+    return counts
+
+  def close(self):
+    if self.fd != None:
+      os.close(self.fd)
+      self.fd = None
+
+# Same interface on top of the backend's per channel readers, gpiozero's
+# MCP3008 on the Pi. One conversion per .value.
+class BackendAdc:
+  name = "gpiozero"
+
+  def __init__(self, hw, device=0):
+    self.hw = hw
+    self.device = device
+    self.adcs = {}
+
+  def plan(self, channels, repeat=1):
+    block = AdcBlock(channels, repeat)
+    for channel in channels:
+      if channel not in self.adcs:
+        self.adcs[channel] = self.hw.adc(channel, self.device)
+    block.adcs = [self.adcs[channel] for channel in block.channels]
+    return block
+
+  def read(self, block):
+    counts = block.counts
+    for i, adc in enumerate(block.adcs):
+      counts[i] = int(round(adc.value * MAX_COUNT))
+    return counts
+
+  def close(self):
+    self.adcs = {}
+
+_spiadcs = {}
+
+# The fast reader where there is an spidev device to use, otherwise the
+# backend's. SPI readers are shared between feeders on the same device.
+def openAdc(hw, device=0, fast=True, verbose=0):
+  if fast and hw.name == "pi":
+    try:
+      if device not in _spiadcs:
+        _spiadcs[device] = SpiAdc(device)
+      return _spiadcs[device]
+    except OSError as e:
+      if verbose:
+        print("SPI ADC unavailable, using gpiozero: {0}".format(e))
+  return BackendAdc(hw, device)
@@ -0,0 +1,69 @@
+import unittest
+import caltable
+
+class FitTest(unittest.TestCase):
+  def test_one_weighin_is_a_ratio(self):
+    t = caltable.fit([(50.0, 40.0)])
+    self.assertEqual(t.knots, [(0.0, 0.0), (50.0, 40.0)])
+    self.assertAlmostEqual(t.weight(25.0), 20.0)
+    self.assertAlmostEqual(t.target(80.0), 100.0)
+
+  def test_offset(self):
+    points = [(s, 2.0 + 0.8 * s) for s in (10.0, 20.0, 40.0, 60.0)]
+    t = caltable.fit(points)
+    self.assertAlmostEqual(t.weight(0.0), 2.0)
+    self.assertAlmostEqual(t.target(18.0), 20.0)
+    # No more than the offset needs no sums
+    self.assertAlmostEqual(t.target(2.0), 0.0)
+    self.assertEqual(t.target(1.0), 0.0)
+    self.assertEqual(t.target(0.0), 0.0)
+
+  def test_linear_weighins_fit_exactly(self):
+    points = [(s, 0.8 * s) for s in (10.0, 25.0, 40.0, 70.0, 90.0)]
+    for pieces in (1, 2):
+      t = caltable.fit(points, pieces)
+      for s, g in points:
+        self.assertAlmostEqual(t.weight(s), g)
+
+  def test_bend(self):
+    # Steeper above 50, where the knot goes with half the weigh-ins each side
+    points = [(s, 0.5 * s + 0.5 * max(s - 50.0, 0.0)) for s in (10.0, 20.0, 30.0, 50.0, 60.0, 80.0)]
+    t = caltable.fit(points, 2)
+    self.assertEqual([s for s, g in t.knots], [0.0, 50.0, 80.0])
+    for s, g in points:
+      self.assertAlmostEqual(t.weight(s), g)
+    self.assertAlmostEqual(t.weight(t.target(35.0)), 35.0)
+
+  def test_order_of_weighins(self):
+    points = [(40.0, 30.0), (10.0, 8.0), (25.0, 19.0)]
+    self.assertEqual(caltable.fit(points, 2).knots, caltable.fit(sorted(points), 2).knots)
+
+  def test_no_weighins(self):
+    self.assertRaises(ValueError, caltable.fit, [])
+    self.assertRaises(ValueError, caltable.fit, [(0.0, 10.0)])
+
+  def test_decreasing(self):
+    self.assertRaises(ValueError, caltable.fit, [(10.0, -5.0), (20.0, -10.0), (30.0, -12.0)])
+
+class CalTableTest(unittest.TestCase):
+  def test_not_increasing(self):
+    self.assertRaises(ValueError, caltable.CalTable, [(0.0, 0.0), (10.0, 0.0)])
+    self.assertRaises(ValueError, caltable.CalTable, [(0.0, 0.0)])
+
+  def test_extends_past_the_ends(self):
+    t = caltable.CalTable([(0.0, 0.0), (10.0, 5.0), (20.0, 15.0)])
+    self.assertAlmostEqual(t.weight(30.0), 25.0)
+    self.assertAlmostEqual(t.weight(-10.0), -5.0)
+    self.assertAlmostEqual(t.target(t.weight(13.0)), 13.0)
+
+class SolveTest(unittest.TestCase):
+  def test_solve(self):
+    x = caltable.solve([[2.0, 1.0], [1.0, 3.0]], [3.0, 5.0])
+    self.assertAlmostEqual(x[0], 0.8)
+    self.assertAlmostEqual(x[1], 1.4)
+
+  def test_singular(self):
+    self.assertEqual(caltable.solve([[1.0, 2.0], [2.0, 4.0]], [1.0, 2.0]), None)
+
+if __name__ == "__main__":
+  unittest.main()
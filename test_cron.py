@@ -0,0 +1,134 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+import cron
+
+def at(*args):
+  return datetime(*args).timestamp()
+
+class FieldTest(unittest.TestCase):
+  def test_fields(self):
+    self.assertEqual(cron.parseField("*", 0, 5), [0, 1, 2, 3, 4, 5])
+    self.assertEqual(cron.parseField("1,3-5", 0, 59), [1, 3, 4, 5])
+    self.assertEqual(cron.parseField("*/15", 0, 59), [0, 15, 30, 45])
+    self.assertEqual(cron.parseField("5/20", 0, 59), [5, 25, 45])
+    self.assertEqual(cron.parseField("mon-wed", 0, 7, cron.DAYS), [1, 2, 3])
+
+  def test_bad_fields(self):
+    for text in ("60", "5-1", "*/0", "x"):
+      self.assertRaises(ValueError, cron.parseField, text, 0, 59)
+
+class EntryTest(unittest.TestCase):
+  def test_next(self):
+    e = cron.CronEntry("30 7,18 * * *".split())
+    self.assertEqual(e.next(at(2026, 10, 18, 8, 0)), at(2026, 10, 18, 18, 30))
+    self.assertEqual(e.next(at(2026, 10, 18, 18, 30)), at(2026, 10, 19, 7, 30))
+
+  def test_sunday_is_0_and_7(self):
+    # 18 October 2026 is a Sunday
+    for field in ("0", "7", "sun"):
+      e = cron.CronEntry(["0", "12", "*", "*", field])
+      self.assertEqual(e.next(at(2026, 10, 17, 13, 0)), at(2026, 10, 18, 12, 0))
+
+  def test_day_or_weekday(self):
+    # Both restricted, either one matches
+    e = cron.CronEntry("0 12 1 * mon".split())
+    self.assertEqual(e.next(at(2026, 10, 18, 13, 0)), at(2026, 10, 19, 12, 0))
+    self.assertEqual(e.next(at(2026, 10, 26, 13, 0)), at(2026, 11, 1, 12, 0))
+    # Only the day restricted
+    e = cron.CronEntry("0 12 1 * *".split())
+    self.assertEqual(e.next(at(2026, 10, 18, 13, 0)), at(2026, 11, 1, 12, 0))
+
+  def test_months(self):
+    e = cron.CronEntry("0 0 1 jan *".split())
+    self.assertEqual(e.next(at(2026, 10, 18)), at(2027, 1, 1))
+
+class CrontabTest(unittest.TestCase):
+  def test_parse(self):
+    text = "\n".join([
+      "# 0 7 * * * root catfeeder.py --left Nala --feed 25",
+      "0 7 * * * root python3 catfeeder.py --left Nala --right Rosie --feed 25",
+      "@daily root python3 catfeeder.py --feed 10",
+      "@reboot root python3 catfeeder.py --left Nala --feed 10",
+      "0 3 * * * root python3 catfeeder.py --left Nala --reset",
+      "61 7 * * * root python3 catfeeder.py --left Nala --feed 25",
+      "0 8 * * * root backup",
+    ])
+    entries = cron.parseCrontab(text)
+    self.assertEqual([names for entry, names in entries], [["Nala", "Rosie"], [None]])
+    self.assertEqual(entries[1][0].hours, [0])
+
+  def test_registry_names(self):
+    entries = cron.parseCrontab("0 7 * * * root python3 catfeeder.py --cat Tom --left Nala --feed 25")
+    self.assertEqual(entries[0][1], ["Tom", "Nala"])
+
+  def test_user_crontab(self):
+    entries = cron.parseCrontab("0 7 * * * python3 catfeeder.py --right Rosie --feed 25", system=False)
+    self.assertEqual(entries[0][1], ["Rosie"])
+
+class ScheduleTest(unittest.TestCase):
+  def schedule(self, text):
+    f = tempfile.NamedTemporaryFile("w", suffix=".crontab", delete=False)
+    f.write(text)
+    f.close()
+    self.addCleanup(os.unlink, f.name)
+    return cron.FeedSchedule(f.name)
+
+  def test_next(self):
+    s = self.schedule("0 7,18 * * * root python3 catfeeder.py --left Nala --feed 25\n")
+    self.assertEqual(s.next("Nala", at(2026, 10, 18, 8, 0)), at(2026, 10, 18, 18, 0))
+    self.assertEqual(s.next("Rosie", at(2026, 10, 18, 8, 0)), None)
+
+  def test_anyone(self):
+    s = self.schedule("\n".join([
+      "0 7 * * * root python3 catfeeder.py --left Nala --feed 25",
+      "0 9 * * * root python3 catfeeder.py --feed 10",
+    ]))
+    self.assertEqual(s.next(None, at(2026, 10, 18, 8, 0)), at(2026, 10, 18, 9, 0))
+    # Feeds for everyone count for each cat
+    self.assertEqual(s.next("Rosie", at(2026, 10, 18, 9, 0)), at(2026, 10, 19, 9, 0))
+
+  def test_rebuilds_past_its_end(self):
+    s = self.schedule("0 7 * * * root python3 catfeeder.py --left Nala --feed 25\n")
+    self.assertEqual(s.next("Nala", at(2026, 10, 18, 8, 0)), at(2026, 10, 19, 7, 0))
+    self.assertEqual(s.next("Nala", at(2026, 11, 20, 8, 0)), at(2026, 11, 21, 7, 0))
+
+  def test_invalidate(self):
+    s = self.schedule("0 7 * * * root python3 catfeeder.py --left Nala --feed 25\n")
+    self.assertEqual(s.next("Nala", at(2026, 10, 18, 6, 0)), at(2026, 10, 18, 7, 0))
+    with open(s.path, "w") as f:
+      f.write("30 6 * * * root python3 catfeeder.py --left Nala --feed 25\n")
+    # Kept until told the crontab changed
+    self.assertEqual(s.next("Nala", at(2026, 10, 18, 6, 0)), at(2026, 10, 18, 7, 0))
+    s.invalidate()
+    self.assertEqual(s.next("Nala", at(2026, 10, 18, 6, 0)), at(2026, 10, 18, 6, 30))
+
+  # a664b88: a cat whose only feed is further off than INDEX_DAYS got None,
+  # even with other cats' feeds in the index
+  def test_beyond_index_with_others_indexed(self):
+    s = self.schedule("\n".join([
+      "0 12 1 * * root python3 catfeeder.py --left Nala --feed 25",
+      "0 7 * * * root python3 catfeeder.py --right Rosie --feed 25",
+    ]))
+    now = at(2026, 10, 18, 13, 0)
+    self.assertEqual(s.next("Nala", now), at(2026, 11, 1, 12, 0))
+    self.assertEqual(s.next("Rosie", now), at(2026, 10, 19, 7, 0))
+    self.assertEqual(s.next(None, now), at(2026, 10, 19, 7, 0))
+    # The index moves on, the cached answer holds until it goes by
+    self.assertEqual(s.next("Nala", at(2026, 10, 25, 13, 0)), at(2026, 11, 1, 12, 0))
+    self.assertEqual(s.next("Nala", at(2026, 11, 1, 12, 0)), at(2026, 12, 1, 12, 0))
+
+  def test_beyond_index(self):
+    s = self.schedule("\n".join([
+      "0 12 1 * * root python3 catfeeder.py --left Nala --feed 25",
+      "0 0 1 jan * root python3 catfeeder.py --feed 10",
+    ]))
+    self.assertEqual(s.next("Nala", at(2026, 10, 18, 13, 0)), at(2026, 11, 1, 12, 0))
+    self.assertEqual(s.next("Rosie", at(2026, 10, 18, 13, 0)), at(2027, 1, 1))
+    self.assertEqual(s.next(None, at(2026, 10, 18, 13, 0)), at(2026, 11, 1, 12, 0))
+    # Within the index once it's close
+    self.assertEqual(s.next("Nala", at(2026, 10, 28, 13, 0)), at(2026, 11, 1, 12, 0))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,78 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime
+import feedschedule
+import hardware
+
+def at(*args):
+  return datetime(*args).timestamp()
+
+class Cat:
+  def __init__(self, name):
+    self.name = name
+    self.nextfeed = None
+
+  def saveLater(self):
+    pass
+
+class Cats:
+  def __init__(self, names):
+    self.feeders = [Cat(name) for name in names]
+
+  def find(self, name):
+    for f in self.feeders:
+      if f.name == name:
+        return f
+    return None
+
+# What FeedScheduler needs of FeederDaemon, keeping the feeds it is asked for
+class Daemon:
+  def __init__(self, clock, names):
+    self.clock = clock
+    self.collection = Cats(names)
+    self.fed = []
+
+  def feedWeights(self, weights):
+    self.fed.append((self.clock.wall(), weights))
+    return []
+
+class SchedulerTest(unittest.TestCase):
+  def setUp(self):
+    self.clock = hardware.VirtualClock()
+    # 8:00 on 18 October 2026
+    self.clock.epoch = at(2026, 10, 18, 8, 0)
+    f = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    f.close()
+    self.path = f.name
+    self.addCleanup(os.unlink, self.path)
+
+  def write(self, meals):
+    with open(self.path, "w") as f:
+      f.write(json.dumps({ "meals": meals }))
+
+  def test_skips_nameless_meals(self):
+    self.write([{ "time": "07:00", "grams": 25 }, { "time": "08:00", "names": ["Nala"], "grams": 10 }])
+    policy, meals = feedschedule.loadSchedule(self.path)
+    self.assertEqual([meal.weights for meal in meals], [{ "Nala": 10.0 }])
+
+  def test_reload_doesnt_feed_past_meals(self):
+    self.write([{ "time": "18:00", "names": ["Nala"], "grams": 25 }])
+    daemon = Daemon(self.clock, ["Nala"])
+    scheduler = feedschedule.FeedScheduler(daemon, self.path)
+    scheduler.start()
+    self.clock.sleep(4 * 3600)
+    # At 12:00 a 10:00 meal is added, it has already gone by today
+    self.write([{ "time": "10:00", "names": ["Nala"], "grams": 10 },
+                { "time": "18:00", "names": ["Nala"], "grams": 25 }])
+    scheduler.reload()
+    self.clock.sleep(60)
+    self.assertEqual(daemon.fed, [])
+    self.clock.sleep(6 * 3600)
+    self.assertEqual(daemon.fed, [(at(2026, 10, 18, 18, 0), { "Nala": 25.0 })])
+    self.assertEqual(daemon.collection.feeders[0].nextfeed, at(2026, 10, 19, 10, 0))
+    scheduler.stop()
+
+if __name__ == "__main__":
+  unittest.main()
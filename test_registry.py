@@ -0,0 +1,76 @@
+import unittest
+import registry
+
+def spec(**settings):
+  return dict({ "name": "Nala", "pwm": 19, "reset": 12, "adc": 0, "clockwise": 5, "anticlockwise": 9 }, **settings)
+
+class FeederSpecTest(unittest.TestCase):
+  def test_parse(self):
+    s = registry.FeederSpec(spec(device=1, timing={ "antiflipmax": 0.9, "flips": 3 }))
+    self.assertEqual(s.pins(), (19, 12))
+    self.assertEqual((s.device, s.adc), (1, 0))
+    self.assertEqual(s.timing, { "antiflipmax": 0.9, "flips": 3 })
+    self.assertEqual(registry.FeederSpec(spec()).device, 0)
+
+  def test_sides(self):
+    self.assertEqual(registry.side("right", "Rosie").pins(), (18, 24))
+
+  def test_unknown_keys(self):
+    self.assertRaises(ValueError, registry.FeederSpec, spec(colour="red"))
+    self.assertRaises(ValueError, registry.FeederSpec, spec(timing={ "spin": 1.0 }))
+
+  def test_missing_or_bad_values(self):
+    self.assertRaises(ValueError, registry.FeederSpec, [])
+    self.assertRaises(ValueError, registry.FeederSpec, spec(name=""))
+    settings = spec()
+    del settings["adc"]
+    self.assertRaises(ValueError, registry.FeederSpec, settings)
+    for bad in (8, -1, True, 1.0, "0"):
+      self.assertRaises(ValueError, registry.FeederSpec, spec(adc=bad))
+    self.assertRaises(ValueError, registry.FeederSpec, spec(device=registry.ADC_DEVICES))
+    self.assertRaises(ValueError, registry.FeederSpec, spec(clockwise=registry.DUTY_MAX + 1))
+    self.assertRaises(ValueError, registry.FeederSpec, spec(timing=[]))
+    self.assertRaises(ValueError, registry.FeederSpec, spec(timing={ "antiflip": 0 }))
+    self.assertRaises(ValueError, registry.FeederSpec, spec(timing={ "flips": 0.5 }))
+
+  def test_reserved_pins(self):
+    for pin in registry.SPI_PINS + (registry.DEBUG_PIN,):
+      self.assertRaises(ValueError, registry.FeederSpec, spec(pwm=pin))
+      self.assertRaises(ValueError, registry.FeederSpec, spec(reset=pin))
+    self.assertRaises(ValueError, registry.FeederSpec, spec(pwm=28))
+    self.assertRaises(ValueError, registry.FeederSpec, spec(reset=19))
+
+  def test_flip_above_maximum(self):
+    self.assertRaises(ValueError, registry.FeederSpec, spec(timing={ "antiflip": 2.0, "antiflipmax": 1.0 }))
+    self.assertRaises(ValueError, registry.FeederSpec, spec(timing={ "clockflip": 100.0 }))
+    # Equal is fine
+    registry.FeederSpec(spec(timing={ "antiflip": 1.0, "antiflipmax": 1.0 }))
+
+  def test_message_names_the_feeder(self):
+    with self.assertRaises(ValueError) as e:
+      registry.FeederSpec(spec(colour="red"))
+    self.assertEqual(str(e.exception), "Feeder Nala: unknown setting colour")
+
+class ValidateTest(unittest.TestCase):
+  def rosie(self, **settings):
+    return registry.FeederSpec(dict(spec(name="Rosie", pwm=18, reset=24, adc=1), **settings))
+
+  def test_valid(self):
+    specs = [registry.FeederSpec(spec()), self.rosie(), self.rosie(name="Tom", pwm=20, reset=21, device=1, adc=0)]
+    self.assertEqual(registry.validate(specs), specs)
+
+  def test_duplicate_names(self):
+    self.assertRaises(ValueError, registry.validate, [registry.FeederSpec(spec()), self.rosie(name="Nala")])
+
+  def test_duplicate_pins(self):
+    self.assertRaises(ValueError, registry.validate, [registry.FeederSpec(spec()), self.rosie(pwm=19)])
+    # One feeder's pwm pin is another's reset
+    self.assertRaises(ValueError, registry.validate, [registry.FeederSpec(spec()), self.rosie(reset=19)])
+
+  def test_duplicate_channels(self):
+    self.assertRaises(ValueError, registry.validate, [registry.FeederSpec(spec()), self.rosie(adc=0)])
+    # The same channel on the other ADC is a different channel
+    registry.validate([registry.FeederSpec(spec()), self.rosie(adc=0, device=1)])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,148 @@
+import array
+import itertools
+import json
+import os
+import threading
+import time
+
+# Software stand-in for timing DEBUG_PIN on a logic analyser. When a Tracer
+# is in use, ADC reads, integrator batches, motor steps and save() calls
+# record begin and end events, from every thread, into arrays allocated up
+# front. dump() writes them as Chrome trace event JSON for chrome://tracing
+# or ui.perfetto.dev. Motor states are shown as async spans, one track per
+# feeder, since they overlap the sampler's spans in the loop engine.
+#
+# Spans are with blocks from span(), which hands back one shared span that
+# records nothing unless tracing was asked for, so tracing costs a call
+# when it is off. Async spans and instants look the tracer up with active(),
+# which is None then.
+
+TRACE_EVENTS = 1 << 18
+
+# Event phases, as Chrome names them
+BEGIN = "B"
+END = "E"
+ASYNC_BEGIN = "b"
+ASYNC_END = "e"
+INSTANT = "i"
+PHASES = [BEGIN, END, ASYNC_BEGIN, ASYNC_END, INSTANT]
+
+class Tracer:
+  def __init__(self, size=TRACE_EVENTS):
+    self.size = size
+    self.times = array.array("d", bytes(8 * size))
+    self.phases = bytearray(size)
+    self.tids = array.array("q", bytes(8 * size))
+    self.names = [None] * size
+    self.args = [None] * size
+    # next() on a count is atomic, so threads never share a slot
+    self.counter = itertools.count()
+    self.dropped = 0
+    self.threads = {}
+    self.start = time.perf_counter()
+    self.pid = os.getpid()
+
+  def add(self, phase, name, arg):
+    i = next(self.counter)
+    if i >= self.size:
+      self.dropped += 1
+      return
+    tid = threading.get_ident()
+    if tid not in self.threads:
+      self.threads[tid] = threading.current_thread().name
+    self.times[i] = time.perf_counter()
+    self.phases[i] = phase
+    self.tids[i] = tid
+    self.names[i] = name
+    self.args[i] = arg
+
+  def begin(self, name, arg=None):
+    self.add(0, name, arg)
+
+  def end(self, name, arg=None):
+    self.add(1, name, arg)
+
+  # Spans that needn't nest with the thread's others, arg tells them apart
+  def asyncBegin(self, name, arg):
+    self.add(2, name, arg)
+
+  def asyncEnd(self, name, arg):
+    self.add(3, name, arg)
+
+  def instant(self, name, arg=None):
+    self.add(4, name, arg)
+
+  def span(self, name, arg=None):
+    return Span(self, name, arg)
+
+  # Events recorded, once the threads are done with them
+  def count(self):
+    n = 0
+    while n < self.size and self.names[n] != None:
+      n += 1
+    return n
+
+  def events(self):
+    events = []
+    for tid, name in self.threads.items():
+      events.append({ "name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": { "name": name } })
+    for i in range(self.count()):
+      phase = PHASES[self.phases[i]]
+      event = {
+        "name": self.names[i],
+        "ph": phase,
+        "ts": (self.times[i] - self.start) * 1e6,
+        "pid": self.pid,
+        "tid": self.tids[i]
+      }
+      if phase in (ASYNC_BEGIN, ASYNC_END):
+        event["cat"] = "motor"
+        event["id"] = str(self.args[i])
+      elif phase == INSTANT:
+        event["s"] = "t"
+      if self.args[i] != None:
+        event["args"] = { "feeder": self.args[i] }
+      events.append(event)
+    return events
+
+  def dump(self, path):
+    with open(path, "w") as f:
+      json.dump({ "traceEvents": self.events(), "displayTimeUnit": "ms",
+                  "otherData": { "dropped": self.dropped } }, f)
+
+class Span:
+  def __init__(self, tracer, name, arg):
+    self.tracer = tracer
+    self.name = name
+    self.arg = arg
+
+  def __enter__(self):
+    self.tracer.begin(self.name, self.arg)
+    return self
+
+  def __exit__(self, *exc):
+    self.tracer.end(self.name, self.arg)
+    return False
+
+TRACER = None
+
+def use(tracer):
+  global TRACER
+  TRACER = tracer
+  return tracer
+
+def active():
+  return TRACER
+
+class NoSpan:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+NOSPAN = NoSpan()
+
+# The with block as a span on the tracer in use, if there is one
+def span(name, arg=None):
+  return NOSPAN if TRACER == None else TRACER.span(name, arg)
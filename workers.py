@@ -0,0 +1,61 @@
+import threading
+import traceback
+from collections import deque
+
+# Long lived threads that run jobs handed to them, in order. Every feed used
+# to start a measure, an integrator and a motor thread and join them again at
+# the end, and calibration another for each run between weigh-ins; now each
+# feeder keeps its three workers, a background one for calibration's runs
+# and a writer that saves its settings and journal off the sampling threads,
+# and the collection its sampler, started with the first job and then only
+# given the next one. The threads come from clock.thread() so they take part in virtual
+# time; an idle worker blocks on its event like any other waiting thread.
+#
+#   submit(fn, *args)  queue fn(*args) and return at once
+#   join()             wait until everything submitted has run
+#   busy()             anything queued or running
+
+class Worker:
+  def __init__(self, clock, name):
+    self.clock = clock
+    self.name = name
+    self.jobs = deque()
+    self.lock = threading.Lock()
+    self.pending = 0
+    self.ready = clock.event()
+    self.idle = clock.event()
+    self.idle.set()
+    self.thread = None
+
+  def submit(self, fn, *args):
+    with self.lock:
+      if self.thread == None:
+        self.thread = self.clock.thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+      self.pending += 1
+      self.idle.clear()
+      self.jobs.append((fn, args))
+    self.ready.set()
+
+  def join(self):
+    self.idle.wait()
+
+  def busy(self):
+    return self.pending > 0
+
+  def run(self):
+    while True:
+      self.ready.wait()
+      self.ready.clear()
+      while self.jobs:
+        fn, args = self.jobs.popleft()
+        try:
+          fn(*args)
+        except Exception:
+          print("{0}: job failed".format(self.name))
+          traceback.print_exc()
+        with self.lock:
+          self.pending -= 1
+          if self.pending == 0:
+            self.idle.set()